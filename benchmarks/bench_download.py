@@ -0,0 +1,91 @@
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Usage: python3 -m benchmarks.bench_download [MIB] [MIB_PER_SECOND_PER_CONNECTION]
+
+import hashlib
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Importing the SDK opens the configuration database, which should not be the one of the user
+os.environ.setdefault('ONEDRIVE_CONFIG_PATH', os.path.join(tempfile.gettempdir(), 'bench_download.sqlite'))
+
+from onedrive.sdk import download_by_url  # noqa: E402
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(content: bytes, rate: float):
+    class Handler(BaseHTTPRequestHandler):
+        """Serve @content with ranges, sending at most @rate bytes per second through each connection"""
+
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            begin, end = 0, len(content)
+            if 'Range' in self.headers:
+                first, _, last = self.headers['Range'][len('bytes='):].partition('-')
+                begin, end = int(first), min(int(last) + 1 if last else len(content), len(content))
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(begin, end - 1, len(content)))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - begin))
+            self.end_headers()
+            started = time.perf_counter()
+            for offset in range(begin, end, 64 * 1024):
+                self.wfile.write(content[offset:min(offset + 64 * 1024, end)])
+                ahead = (offset + 64 * 1024 - begin) / rate - (time.perf_counter() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def main(size: int, rate: int):
+    content = os.urandom(size * 1024 * 1024)
+    checksum = {'sha1Hash': hashlib.sha1(content).hexdigest()}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(content, rate * 1024 * 1024))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/content'.format(server.server_address[1])
+
+    print('{:>12} {:>10} {:>10}'.format('connections', 'seconds', 'MiB/s'))
+    with tempfile.TemporaryDirectory() as directory:
+        for connections in [1, 2, 4, 8]:
+            path = os.path.join(directory, str(connections))
+            with open(path, 'w+b') as destination:
+                begin = time.perf_counter()
+                download_by_url(url, destination, 0, checksum=checksum, connections=connections,
+                                part_size=4 * 1024 * 1024)
+                elapsed = time.perf_counter() - begin
+            if os.path.getsize(path) != len(content):
+                raise AssertionError()
+            print('{:>12} {:>10.3f} {:>10.1f}'.format(connections, elapsed, size / elapsed))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 64, int(sys.argv[2]) if len(sys.argv) > 2 else 16)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Usage: python3 -m benchmarks.bench_hashes [FILES] [MIB_PER_FILE]
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from onedrive.algorithms import HASH_ENGINES, hash_file, hash_files
+
+ALGORITHMS = ['sha1Hash', 'crc32Hash', 'quickXorHash']
+
+
+def hash_file_by_reading_whole(path: Path, algorithms):
+    # The previous implementation, which reads the whole file once per algorithm
+    result = {}
+    for algorithm in algorithms:
+        engine = HASH_ENGINES[algorithm]()
+        engine.send(None)
+        engine.send(path.read_bytes())
+        result[algorithm] = engine.send(None)
+    return result
+
+
+def main(count: int, size: int):
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for index in range(count):
+            path = Path(directory) / str(index)
+            with path.open('wb') as file:
+                for _ in range(size):
+                    file.write(bytes(range(256)) * 4096)
+            paths.append(path)
+        total = count * size
+
+        print('{:>24} {:>10} {:>10}'.format('method', 'seconds', 'MiB/s'))
+
+        def report(name, function):
+            begin = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - begin
+            print('{:>24} {:>10.3f} {:>10.1f}'.format(name, elapsed, total / elapsed))
+
+        report('read whole per hash', lambda: [hash_file_by_reading_whole(path, ALGORITHMS) for path in paths])
+        report('streaming', lambda: [hash_file(path, ALGORITHMS) for path in paths])
+        for workers in [2, 4, 8]:
+            report('streaming, {} threads'.format(workers), lambda: hash_files({
+                str(index): (path, ALGORITHMS) for index, path in enumerate(paths)
+            }, workers=workers))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 16, int(sys.argv[2]) if len(sys.argv) > 2 else 64)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Usage: python3 -m benchmarks.bench_memory [SIZE]
+
+import resource
+import subprocess
+import sys
+import time
+
+from onedrive.compact import CompactTree
+from onedrive.model import Tree, CloudFile, Directory
+
+BACKENDS = {
+    'default': Tree,
+    'compact': CompactTree
+}
+
+
+def _peak_rss() -> int:
+    # Kibibytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def build_tree(backend, size: int, *, files_per_dir: int = 10) -> Tree:
+    """Build a tree of @size nodes looking like a retrieved delta"""
+    tree = backend('ROOT')
+    for index in range(size):
+        identifier = '5A3F0BCA1E3D6C7B!{:d}'.format(index)
+        parent = '5A3F0BCA1E3D6C7B!{:d}'.format(index - index % (files_per_dir + 1)) if index > files_per_dir else 'ROOT'
+        if index % (files_per_dir + 1) == 0:
+            tree.dirs[identifier] = Directory(identifier, 'Folder {:d}'.format(index), 'ROOT')
+        else:
+            tree.files[identifier] = CloudFile(
+                identifier,
+                'IMG_{:04d}.JPG'.format(index % 10000),
+                parent,
+                0,
+                '"{{5A3F0BCA-1E3D-6C7B-{:012X}}},1"'.format(index),
+                '"c:{{5A3F0BCA-1E3D-6C7B-{:012X}}},2"'.format(index),
+                {
+                    'sha1Hash': '{:040X}'.format(index * 2654435761),
+                    'crc32Hash': '{:08X}'.format(index & 0xffffffff)
+                }
+            )
+    tree.reconstruct_by_parents()
+    return tree
+
+
+def measure(backend_name: str, size: int) -> None:
+    before = _peak_rss()
+    begin = time.perf_counter()
+    tree = build_tree(BACKENDS[backend_name], size)
+    elapsed = time.perf_counter() - begin
+    print('{:>10} {:>10} {:>14.1f} {:>10.3f}'.format(
+        backend_name, len(tree.files) + len(tree.dirs), (_peak_rss() - before) / 1024, elapsed
+    ))
+
+
+def main(size: int):
+    print('{:>10} {:>10} {:>14} {:>10}'.format('backend', 'nodes', 'peak RSS MiB', 'seconds'))
+    for backend_name in BACKENDS:
+        # Peak RSS only grows within a process, so every backend is measured in a fresh one
+        subprocess.run([sys.executable, '-m', __spec__.name, '--child', backend_name, str(size)], check=True)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        measure(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000000)
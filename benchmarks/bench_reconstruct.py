@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Usage: python3 -m benchmarks.bench_reconstruct [SIZE...]
+
+import random
+import sys
+import time
+
+from onedrive.model import Tree, File, Directory
+
+
+def build_tree(size: int, *, files_per_dir: int = 8, seed: int = 0) -> Tree:
+    """Build a random tree of about @size nodes, a few of them orphans"""
+    rng = random.Random(seed)
+    tree = Tree('0')
+    dir_ids = ['0']
+    count = 0
+    while count < size:
+        parent = rng.choice(dir_ids)
+        identifier = str(count + 1)
+        if count % (files_per_dir + 1) == 0:
+            tree.dirs[identifier] = Directory(identifier, 'Folder ' + identifier, parent)
+            dir_ids.append(identifier)
+        else:
+            tree.files[identifier] = File(identifier, 'File ' + identifier, parent)
+        count += 1
+    # Orphans with missing parents
+    for index in range(size // 1000):
+        identifier = 'orphan' + str(index)
+        tree.files[identifier] = File(identifier, identifier, 'missing' + str(index))
+    return tree
+
+
+def main(sizes):
+    print('{:>10} {:>10} {:>14}'.format('nodes', 'seconds', 'us per node'))
+    for size in sizes:
+        tree = build_tree(size)
+        begin = time.perf_counter()
+        tree.reconstruct_by_parents()
+        elapsed = time.perf_counter() - begin
+        print('{:>10} {:>10.3f} {:>14.3f}'.format(size, elapsed, elapsed / size * 1e6))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000, 2000000])
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Usage: python3 -m benchmarks.bench_transport [REQUESTS] [THREADS] [LATENCY_MS]
+# Needs httpx[http2]
+
+import asyncio
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+os.environ.setdefault('ONEDRIVE_CONFIG_PATH', str(tempfile.mktemp(suffix='.sqlite')))
+
+import requests  # noqa: E402
+from h2.config import H2Configuration  # noqa: E402
+from h2.connection import H2Connection  # noqa: E402
+from h2.events import StreamEnded, ConnectionTerminated  # noqa: E402
+from requests.adapters import HTTPAdapter  # noqa: E402
+
+from onedrive.transport import HTTPXAdapter  # noqa: E402
+
+BODY = b'{"id": "0123456789ABCDEF!123", "name": "file"}'
+
+
+class NoDelayMixIn:
+    def get_request(self):
+        connection, address = super().get_request()
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection, address
+
+
+class HTTP1Server(NoDelayMixIn, socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_http1_handler(latency: float, connections: list):
+    class Handler(BaseHTTPRequestHandler):
+        """Respond after @latency seconds, where a new connection costs another two for handshakes"""
+
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            connections.append(None)
+            time.sleep(2 * latency)
+
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class HTTP2Server:
+    """Serve HTTP/2 with prior knowledge on an event loop, responding after @latency seconds as the other server"""
+
+    def __init__(self, latency: float, connections: list):
+        self._latency = latency
+        self._connections = connections
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._serve, '127.0.0.1', 0))
+        self.server_address = self._server.sockets[0].getsockname()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.append(None)
+        await asyncio.sleep(2 * self._latency)
+        connection = H2Connection(H2Configuration(client_side=False))
+        connection.initiate_connection()
+        writer.write(connection.data_to_send())
+
+        def _respond(stream_id: int):
+            connection.send_headers(stream_id, [
+                (':status', '200'),
+                ('content-type', 'application/json'),
+                ('content-length', str(len(BODY)))
+            ])
+            connection.send_data(stream_id, BODY, end_stream=True)
+            writer.write(connection.data_to_send())
+
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            events = connection.receive_data(data)
+            writer.write(connection.data_to_send())
+            for event in events:
+                if isinstance(event, StreamEnded):
+                    self._loop.call_later(self._latency, _respond, event.stream_id)
+            if any(isinstance(event, ConnectionTerminated) for event in events):
+                break
+        writer.close()
+
+    def serve_forever(self):
+        self._loop.run_forever()
+
+    def shutdown(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def run(session: requests.Session, url: str, count: int, threads: int) -> float:
+    def _get(_):
+        response = session.get(url)
+        response.raise_for_status()
+        return response.json()
+
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(_get, range(count)))
+    return time.perf_counter() - begin
+
+
+def main(count: int, threads: int, latency: float):
+    connections = {'http1': [], 'http2': []}
+    http1 = HTTP1Server(('127.0.0.1', 0), make_http1_handler(latency, connections['http1']))
+    http2 = HTTP2Server(latency, connections['http2'])
+    for server in [http1, http2]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    urls = {name: 'http://127.0.0.1:{}/'.format(server.server_address[1])
+            for name, server in [('http1', http1), ('http2', http2)]}
+
+    # Servers are plain HTTP here, so HTTP/2 is used with prior knowledge instead of negotiated by TLS
+    transports = [
+        ('requests, HTTP/1.1', 'http1', lambda: HTTPAdapter(pool_maxsize=threads)),
+        ('httpx, HTTP/1.1', 'http1', lambda: HTTPXAdapter(HTTPXAdapter.create_client(http2=False))),
+        ('httpx, HTTP/2', 'http2', lambda: HTTPXAdapter(HTTPXAdapter.create_client(http1=False)))
+    ]
+
+    print('{:>20} {:>10} {:>12} {:>12}'.format('transport', 'seconds', 'requests/s', 'connections'))
+    for name, server, transport in transports:
+        del connections[server][:]
+        with requests.Session() as session:
+            session.mount('http://', transport())
+            elapsed = run(session, urls[server], count, threads)
+        print('{:>20} {:>10.3f} {:>12.1f} {:>12}'.format(name, elapsed, count / elapsed, len(connections[server])))
+
+    http1.shutdown()
+    http2.shutdown()
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 32,
+        (int(sys.argv[3]) if len(sys.argv) > 3 else 20) / 1000
+    )
@@ -13,20 +13,23 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import copy
 import hashlib
 import itertools
+import os
 import zlib
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import singledispatch
 from pathlib import Path
-from typing import Set, Tuple, Sequence, Optional, Callable, Mapping
+from typing import Set, Tuple, Sequence, Optional, Callable, Mapping, List, Iterable, Dict
 
 import attr
 
 from . import _compare_size
 from .model import Operation, AddFile, DelFile, ModifyFile, RenameMoveFile, AddDir, DelDir, RenameMoveDir, CloudFile
 from .model import Tree, check_operation, basic_operation, File, LocalFile
+from .overlay import OverlayTree
+from .quickxor import QuickXorHash
 
 
 def compare_file_by_cTag(before: CloudFile, after: CloudFile) -> bool:
@@ -40,26 +43,324 @@ def compare_file_by_mtime(last_sync_timestamp: int) -> Callable[[File, LocalFile
     return _
 
 
-def compare_file_by_hashes(id_to_path: Mapping[str, Path]) -> Callable[[LocalFile, CloudFile], bool]:
+class HashCache:
+    """Cache of hashes of local files, see database.ContentHashCache"""
+
+    def get(self, stat: os.stat_result, algorithms: Iterable[str]) -> Optional[Dict[str, str]]:
+        raise NotImplementedError()
+
+    def put(self, stat: os.stat_result, hashes: Mapping[str, str]) -> None:
+        raise NotImplementedError()
+
+
+def _file_version(stat: os.stat_result) -> Tuple[int, int, int, int]:
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def hash_file(path: Path, algorithms: Iterable[str], *, chunk_size: int = 1024 * 1024,
+              cache: HashCache = None) -> Dict[str, str]:
+    """Calculate the hashes of a file in one pass, unsupported algorithms are ignored"""
+    algorithms = [algorithm for algorithm in algorithms if algorithm in HASH_ENGINES]
+    if cache is not None:
+        stat = path.stat()
+        cached = cache.get(stat, algorithms)
+        if cached is not None:
+            return cached
+    engines = {algorithm: HASH_ENGINES[algorithm]() for algorithm in algorithms}
+    for engine in engines.values():
+        engine.send(None)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with path.open('rb', buffering=0) as file:
+        while True:
+            length = file.readinto(buffer)
+            if not length:
+                break
+            for engine in engines.values():
+                engine.send(view[:length])
+    result = {algorithm: engine.send(None) for algorithm, engine in engines.items()}
+    # The file may be modified while reading
+    if cache is not None and _file_version(path.stat()) == _file_version(stat):
+        cache.put(stat, result)
+    return result
+
+
+def hash_files(jobs: Mapping[str, Tuple[Path, Iterable[str]]], *, workers: int = 4,
+               cache: HashCache = None) -> Dict[str, Dict[str, str]]:
+    """Calculate the hashes of files concurrently, hashlib and zlib release the GIL for large buffers
+
+    :param jobs: Mapping from identifiers to paths and algorithms needed
+    :return: Mapping from identifiers to hashes
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            identifier: executor.submit(hash_file, path, algorithms, cache=cache)
+            for identifier, (path, algorithms) in jobs.items()
+        }
+        return {identifier: future.result() for identifier, future in futures.items()}
+
+
+def compare_file_by_hashes(id_to_path: Mapping[str, Path], *, before: Tree = None, after: Tree = None,
+                           workers: int = 4, cache: HashCache = None) -> Callable[[LocalFile, CloudFile], bool]:
+    """Compare files by their content
+
+    If the trees to be compared are given, files existing in both are hashed concurrently in advance
+    """
+    calculated = {}
+    if before is not None and after is not None:
+        calculated = hash_files({
+            identifier: (id_to_path[identifier], after.files[identifier].hashes or {})
+            for identifier in before.files.keys() & after.files.keys()
+        }, workers=workers, cache=cache)
+
     def _(before: LocalFile, after: CloudFile) -> bool:
         if not _compare_size(before.size, after.size):
             return False
         hashes = after.hashes if after.hashes is not None else {}
-        for algorithm in hashes:
-            engine = HASH_ENGINES[algorithm]()
-            engine.send(None)
-            engine.send(id_to_path[before.id].read_bytes())
-            if engine.send(None) != after.hashes[algorithm].upper():
+        if before.id in calculated:
+            actual = calculated[before.id]
+        else:
+            actual = hash_file(id_to_path[before.id], hashes, cache=cache)
+        for algorithm, value in actual.items():
+            if value != normalize_hash(algorithm, hashes[algorithm]):
                 return False
         return True
 
     return _
 
 
-def get_change_set(before: Tree, after: Tree, file_comparison: Callable[[File, File], bool]) -> Set[Operation]:
+def drop_unchanged_content(change_sets: Sequence[Set[Operation]], local_tree: Tree, cloud_tree: Tree,
+                           id_to_path: Mapping[str, Path], *, workers: int = 4,
+                           cache: HashCache = None) -> List[Set[Operation]]:
+    """Omit modifications of files whose local content is the same as the cloud one
+
+    Touching a file or bumping the cTag of it without changing the content does not need any transfer. Candidates
+    are hashed concurrently, and files without any supported hash are kept modified.
+    """
+    candidates = {
+        line.id for change_set in change_sets for line in change_set
+        if isinstance(line, ModifyFile) and line.id in local_tree.files and line.id in cloud_tree.files
+    }
+    jobs = {}
+    for identifier in candidates:
+        local_file = local_tree.files[identifier]
+        cloud_file = cloud_tree.files[identifier]
+        if cloud_file.hashes and _compare_size(local_file.size, cloud_file.size):
+            jobs[identifier] = (id_to_path[identifier], cloud_file.hashes)
+
+    unchanged = set()
+    for identifier, actual in hash_files(jobs, workers=workers, cache=cache).items():
+        expected = cloud_tree.files[identifier].hashes
+        if actual and all(value == normalize_hash(algorithm, expected[algorithm])
+                          for algorithm, value in actual.items()):
+            unchanged.add(identifier)
+
+    return [
+        {line for line in change_set if not (isinstance(line, ModifyFile) and line.id in unchanged)}
+        for change_set in change_sets
+    ]
+
+
+# Only strong hashes are used to identify content, crc32Hash collides too easily
+_COPY_ALGORITHMS = ('sha1Hash', 'quickXorHash')
+
+
+def _touched_cloud_nodes(script: Sequence[Operation], tree: Tree) -> Set[str]:
+    # Nodes changed by @script and all their ancestors, whose current content cannot be relied on
+    touched = set()
+    for line in script:
+        if isinstance(line, (AddFile, AddDir)):
+            touched.add(line.parent_id)
+        else:
+            touched.add(line.id)
+            if isinstance(line, (RenameMoveFile, RenameMoveDir)) and line.destination_id is not None:
+                touched.add(line.destination_id)
+    result = set()
+    for identifier in touched:
+        while identifier is not None and identifier not in result:
+            result.add(identifier)
+            node = tree.files.get(identifier) or tree.dirs.get(identifier)
+            identifier = node.parent if node is not None else None
+    return result
+
+
+def _dir_signature(tree: Tree, dir_id: str, file_signature: Callable[[str], Optional[bytes]],
+                   signatures: Dict[str, Optional[bytes]]) -> Optional[bytes]:
+    # A digest of the names and contents of everything inside, or None if anything inside is unknown
+    if dir_id in signatures:
+        return signatures[dir_id]
+    directory = tree.dirs[dir_id]
+    entries = []
+    result = None
+    for name, child_id in directory.names.items():
+        if child_id in directory.files:
+            signature = file_signature(child_id)
+        else:
+            signature = _dir_signature(tree, child_id, file_signature, signatures)
+        if signature is None:
+            break
+        entries.append((name, child_id in directory.files, signature))
+    else:
+        result = hashlib.sha1(repr(sorted(entries)).encode()).digest()
+    signatures[dir_id] = result
+    return result
+
+
+def find_cloud_copies(local_script: Sequence[Operation], local_tree: Tree, cloud_tree: Tree,
+                      id_to_path: Mapping[str, Path], *, workers: int = 4,
+                      cache: HashCache = None) -> Dict[str, str]:
+    """Find newly added local nodes whose content already exists in the cloud, so that they can be copied there
+
+    A directory is only copied if everything inside it is newly added and its content is the same as a cloud
+    directory untouched by @local_script. Nodes inside copied directories are not returned.
+
+    :return: Mapping from the identifiers of the local nodes to the ones of their cloud sources
+    """
+    algorithm = next((algorithm for algorithm in _COPY_ALGORITHMS if any(
+        algorithm in (file.hashes or {}) for file in cloud_tree.files.values()
+    )), None)
+    added = [line for line in local_script if isinstance(line, (AddFile, AddDir))]
+    if algorithm is None or not added:
+        return {}
+    touched = _touched_cloud_nodes(local_script, cloud_tree)
+
+    def _cloud_file_signature(file_id: str) -> Optional[bytes]:
+        file = cloud_tree.files[file_id]
+        if file_id in touched or algorithm not in (file.hashes or {}):
+            return None
+        return repr((file.size, normalize_hash(algorithm, file.hashes[algorithm]))).encode()
+
+    local_hashes = hash_files({
+        line.child_id: (id_to_path[line.child_id], [algorithm]) for line in added if isinstance(line, AddFile)
+    }, workers=workers, cache=cache)
+
+    def _local_file_signature(file_id: str) -> Optional[bytes]:
+        if algorithm not in local_hashes.get(file_id, {}):
+            return None
+        return repr((local_tree.files[file_id].size, local_hashes[file_id][algorithm])).encode()
+
+    cloud_files = {}
+    for file_id in cloud_tree.files:
+        signature = _cloud_file_signature(file_id)
+        if signature is not None:
+            cloud_files.setdefault(signature, file_id)
+    cloud_dirs = {}
+    if any(isinstance(line, AddDir) for line in added):
+        cloud_signatures = {}
+        for dir_id in cloud_tree.dirs:
+            signature = _dir_signature(cloud_tree, dir_id, _cloud_file_signature, cloud_signatures)
+            if signature is not None and dir_id != cloud_tree.root_id and dir_id not in touched:
+                cloud_dirs.setdefault(signature, dir_id)
+
+    added_ids = {line.child_id for line in added}
+    # Directories moved into newly added ones are not copied along
+    local_signatures = {
+        child_id: None for line in added if isinstance(line, AddDir)
+        for child_id in local_tree.dirs[line.child_id].dirs if child_id not in added_ids
+    }
+    copies = {}
+    inside = set()
+    # Parents are always added before their children
+    for line in added:
+        if line.parent_id in copies or line.parent_id in inside:
+            inside.add(line.child_id)
+            continue
+        if isinstance(line, AddFile):
+            source_id = cloud_files.get(_local_file_signature(line.child_id))
+        else:
+            signature = _dir_signature(local_tree, line.child_id, lambda file_id: (
+                _local_file_signature(file_id) if file_id in added_ids else None
+            ), local_signatures)
+            source_id = cloud_dirs.get(signature)
+        if source_id is not None:
+            copies[line.child_id] = source_id
+    return copies
+
+
+def find_local_sources(cloud_script: Sequence[Operation], local_tree: Tree, cloud_tree: Tree,
+                       id_to_path: Mapping[str, Path], sizes: Mapping[str, int], *, workers: int = 4,
+                       cache: HashCache = None) -> Dict[str, str]:
+    """Find local files with the same content as the files added by @cloud_script, so that no download is needed
+
+    Only local files with the same sizes as the added ones are hashed, and files modified by @cloud_script are
+    never used as sources. Sizes of files in trees are unreliable, see _compare_size, so the sizes reported by the
+    cloud are compared with the ones of the local files on disk.
+
+    :param sizes: Sizes of the files added by @cloud_script, see sdk.retrieve_delta, where files of unknown sizes are
+        always downloaded
+    :return: Mapping from the identifiers of the added files to the ones of the local files
+    """
+    wanted = defaultdict(lambda: defaultdict(list))
+    for line in cloud_script:
+        if not isinstance(line, AddFile) or sizes.get(line.child_id) is None:
+            continue
+        file = cloud_tree.files[line.child_id]
+        for algorithm in _COPY_ALGORITHMS:
+            if algorithm in (file.hashes or {}):
+                wanted[sizes[line.child_id]][algorithm, normalize_hash(algorithm, file.hashes[algorithm])].append(
+                    line.child_id
+                )
+    if not wanted:
+        return {}
+    modified = {line.id for line in cloud_script if isinstance(line, ModifyFile)}
+
+    jobs = {}
+    local_sizes = {}
+    for identifier in local_tree.files:
+        if identifier in modified:
+            continue
+        try:
+            size = id_to_path[identifier].stat().st_size
+        except OSError:
+            continue
+        if size in wanted:
+            jobs[identifier] = (id_to_path[identifier], {algorithm for algorithm, _ in wanted[size]})
+            local_sizes[identifier] = size
+    sources = {}
+    for identifier, hashes in hash_files(jobs, workers=workers, cache=cache).items():
+        candidates = wanted[local_sizes[identifier]]
+        for algorithm, value in hashes.items():
+            for added_id in candidates.get((algorithm, value), ()):
+                sources.setdefault(added_id, identifier)
+    return sources
+
+
+def _changed_nodes(tree: Tree, other: Tree) -> Tuple[Set[str], Set[str]]:
+    # Nodes in subtrees of @tree whose digests differ from the ones in @other
+    files = set()
+    dirs = set()
+    stack = [tree.root_id]
+    while stack:
+        dir_id = stack.pop()
+        if dir_id in other.dirs and tree.digest(dir_id) == other.digest(dir_id):
+            continue
+        directory = tree.dirs[dir_id]
+        dirs.add(dir_id)
+        files.update(directory.files)
+        stack.extend(directory.dirs)
+    return files, dirs
+
+
+def get_change_set(before: Tree, after: Tree, file_comparison: Callable[[File, File], bool], *,
+                   by_digest: bool = False) -> Set[Operation]:
+    """Generate operations that turn @before into @after
+
+    If @by_digest is set, subtrees with the same digests are skipped, which is only valid if @file_comparison
+    compares files by their cTags. The digests of saved trees are loaded with them, so only the changed subtrees are
+    visited, while digests not computed yet cost more than a full comparison
+    """
     change_set = set()
 
-    for file_id in before.files.keys() | after.files.keys():
+    if by_digest:
+        before_files, before_dirs = _changed_nodes(before, after)
+        after_files, after_dirs = _changed_nodes(after, before)
+        file_ids = before_files | after_files
+        dir_ids = before_dirs | after_dirs
+    else:
+        file_ids = before.files.keys() | after.files.keys()
+        dir_ids = before.dirs.keys() | after.dirs.keys()
+
+    for file_id in file_ids:
         if file_id not in before.files:
             file = after.files[file_id]
             change_set.add(AddFile(file.parent, file_id, file.name, file.size))
@@ -81,7 +382,7 @@ def get_change_set(before: Tree, after: Tree, file_comparison: Callable[[File, F
         if not file_comparison(before_file, after_file):
             change_set.add(ModifyFile(file_id, after_file.size))
 
-    for dir_id in before.dirs.keys() | after.dirs.keys():
+    for dir_id in dir_ids:
         if dir_id not in before.dirs:
             directory = after.dirs[dir_id]
             change_set.add(AddDir(directory.parent, dir_id, directory.name))
@@ -118,6 +419,9 @@ def check_same_node_operations(cloud_changes: Set[Operation], local_changes: Set
 
     for identifier in cloud_by_id.keys() & local_by_id.keys():
         for cloud_change, local_change in itertools.product(cloud_by_id[identifier], local_by_id[identifier]):
+            if cloud_change == local_change and not isinstance(cloud_change, ModifyFile):
+                # Exactly the same operations do not conflict, see drop_common_operations
+                continue
             if isinstance(cloud_change, (
                     DelFile, ModifyFile, RenameMoveFile
             )) and isinstance(local_change, (
@@ -279,43 +583,49 @@ def mark_dependencies(tree: Tree, change_set: Set[Operation]) -> Set[Tuple[Opera
     return dependencies
 
 
-def topological_sort(change_set: Set[Operation], dependencies: Set[Tuple[Operation, Operation]]) -> Sequence[Operation]:
-    result = []
-    change_set = set(change_set)
+def topological_layers(change_set: Set[Operation],
+                       dependencies: Set[Tuple[Operation, Operation]]) -> List[List[Operation]]:
+    """Sort the operations into layers with Kahn's algorithm
 
-    predecessors = defaultdict(set)
-    successors = defaultdict(set)
+    Every operation only depends on operations in previous layers, so operations in the same layer can be applied
+    concurrently. Inside a layer, transfers are placed after other operations.
+    """
+    operations = list(change_set)
+    indices = {operation: index for index, operation in enumerate(operations)}
+    in_degrees = [0] * len(operations)
+    successors = [[] for _ in operations]
     for consumer, producer in dependencies:
-        predecessors[consumer].add(producer)
-        successors[producer].add(consumer)
+        successors[indices[producer]].append(indices[consumer])
+        in_degrees[indices[consumer]] += 1
 
-    while True:
-        count = False
-        for operation in set(change_set):
-            if isinstance(operation, (AddFile, ModifyFile)):
-                continue
-            if not predecessors[operation]:
-                count = True
-                change_set.remove(operation)
-                result.append(operation)
-                for consumer in successors[operation]:
-                    predecessors[consumer].remove(operation)
-        if not count:
-            break
+    result = []
+    layer = [index for index, in_degree in enumerate(in_degrees) if not in_degree]
+    while layer:
+        layer.sort(key=lambda index: isinstance(operations[index], (AddFile, ModifyFile)))
+        result.append([operations[index] for index in layer])
+        next_layer = []
+        for producer in layer:
+            for consumer in successors[producer]:
+                in_degrees[consumer] -= 1
+                if not in_degrees[consumer]:
+                    next_layer.append(consumer)
+        layer = next_layer
+
+    if any(in_degrees):
+        raise Exception('Topological sorting failed, possible loops: ' + str({
+            operations[index] for index, in_degree in enumerate(in_degrees) if in_degree
+        }))
 
-    for operation in set(change_set):
-        if isinstance(operation, (AddFile, ModifyFile)):
-            change_set.remove(operation)
-            result.append(operation)
+    return result
 
-    if change_set:
-        raise Exception('Topological sorting failed, possible loops: ' + str(change_set))
 
-    return result
+def topological_sort(change_set: Set[Operation], dependencies: Set[Tuple[Operation, Operation]]) -> Sequence[Operation]:
+    return list(itertools.chain.from_iterable(topological_layers(change_set, dependencies)))
 
 
 def field_test(tree: Tree, script: Sequence[Operation]) -> Tree:
-    field = copy.deepcopy(tree)
+    # The resulting tree is a view of @tree, so @tree must not be modified while it is in use
+    field = OverlayTree(tree)
     for line in script:
         if check_operation(line, field):
             basic_operation(line, field)
@@ -325,22 +635,56 @@ def field_test(tree: Tree, script: Sequence[Operation]) -> Tree:
     return field
 
 
-def optimize_cloud_deletion(tree: Tree, script: Sequence[Operation]) -> Sequence[Operation]:
+ScriptPass = Callable[[Tree, Sequence[Operation], Sequence[Operation]], List[Operation]]
+
+
+def drop_common_operations(tree: Tree, script: Sequence[Operation],
+                           other_script: Sequence[Operation]) -> List[Operation]:
+    """Omit operations which are also in the other script, as they have been applied on both sides"""
+    # Two ModifyFile operations are equal as long as the sizes are equal, so they are never omitted
+    common = {line for line in other_script if not isinstance(line, ModifyFile)}
+    return [line for line in script if line not in common]
+
+
+def prune_deletions(tree: Tree, script: Sequence[Operation], other_script: Sequence[Operation]) -> List[Operation]:
+    """Omit deletions inside deleted directories, as deleting a directory deletes everything inside"""
+    deleted_dirs = {line.id for line in script if isinstance(line, DelDir)}
     result = []
     for line in script:
-        if isinstance(line, (DelFile, DelDir)):
-            if isinstance(line, DelFile):
-                parent_id = tree.files[line.id].parent
-            elif isinstance(line, DelDir):
-                parent_id = tree.dirs[line.id].parent
-            else:
-                raise AssertionError()
-            if any(isinstance(op, DelDir) and op.id == parent_id for op in script):
-                continue
+        if isinstance(line, DelFile) and tree.files[line.id].parent in deleted_dirs:
+            continue
+        if isinstance(line, DelDir) and tree.dirs[line.id].parent in deleted_dirs:
+            continue
         result.append(line)
     return result
 
 
+def optimize_scripts(
+        cloud_tree: Tree,
+        cloud_script: Sequence[Operation],
+        local_tree: Tree,
+        local_script: Sequence[Operation],
+        passes: Sequence[ScriptPass]
+) -> Tuple[List[Operation], List[Operation], Mapping[str, int]]:
+    """Apply optimization passes to both scripts
+
+    :param cloud_tree: The tree which the cloud script is generated against
+    :param local_tree: The tree which the local script is generated against
+    :return: The optimized scripts, and the number of operations saved by each pass
+    """
+    cloud_script = list(cloud_script)
+    local_script = list(local_script)
+    saved = OrderedDict()
+    for script_pass in passes:
+        count = len(cloud_script) + len(local_script)
+        cloud_script, local_script = (
+            script_pass(cloud_tree, cloud_script, local_script),
+            script_pass(local_tree, local_script, cloud_script)
+        )
+        saved[script_pass.__name__] = count - len(cloud_script) - len(local_script)
+    return cloud_script, local_script, saved
+
+
 def _sha1():
     engine = hashlib.sha1()
     while True:
@@ -361,8 +705,26 @@ def _crc32():
     yield (engine & 0xffffffff).to_bytes(4, 'little').hex().upper()
 
 
+def _quick_xor():
+    engine = QuickXorHash()
+    while True:
+        chunk = yield
+        if chunk is None:
+            break
+        engine.update(chunk)
+    yield engine.b64digest()
+
+
 HASH_ENGINES = {
     'sha1Hash': _sha1,
     'crc32Hash': _crc32,
-    # quickXOR hashes?
+    'quickXorHash': _quick_xor
 }
+
+
+def normalize_hash(algorithm: str, value: str) -> str:
+    """Convert a hash provided by OneDrive to the format generated by HASH_ENGINES"""
+    # Hexadecimal hashes are case-insensitive, but quickXorHash is encoded in Base64
+    if algorithm == 'quickXorHash':
+        return value
+    return value.upper()
@@ -14,13 +14,16 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import json
 import logging
 from pathlib import Path
 
 from requests.exceptions import HTTPError
 
 from .sync import sync, SyncDirection
-from .database import CONFIG, clear_all_trees, session_scope
+from .database import CONFIG, TREE_BACKENDS, clear_all_trees, session_scope
+from .transfer import BandwidthSchedule, TransferPriority
+from .transport import TRANSPORTS, HTTPXAdapter
 
 
 def main():
@@ -38,6 +41,25 @@ def main():
     group_config.add_argument('--set-root-id', metavar='ROOT_ID', help='''
     [DO NOT USE IF YOU DO NOT KNOW WHAT THIS MEANS] Specify the root id of your sub-folder in OneDrive
     ''')
+    group_config.add_argument('--set-tree-backend', choices=sorted(TREE_BACKENDS), help='''
+    Specify how trees are stored in memory, "compact" uses less memory for huge drives but is slower
+    ''')
+    group_config.add_argument('--set-transport', choices=sorted(TRANSPORTS), help='''
+    Specify how requests are sent, "httpx" multiplexes them over HTTP/2 connections and needs httpx[http2] installed
+    ''')
+    group_config.add_argument('--set-upload-limit', metavar='SCHEDULE', help='''
+    Limit the upload bandwidth in bytes per second, like "2M" or "08:00-18:00=512K,22:00-06:00=unlimited,2M" for
+    different rates at different times of day, where the rate without a period applies to the rest of the day
+    ''')
+    group_config.add_argument('--set-download-limit', metavar='SCHEDULE', help='''
+    Limit the download bandwidth, in the same format as --set-upload-limit
+    ''')
+    group_config.add_argument('--set-transfer-priority', metavar='RULES', help='''
+    Order transfers by comma-separated rules among {}, applied in order (Default: paths,small-first)
+    '''.format(', '.join(TransferPriority.RULES)))
+    group_config.add_argument('--set-priority-paths', metavar='PATH', nargs='*', help='''
+    Transfer files at or inside these paths relative to the location first, with the "paths" rule
+    ''')
 
     parser.description = '''Run this program with no arguments after setting location initiates a synchronization'''
     parser.epilog = '''
@@ -49,11 +71,50 @@ def main():
 
     logging.getLogger().setLevel(logging.INFO)
 
-    if (args.download_only or args.upload_only) and (args.set_root_id is not None or args.set_location is not None):
+    transfer_settings = {
+        'upload_limit': args.set_upload_limit,
+        'download_limit': args.set_download_limit,
+        'transfer_priority': args.set_transfer_priority,
+        'priority_paths': json.dumps(args.set_priority_paths) if args.set_priority_paths is not None else None
+    }
+    transfer_settings = {key: value for key, value in transfer_settings.items() if value is not None}
+
+    if (args.download_only or args.upload_only) and (
+            args.set_root_id is not None or args.set_location is not None or args.set_tree_backend is not None or
+            args.set_transport is not None or transfer_settings
+    ):
         parser.error('Please configure before use')
 
     if args.set_root_id is not None and args.set_location is None:
         parser.error('Cannot reset root id now')
+    if args.set_tree_backend is not None:
+        CONFIG.tree_backend = args.set_tree_backend
+        logging.info('Tree backend set successfully')
+    if args.set_transport is not None:
+        if args.set_transport == 'httpx':
+            try:
+                HTTPXAdapter.shared_client()
+            except Exception as error:
+                parser.error(str(error))
+        CONFIG.transport = args.set_transport
+        logging.info('Transport set successfully')
+    if transfer_settings:
+        try:
+            for key in ('upload_limit', 'download_limit'):
+                if key in transfer_settings:
+                    BandwidthSchedule.parse(transfer_settings[key])
+            if 'transfer_priority' in transfer_settings:
+                TransferPriority(filter(None, transfer_settings['transfer_priority'].split(',')))
+        except ValueError as error:
+            parser.error(str(error))
+        for key, value in transfer_settings.items():
+            setattr(CONFIG, key, value)
+        logging.info('Transfer settings set successfully')
+    if (args.set_tree_backend is not None or args.set_transport is not None or transfer_settings) and (
+            args.set_location is None
+    ):
+        return 0
+
     if args.set_location is not None:
         path = Path(args.set_location)
         if not path.is_dir():
@@ -0,0 +1,234 @@
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from array import array
+from typing import Dict, Iterator, List, MutableMapping, Optional
+
+from .model import Tree, File, CloudFile
+
+
+class _Interner:
+    """Bidirectional mapping between strings and small integers"""
+
+    def __init__(self):
+        self._values = []
+        self._indices = {}
+
+    def intern(self, value: Optional[str]) -> int:
+        index = self._indices.get(value)
+        if index is None:
+            index = len(self._values)
+            self._values.append(value)
+            self._indices[value] = index
+        return index
+
+    def __getitem__(self, index: int) -> Optional[str]:
+        return self._values[index]
+
+
+class _TextColumn:
+    """Strings packed into one buffer and addressed by row
+
+    A value is overwritten in place if the new one is not longer, otherwise it is appended to the buffer
+    """
+
+    _NONE = 0xffffffff
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._offsets = array('Q')
+        self._lengths = array('I')
+
+    def __getitem__(self, row: int) -> Optional[str]:
+        length = self._lengths[row]
+        if length == self._NONE:
+            return None
+        offset = self._offsets[row]
+        return self._buffer[offset:offset + length].decode()
+
+    def __setitem__(self, row: int, value: Optional[str]) -> None:
+        while row >= len(self._lengths):
+            self._offsets.append(0)
+            self._lengths.append(self._NONE)
+        if value is None:
+            self._lengths[row] = self._NONE
+            return
+        data = value.encode()
+        length = self._lengths[row]
+        if length == self._NONE or length < len(data):
+            self._offsets[row] = len(self._buffer)
+            self._buffer += data
+        else:
+            offset = self._offsets[row]
+            self._buffer[offset:offset + len(data)] = data
+        self._lengths[row] = len(data)
+
+
+def _pack_hashes(hashes: Optional[Dict[str, str]]) -> Optional[str]:
+    if not hashes:
+        return None
+    return '\0'.join(key + '\0' + value for key, value in hashes.items())
+
+
+def _unpack_hashes(packed: Optional[str]) -> Dict[str, str]:
+    if packed is None:
+        return {}
+    fields = packed.split('\0')
+    return dict(zip(fields[::2], fields[1::2]))
+
+
+class _CompactFile(CloudFile):
+    """A view of one row of _CompactFiles, attributes are read from and written to the columns"""
+
+    __slots__ = ('_files', '_row')
+
+    def __init__(self, files: '_CompactFiles', row: int):
+        # The slots of the base classes are left unset, the properties below take their place
+        self._files = files
+        self._row = row
+
+    def __copy__(self) -> CloudFile:
+        # A detached copy, which does not write through to the columns
+        return CloudFile(self.id, self.name, self.parent, self.size, self.eTag, self.cTag, self.hashes)
+
+    @property
+    def id(self) -> str:
+        return self._files._ids[self._row]
+
+    @property
+    def name(self) -> str:
+        return self._files._name_table[self._files._names[self._row]]
+
+    @name.setter
+    def name(self, value: str) -> None:
+        self._files._names[self._row] = self._files._name_table.intern(value)
+
+    @property
+    def parent(self) -> str:
+        return self._files._parent_table[self._files._parents[self._row]]
+
+    @parent.setter
+    def parent(self, value: str) -> None:
+        self._files._parents[self._row] = self._files._parent_table.intern(value)
+
+    @property
+    def size(self) -> int:
+        return self._files._sizes[self._row]
+
+    @size.setter
+    def size(self, value: int) -> None:
+        self._files._sizes[self._row] = value
+
+    @property
+    def eTag(self) -> str:
+        return self._files._eTags[self._row]
+
+    @eTag.setter
+    def eTag(self, value: str) -> None:
+        self._files._eTags[self._row] = value
+
+    @property
+    def cTag(self) -> str:
+        return self._files._cTags[self._row]
+
+    @cTag.setter
+    def cTag(self, value: str) -> None:
+        self._files._cTags[self._row] = value
+
+    @property
+    def hashes(self) -> Dict[str, str]:
+        # A new dictionary is returned every time, so modifications must be assigned back
+        return _unpack_hashes(self._files._hashes[self._row])
+
+    @hashes.setter
+    def hashes(self, value: Dict[str, str]) -> None:
+        self._files._hashes[self._row] = _pack_hashes(value)
+
+
+class _CompactFiles(MutableMapping[str, File]):
+    """Files stored as parallel columns, with identifiers, names and parents interned"""
+
+    def __init__(self):
+        self._rows = {}
+        self._ids = []  # type: List[Optional[str]]
+        self._free = []  # type: List[int]
+        self._name_table = _Interner()
+        self._parent_table = _Interner()
+        self._names = array('I')
+        self._parents = array('I')
+        self._sizes = array('q')
+        self._eTags = _TextColumn()
+        self._cTags = _TextColumn()
+        self._hashes = _TextColumn()
+
+    def __getitem__(self, key: str) -> File:
+        return _CompactFile(self, self._rows[key])
+
+    def __setitem__(self, key: str, value: File) -> None:
+        row = self._rows.get(key)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+                self._ids[row] = key
+            else:
+                row = len(self._ids)
+                self._ids.append(key)
+                self._names.append(0)
+                self._parents.append(0)
+                self._sizes.append(0)
+            self._rows[key] = row
+        self._names[row] = self._name_table.intern(value.name)
+        self._parents[row] = self._parent_table.intern(value.parent)
+        self._sizes[row] = value.size
+        self._eTags[row] = getattr(value, 'eTag', None)
+        self._cTags[row] = getattr(value, 'cTag', None)
+        self._hashes[row] = _pack_hashes(getattr(value, 'hashes', None))
+
+    def __delitem__(self, key: str) -> None:
+        row = self._rows.pop(key)
+        self._ids[row] = None
+        self._eTags[row] = None
+        self._cTags[row] = None
+        self._hashes[row] = None
+        self._free.append(row)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._rows
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._rows)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def keys(self):
+        return self._rows.keys()
+
+
+class CompactTree(Tree):
+    """A tree that keeps the files in columns instead of one object per file
+
+    Only CloudFile attributes are kept, so it is suitable for the saved, delta and cloud trees. Directories are left
+    as they are because they are usually far fewer than files. Every lookup of a file returns a new view object, which
+    supports the same attributes as CloudFile.
+    """
+
+    def __init__(self, root_id: str):
+        super().__init__(root_id)
+        self._files = _CompactFiles()
+
+    @property
+    def files(self) -> MutableMapping[str, File]:
+        return self._files
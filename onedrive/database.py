@@ -13,17 +13,23 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import itertools
-from collections import OrderedDict
+import json
+import os
+import threading
 from contextlib import contextmanager
 from enum import IntEnum
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Set, Tuple
 
-from sqlalchemy import create_engine, Column, String, Integer
+import attr
+from sqlalchemy import create_engine, Column, String, Integer, Boolean
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 from .platform import DATABASE_LOCATION
-from .model import Tree, Directory, CloudFile
+from .algorithms import HashCache
+from .model import Tree, Directory, CloudFile, Operation, OPERATION_TYPES
+from .compact import CompactTree
 
 ENGINE = create_engine('sqlite:///' + str(DATABASE_LOCATION))
 Session = sessionmaker(bind=ENGINE)
@@ -46,6 +52,12 @@ def session_scope():
 class TreeType(IntEnum):
     SAVED = 1
     DELTA = 2
+    PLANNED = 3  # The cloud tree which the journalled scripts were planned against
+
+
+class ScriptType(IntEnum):
+    CLOUD = 1  # Changes in the cloud, applied locally
+    LOCAL = 2  # Changes made locally, applied to the cloud
 
 
 Base = declarative_base()
@@ -76,6 +88,14 @@ class DirEntity(Base):
     parent = Column(String)
 
 
+class DigestEntity(Base):
+    __tablename__ = 'dir_digests'
+    tree = Column(Integer, primary_key=True)
+    id = Column(String, primary_key=True)
+    structure = Column(Integer)
+    content = Column(Integer)
+
+
 class HashEntity(Base):
     __tablename__ = 'hashes'
     id = Column(String, primary_key=True)
@@ -83,6 +103,52 @@ class HashEntity(Base):
     value = Column(String)
 
 
+class ContentHashEntity(Base):
+    __tablename__ = 'content_hashes'
+    device = Column(Integer, primary_key=True)
+    inode = Column(Integer, primary_key=True)
+    type = Column(String, primary_key=True)
+    size = Column(Integer)
+    st_mtime_ns = Column(Integer)
+    value = Column(String)
+
+
+class JournalEntity(Base):
+    __tablename__ = 'journal'
+    script = Column(Integer, primary_key=True)
+    index = Column(Integer, primary_key=True)
+    operation = Column(String)
+    done = Column(Boolean)
+
+
+class JournalIdEntity(Base):
+    __tablename__ = 'journal_ids'
+    id = Column(String, primary_key=True)
+    path = Column(String)
+    real_id = Column(String)
+
+
+class UploadSessionEntity(Base):
+    __tablename__ = 'upload_sessions'
+    path = Column(String, primary_key=True)
+    parent_id = Column(String)
+    name = Column(String)
+    url = Column(String)
+    device = Column(Integer)
+    inode = Column(Integer)
+    size = Column(Integer)
+    st_mtime_ns = Column(Integer)
+    offset = Column(Integer)
+
+
+class PartialDownloadEntity(Base):
+    __tablename__ = 'partial_downloads'
+    id = Column(String, primary_key=True)
+    cTag = Column(String)
+    size = Column(Integer)
+    ranges = Column(String)
+
+
 Base.metadata.create_all(ENGINE)
 
 
@@ -110,6 +176,15 @@ CONFIG = Config()
 #     sys.exit(-1)
 CONFIG.db_version = 1
 
+TREE_BACKENDS = {
+    'default': Tree,
+    'compact': CompactTree
+}
+
+
+def create_tree(root_id: str) -> Tree:
+    return TREE_BACKENDS[getattr(CONFIG, 'tree_backend', 'default')](root_id)
+
 
 def save_tree(session: Session.class_, tree: Tree, tree_type: TreeType):
     files = tree.files.values()
@@ -139,11 +214,20 @@ def save_tree(session: Session.class_, tree: Tree, tree_type: TreeType):
         name=directory.name,
         parent=directory.parent
     ) for directory in dirs)
+    # Digests are saved so that the next comparison can skip unchanged subtrees at once, see get_change_set
+    session.query(DigestEntity).filter_by(tree=tree_type.value).delete()
+    session.add_all(DigestEntity(
+        tree=tree_type,
+        id=dir_id,
+        structure=structure,
+        content=content
+    ) for dir_id, (structure, content) in tree.all_digests().items())
 
 
 def load_tree(session: Session.class_, tree_type: TreeType) -> Tree:
-    files = OrderedDict()
-    dirs = OrderedDict()
+    tree = create_tree(CONFIG.root_id)
+    files = tree.files
+    dirs = tree.dirs
     for entity in session.query(FileEntity).filter_by(tree=tree_type.value):
         if tree_type == TreeType.DELTA:
             hashes = session.query(HashEntity).filter_by(id=entity.id).all()
@@ -161,10 +245,11 @@ def load_tree(session: Session.class_, tree_type: TreeType) -> Tree:
     for entity in session.query(DirEntity).filter_by(tree=tree_type.value):
         dirs[entity.id] = Directory(entity.id, entity.name, entity.parent)
 
-    tree = Tree(CONFIG.root_id)
-    tree.files.update(files)
-    tree.dirs.update(dirs)
     tree.reconstruct_by_parents()
+    tree.restore_digests({
+        entity.id: (entity.structure, entity.content)
+        for entity in session.query(DigestEntity).filter_by(tree=tree_type.value)
+    })
 
     return tree
 
@@ -172,4 +257,205 @@ def load_tree(session: Session.class_, tree_type: TreeType) -> Tree:
 def clear_all_trees(session: Session.class_):
     session.query(FileEntity).delete()
     session.query(DirEntity).delete()
+    session.query(DigestEntity).delete()
     session.query(HashEntity).delete()
+    clear_journal(session)
+
+
+class ContentHashCache(HashCache):
+    """Hashes of local files, keyed by device, inode, size and modification time
+
+    The whole table is loaded at once, and the changes are written back by save(). It is safe to be used from multiple
+    threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._dirty = set()
+        with session_scope() as session:
+            for entity in session.query(ContentHashEntity):
+                key = entity.device, entity.inode
+                size, st_mtime_ns, hashes = self._entries.setdefault(key, (entity.size, entity.st_mtime_ns, {}))
+                if (size, st_mtime_ns) == (entity.size, entity.st_mtime_ns):
+                    hashes[entity.type] = entity.value
+
+    def get(self, stat: os.stat_result, algorithms: Iterable[str]) -> Optional[Dict[str, str]]:
+        """The cached hashes, or None if the file has changed or any of the algorithms is missing"""
+        with self._lock:
+            entry = self._entries.get((stat.st_dev, stat.st_ino))
+        if entry is None or entry[:2] != (stat.st_size, stat.st_mtime_ns):
+            return None
+        hashes = entry[2]
+        if not all(algorithm in hashes for algorithm in algorithms):
+            return None
+        return {algorithm: hashes[algorithm] for algorithm in algorithms}
+
+    def put(self, stat: os.stat_result, hashes: Mapping[str, str]) -> None:
+        key = stat.st_dev, stat.st_ino
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[:2] != (stat.st_size, stat.st_mtime_ns):
+                entry = stat.st_size, stat.st_mtime_ns, {}
+                self._entries[key] = entry
+            entry[2].update(hashes)
+            self._dirty.add(key)
+
+    def save(self, alive: Iterable[Tuple[int, int]] = None) -> None:
+        """Write the changes back
+
+        :param alive: Devices and inodes of all existing files, the others are evicted if provided
+        """
+        with self._lock, session_scope() as session:
+            if alive is not None:
+                for key in self._entries.keys() - set(alive):
+                    del self._entries[key]
+                    self._dirty.add(key)
+            for device, inode in self._dirty:
+                session.query(ContentHashEntity).filter_by(device=device, inode=inode).delete()
+                if (device, inode) not in self._entries:
+                    continue
+                size, st_mtime_ns, hashes = self._entries[device, inode]
+                session.add_all(ContentHashEntity(
+                    device=device,
+                    inode=inode,
+                    type=type_,
+                    size=size,
+                    st_mtime_ns=st_mtime_ns,
+                    value=value
+                ) for type_, value in hashes.items())
+            self._dirty.clear()
+
+
+def _dump_operation(operation: Operation) -> str:
+    return json.dumps([type(operation).__name__, attr.asdict(operation)])
+
+
+def _load_operation(value: str) -> Operation:
+    type_name, fields = json.loads(value)
+    return OPERATION_TYPES[type_name](**fields)
+
+
+def save_journal(session: Session.class_, scripts: Mapping[ScriptType, Sequence[Operation]],
+                 temp_paths: Mapping[str, str], planned_tree: Tree):
+    """Record the scripts to be applied, so that an interrupted synchronization can be resumed
+
+    :param scripts: The scripts in the order they will be applied
+    :param temp_paths: Paths relative to the local root of the nodes with temporary identifiers, as temporary
+                       identifiers are assigned again in the next run
+    :param planned_tree: The cloud tree which the scripts were planned against, loaded by load_tree as
+                         TreeType.PLANNED, as the cloud may have changed again when resuming
+    """
+    clear_journal(session)
+    save_tree(session, planned_tree, TreeType.PLANNED)
+    session.add_all(JournalEntity(
+        script=script_type,
+        index=index,
+        operation=_dump_operation(operation),
+        done=False
+    ) for script_type, script in scripts.items() for index, operation in enumerate(script))
+    session.add_all(JournalIdEntity(id=temp_id, path=path, real_id=None) for temp_id, path in temp_paths.items())
+
+
+def load_journal(session: Session.class_) -> Optional[Tuple[
+    Dict[ScriptType, List[Operation]],
+    Set[Tuple[ScriptType, int]],
+    Dict[str, str],
+    Dict[str, str]
+]]:
+    """Load the scripts of an interrupted synchronization
+
+    :return: None if there is nothing to resume, otherwise the scripts, the indices of operations already applied,
+             the paths of temporary identifiers and the real identifiers assigned to them
+    """
+    entities = session.query(JournalEntity).order_by(JournalEntity.script, JournalEntity.index).all()
+    if not entities:
+        return None
+    scripts = {script_type: [] for script_type in ScriptType}
+    done = set()
+    for entity in entities:
+        script_type = ScriptType(entity.script)
+        scripts[script_type].append(_load_operation(entity.operation))
+        if entity.done:
+            done.add((script_type, entity.index))
+    temp_paths = {}
+    real_id = {}
+    for entity in session.query(JournalIdEntity):
+        temp_paths[entity.id] = entity.path
+        if entity.real_id is not None:
+            real_id[entity.id] = entity.real_id
+    return scripts, done, temp_paths, real_id
+
+
+def checkpoint_journal(session: Session.class_, script_type: ScriptType, index: int, real_id: Mapping[str, str]):
+    """Mark an operation as applied, together with the real identifiers it assigned"""
+    session.query(JournalEntity).filter_by(script=script_type.value, index=index).update({'done': True})
+    for temp_id, identifier in real_id.items():
+        session.query(JournalIdEntity).filter_by(id=temp_id).update({'real_id': identifier})
+
+
+def clear_journal(session: Session.class_):
+    session.query(JournalEntity).delete()
+    session.query(JournalIdEntity).delete()
+    session.query(FileEntity).filter_by(tree=TreeType.PLANNED.value).delete()
+    session.query(DirEntity).filter_by(tree=TreeType.PLANNED.value).delete()
+    session.query(DigestEntity).filter_by(tree=TreeType.PLANNED.value).delete()
+    session.query(UploadSessionEntity).delete()
+
+
+def save_upload_session(session: Session.class_, path: str, parent_id: str, name: str, url: str,
+                        stat: os.stat_result, offset: int):
+    """Record an upload in progress, together with the version of the file being uploaded"""
+    session.merge(UploadSessionEntity(
+        path=path, parent_id=parent_id, name=name, url=url, device=stat.st_dev, inode=stat.st_ino,
+        size=stat.st_size, st_mtime_ns=stat.st_mtime_ns, offset=offset
+    ))
+
+
+def load_upload_session(session: Session.class_, path: str, parent_id: str, name: str,
+                        stat: os.stat_result) -> Optional[Tuple[str, int]]:
+    """Find an interrupted upload of the same version of the file to the same destination
+
+    :return: The URL of the upload session and the number of bytes confirmed, if any
+    """
+    entity = session.query(UploadSessionEntity).get(path)
+    if entity is None:
+        return None
+    if (entity.parent_id, entity.name, entity.device, entity.inode, entity.size, entity.st_mtime_ns) != (
+            parent_id, name, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+    ):
+        session.delete(entity)
+        return None
+    return entity.url, entity.offset
+
+
+def remove_upload_session(session: Session.class_, path: str):
+    session.query(UploadSessionEntity).filter_by(path=path).delete()
+
+
+def save_partial_download(session: Session.class_, identifier: str, cTag: str, size: int,
+                          ranges: Iterable[Tuple[int, int]]):
+    """Record the ranges of bytes written for a download in progress of the version @cTag of a file"""
+    session.merge(PartialDownloadEntity(id=identifier, cTag=cTag, size=size, ranges=json.dumps(list(ranges))))
+
+
+def load_partial_download(session: Session.class_, identifier: str,
+                          cTag: str) -> Optional[Tuple[int, List[Tuple[int, int]]]]:
+    """Find an interrupted download of the same version of a file
+
+    :return: The size of the file and the ranges of bytes written, if any
+    """
+    entity = session.query(PartialDownloadEntity).get(identifier)
+    if entity is None:
+        return None
+    if entity.cTag != cTag:
+        session.delete(entity)
+        return None
+    return entity.size, [(begin, end) for begin, end in json.loads(entity.ranges)]
+
+
+def remove_partial_downloads(session: Session.class_, identifier: str = None):
+    query = session.query(PartialDownloadEntity)
+    if identifier is not None:
+        query = query.filter_by(id=identifier)
+    query.delete()
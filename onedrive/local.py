@@ -18,12 +18,22 @@ from pathlib import Path
 from typing import Iterator, Tuple, Set, MutableMapping, Mapping
 
 from . import _compare_size
+from .algorithms import hash_file, normalize_hash, HashCache
 from .database import CONFIG
 from .model import AddFile, AddDir, CloudFile, AddCloudFile
 from .model import Tree, Directory, Operation, RenameMoveFile, RenameMoveDir, LocalFile
 from .platform import load_id_from_metadata
 
 
+# A directory inside the local root for intermediate files, which is never synchronized
+STAGING_DIR_NAME = '.onedrive-staging'
+
+
+def is_temp_id(identifier: str) -> bool:
+    # Temporary identifiers never collide with real ones as they begin with a null character
+    return identifier is not None and identifier.startswith('\0')
+
+
 def _parse_local_tree(path) -> Tuple[
     Tree,
     MutableMapping[str, str],
@@ -44,6 +54,8 @@ def _parse_local_tree(path) -> Tuple[
 
     def _append_children(parent_id: str, counter: Iterator[str], parent_path: Path):
         for child in parent_path.iterdir():
+            if parent_id == tree.root_id and child.name == STAGING_DIR_NAME:
+                continue
             # Because of duplicated or missing extended attributes, a temporary identifier is applied to every item
             temp_id = next(counter)
 
@@ -56,16 +68,93 @@ def _parse_local_tree(path) -> Tuple[
             if child.is_dir():
                 tree.dirs[temp_id] = Directory(temp_id, child.name, parent_id)
                 tree.dirs[parent_id].dirs.add(temp_id)
+                tree.dirs[parent_id].names[child.name] = temp_id
                 _append_children(temp_id, counter, child)
             elif child.is_file():
                 stat = child.stat()
-                tree.files[temp_id] = LocalFile(temp_id, child.name, parent_id, stat.st_size, stat.st_mtime_ns)
+                tree.files[temp_id] = LocalFile(
+                    temp_id, child.name, parent_id, stat.st_size, stat.st_mtime_ns, stat.st_dev, stat.st_ino
+                )
                 tree.dirs[parent_id].files.add(temp_id)
+                tree.dirs[parent_id].names[child.name] = temp_id
 
     _append_children(tree.root_id, _counter(), path)
     return tree, counter_to_id, id_to_counter, counter_to_path
 
 
+def _match_vanished_files(
+        local_tree: Tree,
+        counter_to_id: MutableMapping[str, str],
+        counter_to_path: Mapping[str, Path],
+        cloud_tree: Tree,
+        saved_tree: Tree,
+        sizes: Mapping[str, int],
+        cache: HashCache = None
+) -> None:
+    """Identify new files as files vanished from the same directories since the last synchronization
+
+    Editors saving by replacing files drop the extended attributes, which would turn a modification into a deletion
+    and a creation. A new file is paired with a vanished one of the same name, or else of the same size and content.
+    Files added in the cloud since then have never been downloaded, so they are never paired, otherwise two different
+    new files of the same name would become the same addition on both sides and one of them would be lost.
+
+    :param counter_to_id: Mapping from temporary identifiers to real ones, where the matched files are added to
+    :param cloud_tree: The cloud tree providing hashes of the candidates, which must still exist in the cloud
+    :param saved_tree: The tree at the last synchronization, where the candidates were
+    :param sizes: Sizes of files reported by the cloud, see sdk.retrieve_delta, which rule out candidates before any
+        file is read. Sizes of files in trees are unreliable, see _compare_size, so files are compared by the sizes on
+        disk, while candidates of unknown sizes are only ruled out by their hashes
+    """
+    claimed = set(counter_to_id.values())
+    by_name = {}
+    by_parent = defaultdict(list)
+    for file_id, file in saved_tree.files.items():
+        if file_id not in claimed and file_id in cloud_tree.files:
+            by_name[file.parent, file.name] = file_id
+            by_parent[file.parent].append(file_id)
+    if not by_name:
+        return
+
+    new_files = [file_id for file_id in local_tree.files if file_id not in counter_to_id]
+    unmatched = []
+    for temp_id in new_files:
+        file = local_tree.files[temp_id]
+        file_id = by_name.get((counter_to_id.get(file.parent, file.parent), file.name))
+        if file_id is not None and file_id not in claimed:
+            counter_to_id[temp_id] = file_id
+            claimed.add(file_id)
+        else:
+            unmatched.append(temp_id)
+
+    for temp_id in unmatched:
+        file = local_tree.files[temp_id]
+        candidates = [
+            cloud_tree.files[file_id] for file_id in by_parent.get(counter_to_id.get(file.parent, file.parent), ())
+            if file_id not in claimed and cloud_tree.files[file_id].hashes
+        ]
+        if not candidates:
+            continue
+        try:
+            size = counter_to_path[temp_id].stat().st_size
+        except OSError:
+            continue
+        candidates = [candidate for candidate in candidates if sizes.get(candidate.id, size) == size]
+        if not candidates:
+            continue
+        # Each new file is read only once, for all the algorithms the candidates provide
+        actual = hash_file(counter_to_path[temp_id], {
+            algorithm for candidate in candidates for algorithm in candidate.hashes
+        }, cache=cache)
+        for candidate in candidates:
+            common = candidate.hashes.keys() & actual.keys()
+            if common and all(
+                    actual[algorithm] == normalize_hash(algorithm, candidate.hashes[algorithm]) for algorithm in common
+            ):
+                counter_to_id[temp_id] = candidate.id
+                claimed.add(candidate.id)
+                break
+
+
 def _normalize_local_tree(
         local_tree: Tree,
         counter_to_id: MutableMapping[str, str],
@@ -123,7 +212,7 @@ def _normalize_local_tree(
         identifier = counter_to_id.get(file_id, file_id)
         tree.files[identifier] = LocalFile(identifier, file.name, counter_to_id.get(
             file.parent, file.parent
-        ), file.size, file.st_mtime_ns)
+        ), file.size, file.st_mtime_ns, file.st_dev, file.st_ino)
     for dir_id, directory in local_tree.dirs.items():
         if dir_id == tree.root_id:
             continue
@@ -141,9 +230,11 @@ def _normalize_local_tree(
     return tree, id_to_path
 
 
-def get_local_tree(path, cloud_tree: Tree) -> Tuple[Tree, MutableMapping[str, Path]]:
+def get_local_tree(path, cloud_tree: Tree, saved_tree: Tree, sizes: Mapping[str, int],
+                   cache: HashCache = None) -> Tuple[Tree, MutableMapping[str, Path]]:
     path = Path(path)
     tree, counter_to_id, id_to_counter, counter_to_path = _parse_local_tree(path)
+    _match_vanished_files(tree, counter_to_id, counter_to_path, cloud_tree, saved_tree, sizes, cache)
     tree, id_to_path = _normalize_local_tree(tree, counter_to_id, id_to_counter, counter_to_path, cloud_tree)
     id_to_path[CONFIG.root_id] = path
     return tree, id_to_path
@@ -13,13 +13,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
+from collections import defaultdict
 from functools import singledispatch
-from typing import Dict, Set
+from typing import AbstractSet, Dict, Mapping, Optional, Set, Tuple
 
 import attr
 
-from . import _compare_size
-
 
 @attr.s(slots=True)
 class Node:
@@ -44,12 +44,26 @@ class CloudFile(File):
 @attr.s(slots=True)
 class LocalFile(File):
     st_mtime_ns = attr.ib(type=int, default=0)
+    st_dev = attr.ib(type=int, default=0)
+    st_ino = attr.ib(type=int, default=0)
 
 
 @attr.s(slots=True)
 class Directory(Node):
     files = attr.ib(type=Set[str], factory=set)
     dirs = attr.ib(type=Set[str], factory=set)
+    # Index of the names of all children, maintained along with files and dirs
+    names = attr.ib(type=Dict[str, str], factory=dict)
+
+
+# Digests fit in the signed integers of SQLite, so that they can be saved along with the trees
+_DIGEST_MASK = (1 << 63) - 1
+
+
+def _node_digest(*fields: Optional[str]) -> int:
+    # Unlike hash(), this is the same in every process
+    data = '\0'.join(field if field is not None else '' for field in fields).encode('utf-8', 'surrogatepass')
+    return int.from_bytes(hashlib.sha1(data).digest()[:8], 'little')
 
 
 class Tree:
@@ -59,6 +73,8 @@ class Tree:
         self._root_id = root_id
         self._dirs = {root_id: Directory(root_id)}
         self._files = {}
+        # Cached subtree digests, if a directory is cached then all its descendants are cached as well
+        self._digests = {}
 
     @property
     def root_id(self) -> str:
@@ -72,73 +88,120 @@ class Tree:
     def files(self) -> Dict[str, File]:
         return self._files
 
+    def writable_file(self, file_id: str) -> File:
+        """The file to be modified in place, use this instead of files[file_id] before modifying its attributes"""
+        return self.files[file_id]
+
+    def writable_dir(self, dir_id: str) -> Directory:
+        """The directory to be modified in place, use this instead of dirs[dir_id] before modifying it"""
+        return self.dirs[dir_id]
+
     def reconstruct_by_parents(self) -> None:
-        orphan_files = set()
-        orphan_dirs = set()
-
-        while True:
-            count = False
-            for key, value in self.files.items():
-                if key in orphan_files:
-                    continue
-                if value.parent not in self.dirs or value.parent in orphan_dirs:
-                    orphan_files.add(key)
-                    count = True
-            for key, value in self.dirs.items():
-                if key in orphan_dirs or key == self.root_id:
-                    continue
-                if value.parent not in self.dirs or value.parent in orphan_dirs:
-                    orphan_dirs.add(key)
-                    count = True
-            if not count:
-                break
-
-        for orphan in orphan_files:
-            del self.files[orphan]
-        for orphan in orphan_dirs:
-            del self.dirs[orphan]
+        self._digests.clear()
 
-        for directory in self.dirs.values():
-            directory.dirs.clear()
-            directory.files.clear()
+        # Index the children of every directory once, then walk from the root,
+        # anything not reachable (including cycles) is an orphan
+        children_files = defaultdict(set)
+        children_dirs = defaultdict(set)
         for key, value in self.files.items():
-            self.dirs[value.parent].files.add(key)
+            children_files[value.parent].add(key)
         for key, value in self.dirs.items():
             if key == self.root_id:
                 continue
-            self.dirs[value.parent].dirs.add(key)
+            children_dirs[value.parent].add(key)
+
+        reachable = set()
+        stack = [self.root_id]
+        while stack:
+            identifier = stack.pop()
+            reachable.add(identifier)
+            directory = self.dirs[identifier]
+            directory.files = children_files.pop(identifier, set())
+            directory.dirs = children_dirs.pop(identifier, set())
+            directory.names = {self.files[child].name: child for child in directory.files}
+            directory.names.update((self.dirs[child].name, child) for child in directory.dirs)
+            stack.extend(directory.dirs)
+
+        for orphans in children_files.values():
+            for orphan in orphans:
+                del self.files[orphan]
+        for orphan in self.dirs.keys() - reachable:
+            del self.dirs[orphan]
 
-    def list_names(self, dir_id: str) -> Set[str]:
-        directory = self.dirs[dir_id]
-        files = directory.files
-        dirs = directory.dirs
-        return {self.files[child].name for child in files} | {self.dirs[child].name for child in dirs}
+    def list_names(self, dir_id: str) -> AbstractSet[str]:
+        return self.dirs[dir_id].names.keys()
+
+    def digest(self, dir_id: str) -> Tuple[int, int]:
+        """Digests of the subtree of a directory
+
+        :return: The digest of names and parents in the subtree, and the digest of cTags of files in the subtree
+        """
+        if dir_id in self._digests:
+            return self._digests[dir_id]
+
+        # Children are summed up so that the digest does not depend on the order
+        # Sizes are not included as they are unreliable, see _compare_size, and files without cTags add nothing
+        stack = [(dir_id, False)]
+        while stack:
+            identifier, expanded = stack.pop()
+            directory = self.dirs[identifier]
+            if not expanded:
+                stack.append((identifier, True))
+                stack.extend((child, False) for child in directory.dirs if child not in self._digests)
+                continue
+            structure = _node_digest('d', identifier, directory.name, directory.parent)
+            content = 0
+            for child in directory.files:
+                file = self.files[child]
+                structure += _node_digest('f', child, file.name, file.parent)
+                c_tag = getattr(file, 'cTag', None)
+                if c_tag is not None:
+                    content += _node_digest(child, c_tag)
+            for child in directory.dirs:
+                child_structure, child_content = self._digests[child]
+                structure += child_structure
+                content += child_content
+            self._digests[identifier] = structure & _DIGEST_MASK, content & _DIGEST_MASK
+        return self._digests[dir_id]
+
+    def invalidate_digest(self, dir_id: str) -> None:
+        # Must be called before the directory is detached from its parent
+        while dir_id in self._digests:
+            del self._digests[dir_id]
+            dir_id = self.dirs[dir_id].parent
+
+    def cached_digests(self) -> Dict[str, Tuple[int, int]]:
+        """Digests computed so far, which are still valid for the tree"""
+        return dict(self._digests)
+
+    def all_digests(self) -> Dict[str, Tuple[int, int]]:
+        """Digests of all directories, to be saved along with the tree"""
+        self.digest(self.root_id)
+        return self.cached_digests()
+
+    def restore_digests(self, digests: Mapping[str, Tuple[int, int]]) -> None:
+        """Cache digests computed for the same nodes, such as the ones saved along with the tree
+
+        A digest is only taken together with the ones of all subdirectories, so that invalidating any directory still
+        reaches its ancestors. Directories changed since @digests were computed must be left out or invalidated.
+        """
+        stack = [(self.root_id, False)]
+        while stack:
+            identifier, expanded = stack.pop()
+            directory = self.dirs[identifier]
+            if not expanded:
+                stack.append((identifier, True))
+                stack.extend((child, False) for child in directory.dirs)
+                continue
+            if identifier in digests and all(child in self._digests for child in directory.dirs):
+                self._digests[identifier] = digests[identifier]
 
     def equals(self, other) -> bool:
         if not isinstance(other, Tree):
             return False
         if self.root_id != other.root_id:
             return False
-
-        if self.files.keys() != other.files.keys():
-            return False
-        for identifier in self.files.keys() & other.files.keys():
-            if self.files[identifier].name != other.files[identifier].name:
-                return False
-            if self.files[identifier].parent != other.files[identifier].parent:
-                return False
-            if not _compare_size(self.files[identifier].size, other.files[identifier].size):
-                return False
-
-        if self.dirs.keys() != other.dirs.keys():
-            return False
-        for identifier in self.dirs.keys() & other.dirs.keys():
-            if self.dirs[identifier].name != other.dirs[identifier].name:
-                return False
-            if self.dirs[identifier].parent != other.dirs[identifier].parent:
-                return False
-
-        return True
+        return self.digest(self.root_id)[0] == other.digest(other.root_id)[0]
 
 
 # Logically this class is immutable, but frozen=True is inefficient for slots=True, so hash=True is necessary
@@ -255,6 +318,17 @@ class RenameMoveDir(Operation):
         )
 
 
+def _release_name(directory: Directory, name: str, identifier: str) -> None:
+    # Only release the name if it is really occupied by this child
+    if directory.names.get(name) == identifier:
+        del directory.names[name]
+
+
+OPERATION_TYPES = {operation_type.__name__: operation_type for operation_type in [
+    AddFile, AddCloudFile, DelFile, ModifyFile, ModifyCloudFile, RenameMoveFile, AddDir, DelDir, RenameMoveDir
+]}
+
+
 @singledispatch
 def basic_operation(args: Operation, tree: Tree) -> Node:
     raise NotImplementedError()
@@ -267,22 +341,28 @@ def _(args: AddFile, tree: Tree) -> File:
     else:
         child = File(args.child_id, args.name, args.parent_id, args.size)
     tree.files[args.child_id] = child
-    tree.dirs[args.parent_id].files.add(args.child_id)
+    tree.invalidate_digest(args.parent_id)
+    parent = tree.writable_dir(args.parent_id)
+    parent.files.add(args.child_id)
+    parent.names[args.name] = args.child_id
     return child
 
 
 @basic_operation.register(DelFile)
 def _(args: DelFile, tree: Tree) -> File:
     child = tree.files[args.id]
-    parent = tree.dirs[child.parent]
+    tree.invalidate_digest(child.parent)
+    parent = tree.writable_dir(child.parent)
     parent.files.remove(args.id)
+    _release_name(parent, child.name, args.id)
     del tree.files[args.id]
     return child
 
 
 @basic_operation.register(ModifyFile)
 def _(args: ModifyFile, tree: Tree) -> File:
-    file = tree.files[args.id]
+    file = tree.writable_file(args.id)
+    tree.invalidate_digest(file.parent)
     file.size = args.size
     if isinstance(args, ModifyCloudFile) and isinstance(file, CloudFile):
         file.eTag = args.eTag
@@ -292,15 +372,19 @@ def _(args: ModifyFile, tree: Tree) -> File:
 
 @basic_operation.register(RenameMoveFile)
 def _(args: RenameMoveFile, tree: Tree) -> File:
-    child = tree.files[args.id]
+    child = tree.writable_file(args.id)
+    tree.invalidate_digest(child.parent)
+    source = tree.writable_dir(child.parent)
+    _release_name(source, child.name, args.id)
     if args.name is not None:
         child.name = args.name
     if args.destination_id is not None:
-        source = tree.dirs[child.parent]
-        destination = tree.dirs[args.destination_id]
+        destination = tree.writable_dir(args.destination_id)
         child.parent = args.destination_id
         source.files.remove(args.id)
         destination.files.add(args.id)
+        tree.invalidate_digest(args.destination_id)
+    tree.writable_dir(child.parent).names[child.name] = args.id
     return child
 
 
@@ -308,15 +392,20 @@ def _(args: RenameMoveFile, tree: Tree) -> File:
 def _(args: AddDir, tree: Tree) -> Directory:
     child = Directory(args.child_id, args.name, args.parent_id)
     tree.dirs[args.child_id] = child
-    tree.dirs[args.parent_id].dirs.add(args.child_id)
+    tree.invalidate_digest(args.parent_id)
+    parent = tree.writable_dir(args.parent_id)
+    parent.dirs.add(args.child_id)
+    parent.names[args.name] = args.child_id
     return child
 
 
 @basic_operation.register(DelDir)
 def _(args: DelDir, tree: Tree) -> Directory:
     child = tree.dirs[args.id]
-    parent = tree.dirs[child.parent]
+    tree.invalidate_digest(args.id)
+    parent = tree.writable_dir(child.parent)
     parent.dirs.remove(args.id)
+    _release_name(parent, child.name, args.id)
 
     def _del_dir(identifier: str) -> None:
         # Remove the directory from the index of the tree, recursively
@@ -327,6 +416,7 @@ def _(args: DelDir, tree: Tree) -> Directory:
             # We do not need to remove the file from the containing directory
             # as we want to preserve the structure of this subtree
             del tree.files[file_id]
+        tree.invalidate_digest(identifier)
         del tree.dirs[identifier]
 
     _del_dir(args.id)
@@ -335,15 +425,19 @@ def _(args: DelDir, tree: Tree) -> Directory:
 
 @basic_operation.register(RenameMoveDir)
 def _(args: RenameMoveDir, tree: Tree) -> Directory:
-    child = tree.dirs[args.id]
+    child = tree.writable_dir(args.id)
+    tree.invalidate_digest(args.id)
+    source = tree.writable_dir(child.parent)
+    _release_name(source, child.name, args.id)
     if args.name is not None:
         child.name = args.name
     if args.destination_id is not None:
-        source = tree.dirs[child.parent]
-        destination = tree.dirs[args.destination_id]
+        destination = tree.writable_dir(args.destination_id)
         child.parent = args.destination_id
         source.dirs.remove(args.id)
         destination.dirs.add(args.id)
+        tree.invalidate_digest(args.destination_id)
+    tree.writable_dir(child.parent).names[child.name] = args.id
     return child
 
 
@@ -0,0 +1,111 @@
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import copy
+from typing import Any, Callable, Iterator, Mapping, MutableMapping
+
+from .model import Tree, File, Directory
+
+
+class _Overlay(MutableMapping[str, Any]):
+    """Changes recorded on top of a mapping which is left untouched"""
+
+    def __init__(self, base: Mapping[str, Any]):
+        self._base = base
+        self._changes = {}
+        self._deleted = set()
+
+    def is_changed(self, key: str) -> bool:
+        return key in self._changes
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._changes:
+            return self._changes[key]
+        if key in self._deleted:
+            raise KeyError(key)
+        return self._base[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._changes[key] = value
+        self._deleted.discard(key)
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self._changes.pop(key, None)
+        if key in self._base:
+            self._deleted.add(key)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._changes or key not in self._deleted and key in self._base
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._changes
+        for key in self._base:
+            if key not in self._changes and key not in self._deleted:
+                yield key
+
+    def __len__(self) -> int:
+        return len(self._base) - len(self._deleted) + sum(1 for key in self._changes if key not in self._base)
+
+
+def _copy_dir(directory: Directory) -> Directory:
+    return Directory(
+        directory.id,
+        directory.name,
+        directory.parent,
+        set(directory.files),
+        set(directory.dirs),
+        dict(directory.names)
+    )
+
+
+class OverlayTree(Tree):
+    """A copy-on-write view of a tree
+
+    Nodes are copied from the base tree only when they are to be modified through writable_file() or writable_dir(),
+    so the cost of applying a script is proportional to the script rather than the tree. The base tree must not be
+    modified while the overlay is in use.
+    """
+
+    def __init__(self, base: Tree):
+        # The constructor of Tree is not called as nothing should be allocated for the whole tree
+        self._root_id = base.root_id
+        self._files = _Overlay(base.files)
+        self._dirs = _Overlay(base.dirs)
+        self._digests = _Overlay(base._digests)
+
+    @property
+    def files(self) -> MutableMapping[str, File]:
+        return self._files
+
+    @property
+    def dirs(self) -> MutableMapping[str, Directory]:
+        return self._dirs
+
+    def _writable(self, nodes: _Overlay, identifier: str, copier: Callable[[Any], Any]) -> Any:
+        if not nodes.is_changed(identifier):
+            nodes[identifier] = copier(nodes[identifier])
+        return nodes[identifier]
+
+    def writable_file(self, file_id: str) -> File:
+        return self._writable(self._files, file_id, copy.copy)
+
+    def writable_dir(self, dir_id: str) -> Directory:
+        return self._writable(self._dirs, dir_id, _copy_dir)
+
+    def reconstruct_by_parents(self) -> None:
+        raise NotImplementedError('Overlay trees are only modified by basic operations')
@@ -15,11 +15,14 @@
 
 import os
 import errno
+import shutil
 import sys
 from pathlib import Path
 from typing import Optional
 
 if sys.platform == 'linux':
+    import fcntl
+
     if 'ONEDRIVE_CONFIG_PATH' in os.environ:
         DATABASE_LOCATION = Path(os.environ['ONEDRIVE_CONFIG_PATH'])
     else:
@@ -42,6 +45,38 @@ if sys.platform == 'linux':
                 raise
             else:
                 return None
+
+
+    # FICLONE from linux/fs.h
+    _FICLONE = 0x40049409
+    _UNSUPPORTED = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP, errno.EBADF}
+
+
+    def clone_file(source, destination):
+        """Copy the content of a file
+
+        A reflink is tried first, which shares the data on copy-on-write filesystems, then copy_file_range, which
+        copies inside the kernel, and finally an ordinary copy
+        """
+        with open(str(source), 'rb') as source_file, open(str(destination), 'wb') as destination_file:
+            try:
+                fcntl.ioctl(destination_file.fileno(), _FICLONE, source_file.fileno())
+                return
+            except OSError as error:
+                if error.errno not in _UNSUPPORTED:
+                    raise
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    while os.copy_file_range(source_file.fileno(), destination_file.fileno(), 1 << 30):
+                        pass
+                    return
+                except OSError as error:
+                    if error.errno not in _UNSUPPORTED:
+                        raise
+                    source_file.seek(0)
+                    destination_file.seek(0)
+                    destination_file.truncate()
+            shutil.copyfileobj(source_file, destination_file, 1024 * 1024)
 else:
     DATABASE_LOCATION = Path(os.environ.get('LOCALAPPDATA', Path.home() / 'AppData' / 'Local')) / 'onedrive.sqlite'
     raise Exception('Operating system currently unsupported ' + sys.platform)
@@ -13,53 +13,67 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+
 # According to https://docs.microsoft.com/en-us/onedrive/developer/code-snippets/quickxorhash
-# But these functions have different results from https://github.com/skilion/onedrive/blob/v1.1.1/src/qxor.d#L81
-# Don't know why
+# Byte k of the content is rotated left by 11 * k bits inside a 160-bit circular register and XOR-ed into it, then the
+# length of the content is XOR-ed into the last 8 bytes of the little-endian register
+
+import base64
+
+WIDTH_IN_BITS = 160
+SHIFT = 11
+_MASK = (1 << WIDTH_IN_BITS) - 1
+# Bytes 160 positions apart are rotated by the same number of bits
+_PERIOD = WIDTH_IN_BITS
+
 
-from typing import BinaryIO
+def _fold(data: memoryview) -> bytes:
+    """XOR all 160-byte blocks of @data together, the length of @data must be a multiple of 160
 
+    The content is converted into one big integer and folded in halves, so that the work is done inside C loops
+    """
+    blocks = len(data) // _PERIOD
+    value = int.from_bytes(data, 'little')
+    while blocks > 1:
+        half = (blocks + 1) // 2
+        bits = half * _PERIOD * 8
+        value = (value >> bits) ^ (value & ((1 << bits) - 1))
+        blocks = half
+    return value.to_bytes(_PERIOD, 'little')
 
-def XorHash(stream: BinaryIO) -> bytearray:
-    result = bytearray(20)
-    count = 0
-    while True:
-        byte = stream.read(1)
-        if byte is None:
-            raise NotImplementedError('Asynchronous operation not supported')
-        elif not len(byte):
-            count += 1
-            break
-        byte = byte[0]
 
-        location = count * 11 % (20 * 8)
-        higher = byte >> (8 - location % 8)
-        lower = (byte << (location % 8)) & 0xff
-        result[location // 8] ^= lower
-        result[(location // 8 + 1) % 20] ^= higher
+class QuickXorHash:
+    def __init__(self):
+        self._register = 0
+        self._length = 0
 
-        count += 1
-    result.reverse()
-    result[:8] = (count ^ int.from_bytes(result[:8], 'little')).to_bytes(8, 'little')
-    return result
+    def update(self, data) -> None:
+        data = memoryview(data).cast('B')
+        length = self._length
+        # Align to the period first, then fold whole periods, and the remaining bytes are XOR-ed one by one
+        head = min(-length % _PERIOD, len(data))
+        body = (len(data) - head) // _PERIOD * _PERIOD
+        self._xor(data[:head], length)
+        if body:
+            self._xor(_fold(data[head:head + body]), length + head)
+        self._xor(data[head + body:], length + head + body)
+        self._length = length + len(data)
 
+    def _xor(self, data, position: int) -> None:
+        register = self._register
+        offset = position * SHIFT % WIDTH_IN_BITS
+        for byte in bytes(data):
+            if byte:
+                register ^= ((byte << offset) | (byte >> (WIDTH_IN_BITS - offset))) & _MASK
+            offset = (offset + SHIFT) % WIDTH_IN_BITS
+        self._register = register
 
-def XorHash(stream: BinaryIO) -> bytearray:
-    result = 0
-    count = 0
-    while True:
-        byte = stream.read(1)
-        if byte is None:
-            raise NotImplementedError('Asynchronous operation not supported')
-        elif not len(byte):
-            count += 1
-            break
-        byte = byte[0]
-        byte <<= ((count * 11) % (20 * 8))
-        byte = (byte % (1 << (20 * 8))) | (byte // (1 << (20 * 8)))
-        result ^= byte
+    def digest(self) -> bytes:
+        result = bytearray(self._register.to_bytes(WIDTH_IN_BITS // 8, 'little'))
+        for index, byte in enumerate(self._length.to_bytes(8, 'little')):
+            result[WIDTH_IN_BITS // 8 - 8 + index] ^= byte
+        return bytes(result)
 
-        count += 1
-    result = bytearray(reversed(result.to_bytes(20, 'little')))
-    result[:8] = (count ^ int.from_bytes(result[:8], 'little')).to_bytes(8, 'little')
-    return result
+    def b64digest(self) -> str:
+        # The format used by OneDrive
+        return base64.b64encode(self.digest()).decode()
@@ -13,42 +13,285 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import base64
+import logging
+import mmap
 import os
+import threading
+import time
 from collections import OrderedDict
-from typing import Callable, Dict, BinaryIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, BinaryIO, Generator, Iterable, Iterator, List, Optional, Sequence, Tuple
+from typing import Union
+from urllib.parse import quote, unquote, urlparse
 
 import requests
 from oauthlib.oauth2 import WebApplicationClient
 from requests import Session, HTTPError, RequestException
+from requests.adapters import BaseAdapter
 from requests_oauthlib import OAuth2Session
 
 from . import _compare_size
-from .algorithms import HASH_ENGINES
-from .database import CONFIG, TreeType, load_tree, session_scope, save_tree, ConfigEntity
+from .algorithms import HASH_ENGINES, normalize_hash
+from .database import CONFIG, TreeType, load_tree, session_scope, save_tree, ConfigEntity, create_tree
 from .model import Tree, CloudFile, Directory
+from .transfer import ChunkSizer, Backoff, RequestGovernor, parse_ranges, parse_retry_after, missing_ranges
+from .transfer import BandwidthLimiter, UPLOAD_CHUNK_UNIT
+from .transport import create_transport
 
 os.environ['OAUTHLIB_RELAX_TOKEN_SCOPE'] = '1'
 MSGRAPH_ENDPOINT = 'https://graph.microsoft.com/v1.0'
 CLIENT_ID = '14a374a6-851d-43cc-9da1-7c91fbd02b24'
 
 
-class BatchClient:
+# The maximum number of requests in a JSON batch
+BATCH_LIMIT = 20
+# Files are downloaded in parts of this size, through this many connections concurrently
+DOWNLOAD_PART = 8 * 1024 * 1024
+DOWNLOAD_CONNECTIONS = 4
+# Files no larger than this are uploaded with a single request instead of an upload session
+SIMPLE_UPLOAD_LIMIT = 4 * 1024 * 1024
+# Files no larger than this are uploaded in batches, a full batch of them encoded in Base64 is still below the limit
+# of 4 MB for a request
+BATCH_UPLOAD_LIMIT = 128 * 1024
+# The maximum number of files transferred concurrently
+TRANSFER_WORKERS = 4
+# Every request is admitted by this governor, see RequestGovernor, at most this many per second with bursts of this
+# many, and this many concurrently at first
+REQUEST_RATE = 20
+REQUEST_BURST = 40
+REQUEST_CONCURRENCY = 8
+GOVERNOR = RequestGovernor(REQUEST_RATE, REQUEST_BURST, REQUEST_CONCURRENCY)
+# Content of files is transferred within the bandwidth of these limiters, which are unlimited unless scheduled
+UPLOAD_BANDWIDTH = BandwidthLimiter()
+DOWNLOAD_BANDWIDTH = BandwidthLimiter()
+
+
+class BatchError(Exception):
+    """Some requests in a batch failed
+
+    :ivar failures: The tags of the failed requests given when queueing, with the statuses and bodies of the responses
     """
-    This client may be difficult to implement because
-    operations are relative to other ones and identifiers
-    may need to be translated
+
+    def __init__(self, failures: List[Tuple[Any, int, Any]]):
+        super().__init__('\n'.join(
+            str(tag) + ': ' + str(status) + ' ' + str(body) for tag, status, body in failures
+        ))
+        self.failures = failures
+
+
+class BatchClient:
+    """Send requests in JSON batches
+
+    Requests are queued and sent once the batch is full or flush() is called. Identifiers assigned by queued requests
+    are unknown until then, so requests using them can only be queued after flushing. A request depends on the
+    earlier ones in the same batch sharing any of its resources, usually the identifiers of the affected items, so
+    that their order is kept. Microsoft Graph only accepts batches either applied in any order or applied serially,
+    so a batch is sent serially if any of its requests depends on another one.
     """
 
-    def __init__(self, session: Session):
+    def __init__(self, session: Session, limit: int = BATCH_LIMIT):
         self._session = session
+        self._limit = limit
         self.queue = []
 
     @property
     def session(self) -> Session:
         return self._session
 
+    def request(self, method: str, url: str, body: Union[Dict, bytes] = None, *, resources: Iterable[str] = (),
+                tag: Any = None, callback: Callable[[Dict], None] = None):
+        """Queue a request
+
+        :param url: Relative to MSGRAPH_ENDPOINT
+        :param body: A JSON object, or the content of a file which is encoded in Base64
+        :param tag: Identifies the request in BatchError
+        :param callback: Called with the body of the response once succeeded
+        """
+        if len(self.queue) >= self._limit:
+            self.flush()
+        resources = set(resources)
+        request = {
+            'id': str(len(self.queue)),
+            'method': method,
+            'url': url
+        }
+        if isinstance(body, bytes):
+            UPLOAD_BANDWIDTH.consume(len(body))
+            request['body'] = base64.b64encode(body).decode()
+            request['headers'] = {'Content-Type': 'application/octet-stream'}
+        elif body is not None:
+            request['body'] = body
+            request['headers'] = {'Content-Type': 'application/json'}
+        depends_on = {queued[0]['id'] for queued in self.queue if queued[1] & resources}
+        self.queue.append((request, resources, depends_on, tag, callback))
+
     def flush(self):
-        pass
+        """Send all queued requests, and raise BatchError after all succeeded ones are called back
+
+        Requests throttled inside the batch are sent again after Retry-After or with exponential backoff, together
+        with the ones depending on them. In a serial batch, requests after a failed one fail with 424 Failed
+        Dependency even if they do not depend on it, and these are sent again at once.
+        """
+        queue, self.queue = self.queue, []
+        backoff = Backoff()
+        failures = []
+        while queue:
+            pending = {request['id'] for request, _, _, _, _ in queue}
+            serial = any(depends_on & pending for _, _, depends_on, _, _ in queue)
+            batch = []
+            for request, _, _, _, _ in queue:
+                request = dict(request)
+                if serial and batch:
+                    request['dependsOn'] = [batch[-1]['id']]
+                batch.append(request)
+            response = self._session.post(MSGRAPH_ENDPOINT + '/$batch', json={'requests': batch})
+            response.raise_for_status()
+            responses = {item['id']: item for item in response.json()['responses']}
+
+            retried = []
+            retried_ids = set()
+            throttled = False
+            retry_after = None
+            for queued in queue:
+                request, _, depends_on, tag, callback = queued
+                item = responses[request['id']]
+                # Dependencies not sent again have succeeded before
+                failed = {identifier for identifier in depends_on & pending
+                          if not 200 <= responses[identifier]['status'] < 300}
+                if 200 <= item['status'] < 300:
+                    if callback is not None:
+                        callback(item.get('body', None) or {})
+                    continue
+                failure = (tag, item['status'], item.get('body', None))
+                if item['status'] in (429, 503):
+                    throttled = True
+                    after = parse_retry_after((item.get('headers', None) or {}).get('Retry-After', None))
+                    if after is not None:
+                        retry_after = max(retry_after or 0, after)
+                elif item['status'] != 424 or not failed <= retried_ids:
+                    failures.append(failure)
+                    continue
+                retried.append((queued, failure))
+                retried_ids.add(request['id'])
+            queue = [queued for queued, _ in retried]
+            if queue and throttled:
+                begin = time.monotonic()
+                try:
+                    backoff.wait(BatchError([failure for _, failure in retried]), retry_after)
+                except BatchError as error:
+                    failures.extend(error.failures)
+                    break
+                GOVERNOR.record(time.monotonic() - begin)
+        if failures:
+            raise BatchError(failures)
+
+    def create_dir(self, parent_id: str, name: str, **kwargs):
+        self.request('POST', '/me/drive/items/' + parent_id + '/children', {
+            'name': name,
+            'folder': {}
+        }, **kwargs)
+
+    def remove_item(self, identifier: str, **kwargs):
+        self.request('DELETE', '/me/drive/items/' + identifier, **kwargs)
+
+    def upload_file_by_parent(self, parent_id: str, name: str, content: bytes, **kwargs):
+        self.request('PUT', '/me/drive/items/' + parent_id + ':/' + quote(name) + ':/content', content, **kwargs)
+
+    def upload_file_by_id(self, identifier: str, content: bytes, **kwargs):
+        self.request('PUT', '/me/drive/items/' + identifier + '/content', content, **kwargs)
+
+    def move_rename_item(self, identifier: str, *, destination_id: str = None, name: str = None, **kwargs):
+        request = {}
+        if name is not None:
+            request['name'] = name
+        if destination_id is not None:
+            request['parentReference'] = {
+                'id': destination_id
+            }
+        self.request('PATCH', '/me/drive/items/' + identifier, request, **kwargs)
+
+
+class GovernedAdapter(BaseAdapter):
+    """Send requests through the governor and the transport, retrying the throttled ones
+
+    Responses of 429 and 503 are retried after Retry-After or with exponential backoff, until the attempts run out and
+    the last one is returned. The seconds each request waited, in admission and retries, are in the throttled_time
+    attribute of its response. The governor is only held until the headers arrive, so that streamed bodies of
+    transfers are not limited by it.
+
+    :param transport: Sends the requests, the configured one is created with the remaining arguments if not given,
+        see create_transport
+    """
+
+    def __init__(self, governor: RequestGovernor = None, attempts: int = 8, transport: BaseAdapter = None, **kwargs):
+        super().__init__()
+        self._governor = GOVERNOR if governor is None else governor
+        self._attempts = attempts
+        self._transport = create_transport(**kwargs) if transport is None else transport
+
+    def close(self):
+        self._transport.close()
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        body = request.body
+        # Bodies read from streams can only be sent again if they can be rewound
+        position = body.tell() if hasattr(body, 'seek') else None
+        rewindable = body is None or isinstance(body, (bytes, str, memoryview)) or position is not None
+        backoff = Backoff(attempts=self._attempts)
+        throttled = 0.0
+        while True:
+            admitted, waited = self._governor.acquire()
+            throttled += waited
+            try:
+                response = self._transport.send(request, **kwargs)
+            except Exception:
+                self._governor.release(admitted)
+                raise
+            retry_after = parse_retry_after(response.headers.get('Retry-After', None))
+            self._governor.release(admitted, response.status_code, retry_after)
+            if response.status_code not in (429, 503) or not rewindable:
+                break
+            begin = time.monotonic()
+            try:
+                backoff.wait(HTTPError(response=response), retry_after)
+            except HTTPError:
+                break
+            throttled += time.monotonic() - begin
+            response.close()
+            if position is not None:
+                body.seek(position)
+        response.throttled_time = throttled
+        self._governor.record(throttled)
+        return response
+
+
+def governed_session(connections: int = 1) -> Session:
+    """A session without credentials for pre-authenticated URLs, keeping at most @connections connections alive"""
+    session = requests.Session()
+    adapter = GovernedAdapter(pool_connections=1, pool_maxsize=connections)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class SharedOAuth2Session(OAuth2Session):
+    """An OAuth2Session shared by threads, which refreshes an expired token only once
+
+    Refresh tokens can only be used once, so that the threads finding the same token expired would fail except the
+    first one. The others wait for it and use the token refreshed by it instead.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._refresh_lock = threading.Lock()
+
+    def refresh_token(self, token_url: str, **kwargs) -> Dict:
+        with self._refresh_lock:
+            if self.token.get('expires_at', 0) > time.time():
+                return self.token
+            return super().refresh_token(token_url, **kwargs)
 
 
 def get_session(token: Dict = None, token_updater: Callable[[str], None] = None) -> OAuth2Session:
@@ -56,7 +299,7 @@ def get_session(token: Dict = None, token_updater: Callable[[str], None] = None)
     client = WebApplicationClient(CLIENT_ID)
     # The protocol of the redirect uri is changed back to https for easy capturing
     # If possible, change the uri to urn:ietf:wg:oauth:2.0:oob
-    session = OAuth2Session(
+    session = SharedOAuth2Session(
         client=client,
         scope=[
             'Files.ReadWrite',
@@ -70,6 +313,7 @@ def get_session(token: Dict = None, token_updater: Callable[[str], None] = None)
         token_updater=token_updater,
         token=token
     )
+    session.mount('https://', GovernedAdapter(pool_maxsize=TRANSFER_WORKERS * DOWNLOAD_CONNECTIONS))
     if token is not None:
         return session
     # Microsoft enforces the response_mode parameter
@@ -93,39 +337,135 @@ def get_root_id(session: Session) -> str:
     return response.json()['id']
 
 
-def upload_large_file_by_parent(session: Session, parent_id: str, name: str, stream: BinaryIO, size: int):
-    # The size parameter should only be the real size provided by the filesystem
-    response = session.post(MSGRAPH_ENDPOINT + '/me/drive/items/' + parent_id + ':/' + name + ':/createUploadSession')
-    response.raise_for_status()
-    url = response.json()['uploadUrl']
+def upload_large_file_by_parent(session: Session, parent_id: str, name: str, stream: BinaryIO, size: int, *,
+                                resume_url: str = None, progress: Callable[[str, int], None] = None):
+    """Upload a file through an upload session
 
-    bytes_sent = 0
-    chunk = None
-    while bytes_sent < size:
+    :param resume_url: The URL of an interrupted upload session of the same file, which is continued if not expired
+    :param progress: Called with the URL of the session and the number of bytes confirmed whenever they change,
+        so that the upload can be resumed after the process is restarted
+    """
+    # The size parameter should only be the real size provided by the filesystem
+    if not size:
+        # Upload sessions do not accept empty fragments
+        return upload_file_by_parent(session, parent_id, name, stream)
+    offset = None
+    if resume_url is not None:
+        with governed_session() as connection:
+            response = connection.get(resume_url, timeout=60)
+        if response.ok:
+            url = resume_url
+            offset = _next_expected_offset(response.json())
+    if offset is None:
+        response = session.post(
+            MSGRAPH_ENDPOINT + '/me/drive/items/' + parent_id + ':/' + name + ':/createUploadSession'
+        )
+        response.raise_for_status()
+        url = response.json()['uploadUrl']
+        offset = 0
+    if progress is None:
+        return upload_by_session(url, stream, size, offset=offset)
+    progress(url, offset)
+    return upload_by_session(url, stream, size, offset=offset, progress=lambda confirmed: progress(url, confirmed))
+
+
+@contextmanager
+def _map_stream(stream: BinaryIO, size: int) -> Iterator[memoryview]:
+    # Slices of a memory map are sent without being copied, streams without files are read into memory instead
+    try:
+        mapped = mmap.mmap(stream.fileno(), size, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        content = stream.read(size)
+        if len(content) != size:
+            raise AssertionError()
+        yield memoryview(content)
+        return
+    view = memoryview(mapped)
+    try:
+        yield view
+    finally:
+        view.release()
         try:
-            length = min(320 * 1024, size - bytes_sent)
-            if not chunk:
-                chunk = stream.read(length)
-            if len(chunk) != length:
-                raise AssertionError()
-            response = requests.put(url, data=chunk, headers={'content-range': 'bytes {begin}-{end}/{size}'.format(
-                begin=bytes_sent,
-                end=bytes_sent + length - 1,
-                size=size
-            )})
-            response.raise_for_status()
-            chunk = None
-            bytes_sent += length
-        except RequestException:
+            mapped.close()
+        except BufferError:
+            # Slices may still be referenced by the last request, then the map is closed once they are collected
             pass
 
-    response = response.json()
-    return file_from_item(response)
+
+def _next_expected_offset(status: Dict) -> int:
+    return parse_ranges(status['nextExpectedRanges'])[0][0]
+
+
+def upload_by_session(url: str, stream: BinaryIO, size: int, *, offset: int = 0, sizer: ChunkSizer = None,
+                      backoff: Backoff = None, timeout: float = 60,
+                      progress: Callable[[int], None] = None) -> CloudFile:
+    """Upload a file to a created upload session
+
+    One keep-alive connection is used for the whole upload. The chunk size adapts to the throughput, and after a
+    failure the upload resumes from the ranges the server expects, with exponential backoff.
+
+    :param offset: The number of bytes already received by the server
+    :param progress: Called with the number of bytes received by the server whenever it changes
+    """
+    sizer = ChunkSizer() if sizer is None else sizer
+    backoff = Backoff() if backoff is None else backoff
+    # The upload URL is pre-authenticated, so the connection carries no credentials
+    with governed_session() as connection, _map_stream(stream, size) as view:
+        while True:
+            length = min(sizer.size, size - offset)
+            rate = UPLOAD_BANDWIDTH.rate
+            if rate is not None:
+                # Chunks longer than a few seconds at the limited rate would be sent in bursts
+                length = min(length, max(rate * 2 // UPLOAD_CHUNK_UNIT, 1) * UPLOAD_CHUNK_UNIT)
+            try:
+                # The chunk size adapts to the throughput of the network, excluding the time waiting for bandwidth
+                UPLOAD_BANDWIDTH.consume(length)
+                begin = time.monotonic()
+                response = connection.put(url, data=view[offset:offset + length], timeout=timeout, headers={
+                    'Content-Range': 'bytes {begin}-{end}/{size}'.format(
+                        begin=offset,
+                        end=offset + length - 1,
+                        size=size
+                    )
+                })
+                if response.status_code in (200, 201):
+                    return file_from_item(response.json())
+                if response.status_code == 416:
+                    # The fragment has been received before, but the response was lost
+                    response = connection.get(url, timeout=timeout)
+                response.raise_for_status()
+                offset = _next_expected_offset(response.json())
+                sizer.measure(length, time.monotonic() - begin)
+                backoff.reset()
+                if progress is not None:
+                    progress(offset)
+            except RequestException as error:
+                status = error.response.status_code if error.response is not None else None
+                if status is not None and 400 <= status < 500 and status not in (408, 429):
+                    raise
+                sizer.failed()
+                backoff.wait(error, parse_retry_after(
+                    error.response.headers.get('Retry-After', None) if error.response is not None else None
+                ))
+                try:
+                    response = connection.get(url, timeout=timeout)
+                    response.raise_for_status()
+                    offset = _next_expected_offset(response.json())
+                except RequestException:
+                    pass
+
+
+def _stream_length(stream: BinaryIO) -> int:
+    try:
+        return os.fstat(stream.fileno()).st_size - stream.tell()
+    except (AttributeError, OSError, ValueError):
+        return 0
 
 
 def upload_file_by_parent(session: Session, parent_id: str, name: str, stream: BinaryIO):
+    UPLOAD_BANDWIDTH.consume(_stream_length(stream))
     response = session.put(
-        MSGRAPH_ENDPOINT + '/me/drive/items/' + parent_id + "/children('" + name + "')/content", data=stream
+        MSGRAPH_ENDPOINT + '/me/drive/items/' + parent_id + ':/' + quote(name) + ':/content', data=stream
     )
     response.raise_for_status()
     response = response.json()
@@ -133,6 +473,7 @@ def upload_file_by_parent(session: Session, parent_id: str, name: str, stream: B
 
 
 def upload_file_by_id(session: Session, identifier: str, stream: BinaryIO):
+    UPLOAD_BANDWIDTH.consume(_stream_length(stream))
     response = session.put(MSGRAPH_ENDPOINT + '/me/drive/items/' + identifier + '/content', data=stream)
     response.raise_for_status()
     response = response.json()
@@ -160,11 +501,110 @@ def create_dir(session: Session, parent_id: str, name: str) -> str:
     return response.json()['id']
 
 
+def get_item(session: Session, identifier: str) -> CloudFile:
+    response = session.get(MSGRAPH_ENDPOINT + '/me/drive/items/' + identifier)
+    response.raise_for_status()
+    return file_from_item(response.json())
+
+
+def list_children(session: Session, identifier: str) -> List[Union[CloudFile, Directory]]:
+    children = []
+    url = MSGRAPH_ENDPOINT + '/me/drive/items/' + identifier + '/children'
+    while url is not None:
+        response = session.get(url)
+        response.raise_for_status()
+        response = response.json()
+        for item in response['value']:
+            if 'file' in item:
+                children.append(file_from_item(item))
+            else:
+                children.append(Directory(item['id'], item['name'], item['parentReference']['id']))
+        url = response.get('@odata.nextLink', None)
+    return children
+
+
+def copy_item(session: Session, identifier: str, parent_id: str, name: str) -> str:
+    """Start copying an item on the server side
+
+    :return: The URL of the monitor of the asynchronous job, see wait_for_monitor
+    """
+    response = session.post(MSGRAPH_ENDPOINT + '/me/drive/items/' + identifier + '/copy', json={
+        'parentReference': {
+            'id': parent_id
+        },
+        'name': name
+    })
+    response.raise_for_status()
+    if response.status_code != 202:
+        raise AssertionError('Not an asynchronous job')
+    return response.headers['location']
+
+
+def _item_id_from_url(url: str) -> str:
+    path = urlparse(url).path
+    if '/items/' not in path:
+        raise Exception('Unexpected location of the resulting item: ' + url)
+    return unquote(path.split('/items/', 1)[1].split('/', 1)[0])
+
+
+def wait_for_monitor(url: str, *, interval: float = 1, max_interval: float = 10, timeout: float = 10,
+                     total_timeout: float = 3600) -> str:
+    """Poll the monitor of an asynchronous job until it finishes
+
+    The monitor needs no authentication, so it is polled without the session, which makes it safe to be called
+    from other threads. A finished job is reported by its status, or by redirecting to the resulting item or
+    returning the item itself.
+
+    :param timeout: Seconds to wait for each poll
+    :param total_timeout: Seconds to wait for the job, after which it is considered failed, though it may still be
+        running on the server
+    :return: The identifier of the resulting item
+    """
+    deadline = time.monotonic() + total_timeout
+    with governed_session() as connection:
+        while True:
+            try:
+                # The resulting item needs authentication, so redirects to it are not followed
+                response = connection.get(url, timeout=timeout, allow_redirects=False)
+                if response.is_redirect:
+                    return _item_id_from_url(response.headers['location'])
+                response.raise_for_status()
+                status = response.json()
+            except HTTPError as e:
+                # Only server errors are transient
+                if e.response.status_code < 500:
+                    raise
+                logging.warning('Failed to poll the monitor: %s', e)
+                status = {}
+            except RequestException as e:
+                logging.warning('Failed to poll the monitor: %s', e)
+                status = {}
+            if status.get('status', None) == 'completed':
+                return status['resourceId']
+            if status.get('status', None) == 'failed':
+                raise Exception('Asynchronous job failed: ' + str(status.get('error', None)))
+            if 'status' not in status and 'id' in status:
+                return status['id']
+            if time.monotonic() + interval > deadline:
+                raise Exception('Asynchronous job did not finish in ' + str(total_timeout) + ' seconds')
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
+
 def remove_item(session: Session, identifier: str):
     response = session.delete(MSGRAPH_ENDPOINT + '/me/drive/items/' + identifier)
     response.raise_for_status()
 
 
+def find_child(session: Session, parent_id: str, name: str) -> Optional[str]:
+    """The identifier of the child of a directory by its name, or None if there is no such child"""
+    response = session.get(MSGRAPH_ENDPOINT + '/me/drive/items/' + parent_id + ':/' + quote(name) + ':?$select=id')
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()['id']
+
+
 def move_rename_item(session: Session, identifier: str, *, destination_id: str = None, name: str = None):
     request = {}
     if name is not None:
@@ -177,31 +617,164 @@ def move_rename_item(session: Session, identifier: str, *, destination_id: str =
     response.raise_for_status()
 
 
-def download_file(session: Session, identifier: str, destination: BinaryIO, size: int, *,
-                  checksum: Dict[str, str] = None, timeout: float = 10):
-    engines = {algorithm: HASH_ENGINES[algorithm]() for algorithm in checksum if algorithm in HASH_ENGINES}
-    for engine in engines.values():
-        engine.send(None)
-
-    bytes_read = 0
+def get_download_url(session: Session, identifier: str) -> str:
     url = MSGRAPH_ENDPOINT + '/me/drive/items/' + identifier + '/content?AVOverride=1'
     response = session.get(url, allow_redirects=False)
     response.raise_for_status()
     if response.status_code != 302:
         raise AssertionError('Not a redirecting link')
-    url = response.headers['location']
+    return response.headers['location']
+
+
+def download_file(session: Session, identifier: str, destination: BinaryIO, size: int, **kwargs):
+    download_by_url(get_download_url(session, identifier), destination, size, **kwargs)
+
+
+def _get_range(connection: Session, url: str, begin: int, end: int, timeout: float) -> requests.Response:
+    response = connection.get(url, stream=True, timeout=timeout, headers={
+        'Range': 'bytes=' + str(begin) + '-' + str(end - 1),
+        # Ranges of compressed content cannot be written at their offsets
+        'Accept-Encoding': 'identity'
+    })
+    response.raise_for_status()
+    return response
+
+
+def _check_range(response: requests.Response, begin: int) -> Optional[int]:
+    # Returns the total size from a header like "Content-Range: bytes 0-1023/4096"
+    content_range = response.headers.get('Content-Range', '')
+    if response.status_code != 206 or not content_range.startswith('bytes ' + str(begin) + '-'):
+        raise AssertionError('Range not served: ' + content_range)
+    total = content_range.rpartition('/')[2]
+    return int(total) if total != '*' else None
+
+
+def download_by_url(url: str, destination: BinaryIO, size: int, *, checksum: Dict[str, str] = None,
+                    timeout: float = 10, connections: int = DOWNLOAD_CONNECTIONS, part_size: int = DOWNLOAD_PART,
+                    total: int = None, done: Sequence[Tuple[int, int]] = (),
+                    progress: Callable[[int, List[Tuple[int, int]]], None] = None):
+    """Download a file from a pre-authenticated URL
+
+    The first part is requested as a range, which also tells the size of the whole file, and the other parts are
+    downloaded through @connections connections concurrently, written at their offsets. Each part is retried on its
+    own. The hashes are verified by reading the file back after it is complete. If the server does not support
+    ranges, or @destination is not a real file opened for both reading and writing, the file is downloaded through
+    one connection instead.
+
+    :param total: The size of the whole file, known if the download is resumed
+    :param done: Ranges of bytes already written to @destination, which include the beginnings but not the ends
+    :param progress: Called with the size of the whole file and all ranges written whenever a part is written
+    """
+    checksum = {} if checksum is None else checksum
+    done = list(done) if total is not None else []
+    with governed_session(connections) as connection:
+        response = None
+        try:
+            fd = destination.fileno() if destination.readable() else None
+        except (AttributeError, OSError):
+            fd = None
+        if fd is None or connections <= 1:
+            total = None
+        elif total is None:
+            try:
+                response = _get_range(connection, url, 0, part_size, timeout)
+                total = _check_range(response, 0)
+            except (RequestException, AssertionError) as e:
+                logging.warning('Falling back to a single connection as ranges are not supported: %s', e)
+                total = None
+        if total is None:
+            if response is not None:
+                response.close()
+            if fd is not None:
+                os.ftruncate(fd, 0)
+                destination.seek(0)
+            _download_sequentially(connection, url, destination, size, checksum, timeout)
+            return
+
+        if not _compare_size(total, size):
+            raise AssertionError('Size mismatch')
+        os.ftruncate(fd, total)
+
+        def _download_part(begin: int, end: int, response: requests.Response = None):
+            backoff = Backoff()
+            offset = begin
+            while offset < end:
+                try:
+                    if response is None:
+                        response = _get_range(connection, url, offset, end, timeout)
+                        _check_range(response, offset)
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        if offset + len(chunk) > end:
+                            raise AssertionError('Read more than expected')
+                        DOWNLOAD_BANDWIDTH.consume(len(chunk))
+                        os.pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+                    if offset < end:
+                        raise RequestException('Connection closed before byte ' + str(end))
+                except RequestException as error:
+                    backoff.wait(error)
+                finally:
+                    if response is not None:
+                        response.close()
+                    response = None
+
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            parts = {}
+            for begin, end in missing_ranges(total, done, part_size):
+                # The response to the first request is for the first part
+                parts[executor.submit(_download_part, begin, end, response if begin == 0 else None)] = (begin, end)
+            for part in as_completed(parts):
+                part.result()
+                done.append(parts[part])
+                if progress is not None:
+                    progress(total, done)
+
+    # Hashes are calculated in the order of offsets after all parts are written
+    engines = _hash_engines(checksum)
+    for offset in range(0, total, 1024 * 1024):
+        chunk = os.pread(fd, 1024 * 1024, offset)
+        for engine in engines.values():
+            engine.send(chunk)
+    _verify_hashes(engines, checksum)
+
+
+def _hash_engines(checksum: Dict[str, str]) -> Dict[str, Generator]:
+    engines = {algorithm: HASH_ENGINES[algorithm]() for algorithm in checksum if algorithm in HASH_ENGINES}
+    for engine in engines.values():
+        engine.send(None)
+    return engines
+
+
+def _verify_hashes(engines: Dict[str, Generator], checksum: Dict[str, str]):
+    for algorithm, engine in engines.items():
+        calculated = engine.send(None)
+        expected = normalize_hash(algorithm, checksum[algorithm])
+        if calculated != expected:
+            raise Exception('Checksum of {algorithm} mismatch, should be {expected}, actually is {actual}'.format(
+                algorithm=algorithm,
+                expected=expected,
+                actual=calculated
+            ))
+
+
+def _download_sequentially(connection: Session, url: str, destination: BinaryIO, size: int,
+                           checksum: Dict[str, str], timeout: float):
+    engines = _hash_engines(checksum)
+    bytes_read = 0
+    backoff = Backoff()
 
     # As the content is compressed the content-length header is inaccurate
     while True:
         try:
             headers = {'Range': 'bytes=' + str(bytes_read) + '-'} if bytes_read != 0 else {}
-            response = requests.get(url, stream=True, headers=headers, timeout=timeout)
+            response = connection.get(url, stream=True, headers=headers, timeout=timeout)
             response.raise_for_status()
             for chunk in response.iter_content(chunk_size=None):
                 bytes_read += len(chunk)
                 # if bytes_read > size:  # The wrong size provided by OneDrive may only be larger
                 if False:  # But the size value is forcefully reset to 0
                     raise AssertionError('Read more than expected')
+                DOWNLOAD_BANDWIDTH.consume(len(chunk))
                 destination.write(chunk)
                 for engine in engines.values():
                     engine.send(chunk)
@@ -211,20 +784,17 @@ def download_file(session: Session, identifier: str, destination: BinaryIO, size
 
         except RequestException as e:
             print(e)
-            pass
+            backoff.wait(e)
 
-    for algorithm, engine in engines.items():
-        calculated = engine.send(None)
-        expected = checksum[algorithm].upper()
-        if calculated != expected:
-            raise Exception('Checksum of {algorithm} mismatch, should be {expected}, actually is {actual}'.format(
-                algorithm=algorithm,
-                expected=expected,
-                actual=calculated
-            ))
+    _verify_hashes(engines, checksum)
 
 
-def retrieve_delta(session: Session) -> Tree:
+def retrieve_delta(session: Session, sizes: Dict[str, int] = None) -> Tree:
+    """Retrieve the changes since the last time and apply them to the saved cloud tree
+
+    :param sizes: Filled with the sizes of the files changed since the last time as reported, which are not kept in
+        the tree as they may be inaccurate, but are still good enough to order transfers
+    """
     root_id = getattr(CONFIG, 'root_id', None)
     selects = ','.join([
         'id',
@@ -259,7 +829,7 @@ def retrieve_delta(session: Session) -> Tree:
             CONFIG.root_id = root_id
         # The delta link will also contain the $select parameters
         url = MSGRAPH_ENDPOINT + '/me/drive/items/' + root_id + '/delta?$select=' + selects
-        tree = Tree(root_id)
+        tree = create_tree(root_id)
         response = session.get(url)
         response.raise_for_status()
 
@@ -283,6 +853,14 @@ def retrieve_delta(session: Session) -> Tree:
     files = tree.files
     dirs = tree.dirs
 
+    # Digests loaded with the previous tree stay valid for the subtrees without changes
+    for identifier in items:
+        if identifier in files:
+            tree.invalidate_digest(files[identifier].parent)
+        elif identifier in dirs:
+            tree.invalidate_digest(identifier)
+    digests = tree.cached_digests()
+
     deleted = set()
     for identifier, item in items.items():
         if identifier == root_id:
@@ -294,6 +872,8 @@ def retrieve_delta(session: Session) -> Tree:
                 deleted.add(identifier)
         elif 'file' in item:
             files[identifier] = file_from_item(item)
+            if sizes is not None and 'size' in item:
+                sizes[identifier] = item['size']
         elif 'folder' in item or 'package' in item:
             dirs[identifier] = Directory(identifier, item['name'], item['parentReference']['id'])
 
@@ -308,16 +888,22 @@ def retrieve_delta(session: Session) -> Tree:
         if not count:
             break
 
-    tree = Tree(root_id)
+    tree = create_tree(root_id)
     tree.files.update(files)
     tree.dirs.update(dirs)
     tree.reconstruct_by_parents()
+    # Directories with new subdirectories are left out by restore_digests, while the ones with new files are not
+    tree.restore_digests(digests)
+    for identifier in items:
+        if identifier in tree.files:
+            tree.invalidate_digest(tree.files[identifier].parent)
 
     for identifier, file in tree.files.items():
         if file.cTag is None:
             response = session.get(MSGRAPH_ENDPOINT + '/me/drive/items/' + file.id + '?$select=cTag')
             response.raise_for_status()
             file.cTag = response.json()['cTag']
+            tree.invalidate_digest(file.parent)
 
     with session_scope() as session:
         save_tree(session, tree, TreeType.DELTA)
@@ -13,26 +13,45 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import itertools
 import json
 import logging
+import os
 import time
+from collections import Counter, defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from functools import singledispatch
 from pathlib import Path
-from typing import Mapping, MutableMapping, Sequence
+from typing import AbstractSet, Callable, Dict, Iterable, List, Mapping, MutableMapping, Sequence, Set, Tuple, Union
 
+import attr
 from requests import Session
+from requests.exceptions import RequestException
 
 from . import _compare_size
 from .algorithms import get_change_set, check_same_node_operations, mark_dependencies, topological_sort, field_test
-from .algorithms import optimize_cloud_deletion, compare_file_by_cTag, compare_file_by_mtime, compare_file_by_hashes
+from .algorithms import compare_file_by_cTag, compare_file_by_mtime, compare_file_by_hashes, drop_unchanged_content
+from .algorithms import find_cloud_copies, find_local_sources
+from .algorithms import optimize_scripts, drop_common_operations, prune_deletions, ScriptPass
 from .database import CONFIG, TreeType, session_scope, load_tree, save_tree, ConfigEntity
-from .local import get_local_tree
-from .model import RenameMoveDir, Tree, AddCloudFile, ModifyCloudFile
+from .database import ScriptType, save_journal, load_journal, checkpoint_journal, clear_journal, ContentHashCache
+from .database import save_upload_session, load_upload_session, remove_upload_session
+from .database import save_partial_download, load_partial_download, remove_partial_downloads
+from .local import get_local_tree, is_temp_id, STAGING_DIR_NAME
+from .model import RenameMoveDir, Tree, AddCloudFile, ModifyCloudFile, CloudFile
 from .model import basic_operation, Operation, AddFile, DelFile, ModifyFile, RenameMoveFile, AddDir, DelDir
-from .platform import save_id_in_metadata
-from .sdk import get_session, retrieve_delta
-from .sdk import remove_item, move_rename_item, create_dir, download_file, upload_large_file_by_parent
+from .platform import save_id_in_metadata, clone_file
+from .transfer import TransferScheduler, TransferPriority, BandwidthSchedule
+from .sdk import get_session, retrieve_delta, BatchClient, file_from_item
+from .sdk import download_file, upload_large_file_by_parent, upload_file_by_parent, upload_file_by_id
+from .sdk import SIMPLE_UPLOAD_LIMIT, BATCH_UPLOAD_LIMIT, TRANSFER_WORKERS, GOVERNOR
+from .sdk import UPLOAD_BANDWIDTH, DOWNLOAD_BANDWIDTH
+from .sdk import copy_item, wait_for_monitor, get_item, list_children, find_child, remove_item
+
+
+# Rules ordering transfers unless configured, see TransferPriority
+DEFAULT_TRANSFER_PRIORITY = 'paths,small-first'
 
 
 class SyncDirection(Enum):
@@ -45,9 +64,13 @@ def sync(direction: SyncDirection) -> int:
     token = getattr(CONFIG, 'token', None)
     token = json.loads(token) if token is not None else None
     sdk_session = get_session(token, lambda new_token: setattr(CONFIG, 'token', json.dumps(new_token)))
+    UPLOAD_BANDWIDTH.schedule = BandwidthSchedule.parse(getattr(CONFIG, 'upload_limit', ''))
+    DOWNLOAD_BANDWIDTH.schedule = BandwidthSchedule.parse(getattr(CONFIG, 'download_limit', ''))
+    priority = transfer_priority()
 
     logging.info('Retrieving cloud tree structure')
-    cloud_tree = retrieve_delta(sdk_session)
+    sizes = {}
+    cloud_tree = retrieve_delta(sdk_session, sizes)
     logging.info('Cloud tree structure retrieved successfully')
 
     logging.info('Loading previous state from database')
@@ -56,15 +79,103 @@ def sync(direction: SyncDirection) -> int:
     logging.info('Previous state loaded successfully')
 
     logging.info('Parsing local tree structure')
-    local_tree, id_to_path = get_local_tree(CONFIG.local_path, cloud_tree)
+    cache = ContentHashCache()
+    local_tree, id_to_path = get_local_tree(CONFIG.local_path, cloud_tree, saved_tree, sizes, cache)
     logging.info('Local tree structure parsed successfully')
 
+    with session_scope() as db_session:
+        journal = load_journal(db_session)
+
+    if journal is None:
+
+        cloud_script, local_script = plan_scripts(direction, saved_tree, cloud_tree, local_tree, id_to_path, cache)
+
+        if not cloud_script:
+            logging.info('No operations need to be applied locally')
+        else:
+            logging.info('Applying these operations locally:')
+            for line in cloud_script:
+                logging.info(str(line))
+        if not local_script:
+            logging.info('No operations need to be applied to the cloud')
+        else:
+            logging.info('Applying these operations to the cloud:')
+            for line in local_script:
+                logging.info(str(line))
+
+        if cloud_script or local_script:
+            while True:
+                confirm = input('Proceed? [Y/n] ')
+                confirm = confirm.lower()
+                if confirm == '' or confirm == 'y':
+                    break
+                if confirm == 'n':
+                    logging.info('Cancelled')
+                    return -1
+
+            with session_scope() as db_session:
+                save_journal(db_session, {
+                    ScriptType.CLOUD: cloud_script,
+                    ScriptType.LOCAL: local_script
+                }, _temp_paths(cloud_script + local_script, id_to_path, Path(CONFIG.local_path)), cloud_tree)
+        done = set()
+        real_id = {}
+        planned_tree = None
+    else:
+        logging.info('Resuming the interrupted synchronization')
+        scripts, done, temp_paths, real_id = journal
+        cloud_script, local_script, real_id = translate_journal(
+            scripts, temp_paths, real_id, id_to_path, Path(CONFIG.local_path)
+        )
+        with session_scope() as db_session:
+            planned_tree = load_tree(db_session, TreeType.PLANNED)
+
+    if cloud_script or local_script:
+        sources = _find_local_sources(cloud_script, local_tree, cloud_tree, id_to_path, sizes)
+        local_apply_script(cloud_script, id_to_path, local_tree, cloud_tree, sdk_session, done, sources, priority,
+                           sizes)
+        copies = _find_cloud_copies(local_script, local_tree, cloud_tree, id_to_path)
+        cloud_apply_script(local_script, id_to_path, local_tree, cloud_tree, sdk_session, done, real_id, copies,
+                           priority)
+
+    if planned_tree is not None:
+        # The fresh cloud tree may contain changes made after planning, which have never been applied locally
+        cloud_tree = synchronized_tree(planned_tree, local_script, cloud_tree, real_id)
+    with session_scope() as db_session:
+        save_tree(db_session, cloud_tree, TreeType.SAVED)
+        db_session.merge(ConfigEntity(key='last_sync_time', value=str(int(time.time() * 1e9))))
+        clear_journal(db_session)
+
+    if GOVERNOR.throttled_requests:
+        logging.info('{} request(s) were throttled for {:.1f} seconds in total'.format(
+            GOVERNOR.throttled_requests, GOVERNOR.throttled_time
+        ))
+    return 0
+
+
+def transfer_priority() -> TransferPriority:
+    rules = getattr(CONFIG, 'transfer_priority', DEFAULT_TRANSFER_PRIORITY)
+    paths = json.loads(getattr(CONFIG, 'priority_paths', '[]'))
+    return TransferPriority([rule for rule in rules.split(',') if rule], paths)
+
+
+def plan_scripts(
+        direction: SyncDirection,
+        saved_tree: Tree,
+        cloud_tree: Tree,
+        local_tree: Tree,
+        id_to_path: Mapping[str, Path],
+        cache: ContentHashCache
+) -> Tuple[List[Operation], List[Operation]]:
     logging.info('Comparing trees and generating operations')
 
     last_sync_time = int(getattr(CONFIG, 'last_sync_time', 0))
     if direction == SyncDirection.TWO_WAY:
-        cloud_changes = get_change_set(saved_tree, cloud_tree, compare_file_by_cTag)
+        cloud_changes = get_change_set(saved_tree, cloud_tree, compare_file_by_cTag, by_digest=True)
         local_changes = get_change_set(saved_tree, local_tree, compare_file_by_mtime(last_sync_time))
+        cloud_changes, local_changes = _drop_unchanged_content(
+            [cloud_changes, local_changes], local_tree, cloud_tree, id_to_path, cache
+        )
 
         check_same_node_operations(cloud_changes, local_changes)
 
@@ -79,14 +190,22 @@ def sync(direction: SyncDirection) -> int:
         if not field_test(saved_tree, local_script).equals(local_tree):
             raise AssertionError()
 
+        cloud_script, local_script = _optimize_scripts(
+            saved_tree, cloud_script, saved_tree, local_script, [drop_common_operations]
+        )
+
         cloud_final = field_test(cloud_tree, local_script)
         local_final = field_test(local_tree, cloud_script)
         if not cloud_final.equals(local_final):
             raise AssertionError()
 
-        local_script = optimize_cloud_deletion(saved_tree, local_script)
+        cloud_script, local_script = _optimize_scripts(
+            saved_tree, cloud_script, saved_tree, local_script, [prune_deletions]
+        )
     elif direction == SyncDirection.DOWNLOAD_ONLY:
-        cloud_changes = get_change_set(local_tree, cloud_tree, compare_file_by_hashes(id_to_path))
+        cloud_changes = get_change_set(local_tree, cloud_tree, compare_file_by_hashes(
+            id_to_path, before=local_tree, after=cloud_tree, cache=cache
+        ))
 
         cloud_dependencies = mark_dependencies(local_tree, cloud_changes)
 
@@ -95,53 +214,167 @@ def sync(direction: SyncDirection) -> int:
 
         if not field_test(local_tree, cloud_script).equals(cloud_tree):
             raise AssertionError()
+
+        cloud_script, local_script = _optimize_scripts(
+            local_tree, cloud_script, cloud_tree, local_script, [prune_deletions]
+        )
     elif direction == SyncDirection.UPLOAD_ONLY:
         local_changes = get_change_set(cloud_tree, local_tree, compare_file_by_mtime(last_sync_time))
+        local_changes, = _drop_unchanged_content([local_changes], local_tree, cloud_tree, id_to_path, cache)
 
         local_dependencies = mark_dependencies(cloud_tree, local_changes)
 
         cloud_script = []
         local_script = topological_sort(local_changes, local_dependencies)
 
-        optimize_cloud_deletion(saved_tree, local_script)
-
         if not field_test(cloud_tree, local_script).equals(local_tree):
             raise AssertionError()
+
+        cloud_script, local_script = _optimize_scripts(
+            local_tree, cloud_script, cloud_tree, local_script, [prune_deletions]
+        )
     else:
         raise AssertionError()
+    cache.save((file.st_dev, file.st_ino) for file in local_tree.files.values())
 
     logging.info('Compared successfully')
-    if not cloud_script:
-        logging.info('No operations need to be applied locally')
-    else:
-        logging.info('Applying these operations locally:')
-        for line in cloud_script:
-            logging.info(str(line))
-    if not local_script:
-        logging.info('No operations need to be applied to the cloud')
-    else:
-        logging.info('Applying these operations to the cloud:')
-        for line in local_script:
-            logging.info(str(line))
+    return list(cloud_script), list(local_script)
 
-    if cloud_script or local_script:
-        while True:
-            confirm = input('Proceed? [Y/n] ')
-            confirm = confirm.lower()
-            if confirm == '' or confirm == 'y':
-                break
-            if confirm == 'n':
-                logging.info('Cancelled')
-                return -1
-
-        local_apply_script(cloud_script, id_to_path, local_tree, cloud_tree, sdk_session)
-        cloud_apply_script(local_script, id_to_path, local_tree, cloud_tree, sdk_session)
 
-    with session_scope() as db_session:
-        save_tree(db_session, cloud_tree, TreeType.SAVED)
-        db_session.merge(ConfigEntity(key='last_sync_time', value=str(int(time.time() * 1e9))))
+def _drop_unchanged_content(
+        change_sets: Sequence[Set[Operation]],
+        local_tree: Tree,
+        cloud_tree: Tree,
+        id_to_path: Mapping[str, Path],
+        cache: ContentHashCache
+) -> List[Set[Operation]]:
+    count = sum(len(change_set) for change_set in change_sets)
+    change_sets = drop_unchanged_content(change_sets, local_tree, cloud_tree, id_to_path, cache=cache)
+    count -= sum(len(change_set) for change_set in change_sets)
+    if count:
+        logging.info('Content verification omitted ' + str(count) + ' modification(s) of unchanged files')
+    return change_sets
 
-    return 0
+
+def _find_local_sources(
+        cloud_script: Sequence[Operation],
+        local_tree: Tree,
+        cloud_tree: Tree,
+        id_to_path: Mapping[str, Path],
+        sizes: Mapping[str, int]
+) -> Dict[str, str]:
+    cache = ContentHashCache()
+    sources = find_local_sources(cloud_script, local_tree, cloud_tree, id_to_path, sizes, cache=cache)
+    cache.save()
+    if sources:
+        logging.info(str(len(sources)) + ' new file(s) will be reused from existing local ones instead of downloaded')
+    return sources
+
+
+def _find_cloud_copies(
+        local_script: Sequence[Operation],
+        local_tree: Tree,
+        cloud_tree: Tree,
+        id_to_path: Mapping[str, Path]
+) -> Dict[str, str]:
+    cache = ContentHashCache()
+    copies = find_cloud_copies(local_script, local_tree, cloud_tree, id_to_path, cache=cache)
+    cache.save()
+    if copies:
+        logging.info(str(len(copies)) + ' new item(s) will be copied from existing ones in the cloud')
+    return copies
+
+
+def _optimize_scripts(
+        cloud_tree: Tree,
+        cloud_script: Sequence[Operation],
+        local_tree: Tree,
+        local_script: Sequence[Operation],
+        passes: Sequence[ScriptPass]
+) -> Tuple[List[Operation], List[Operation]]:
+    cloud_script, local_script, saved = optimize_scripts(cloud_tree, cloud_script, local_tree, local_script, passes)
+    for name, count in saved.items():
+        if count:
+            logging.info('Optimization ' + name + ' saved ' + str(count) + ' operation(s)')
+    return cloud_script, local_script
+
+
+_ID_FIELDS = ('id', 'parent_id', 'child_id', 'destination_id')
+# Fields referring to existing nodes, whose real identifiers must be known before applying
+_RESOLVED_FIELDS = ('id', 'parent_id', 'destination_id')
+
+
+def _temp_paths(script: Iterable[Operation], id_to_path: Mapping[str, Path], root: Path) -> Dict[str, str]:
+    temp_paths = {}
+    for line in script:
+        for key, value in attr.asdict(line).items():
+            if key in _ID_FIELDS and is_temp_id(value):
+                temp_paths[value] = str(id_to_path[value].relative_to(root))
+    return temp_paths
+
+
+def _translate_ids(line: Operation, translation: Mapping[str, str]) -> Operation:
+    return attr.evolve(line, **{
+        key: translation.get(value, value) for key, value in attr.asdict(line).items() if key in _ID_FIELDS
+    })
+
+
+def translate_journal(
+        scripts: Mapping[ScriptType, Sequence[Operation]],
+        temp_paths: Mapping[str, str],
+        real_id: Mapping[str, str],
+        id_to_path: Mapping[str, Path],
+        root: Path
+) -> Tuple[List[Operation], List[Operation], Dict[str, str]]:
+    """Translate the temporary identifiers recorded by the journal into the ones assigned in this run
+
+    Temporary identifiers are assigned again in every run, so the recorded ones are translated by their paths. The
+    ones whose paths disappeared are prefixed to prevent them from colliding with the new ones.
+
+    :return: The cloud script, the local script and the real identifiers already assigned
+    """
+    path_to_id = {path: identifier for identifier, path in id_to_path.items()}
+    translation = {temp_id: path_to_id.get(root / path, '\0' + temp_id) for temp_id, path in temp_paths.items()}
+    return (
+        [_translate_ids(line, translation) for line in scripts[ScriptType.CLOUD]],
+        [_translate_ids(line, translation) for line in scripts[ScriptType.LOCAL]],
+        {translation.get(temp_id, temp_id): identifier for temp_id, identifier in real_id.items()}
+    )
+
+
+def synchronized_tree(
+        planned_tree: Tree,
+        local_script: Sequence[Operation],
+        cloud_tree: Tree,
+        real_id: Mapping[str, str]
+) -> Tree:
+    """The state both sides agree on after a resumed synchronization, to be saved for the next comparison
+
+    :param planned_tree: The cloud tree which the scripts were planned against, which will be modified
+    :param local_script: The applied local script, whose temporary identifiers are resolved by @real_id
+    :param cloud_tree: The cloud tree after applying, only providing the files uploaded by @local_script, as its
+        other changes are not applied locally and are left to be found in the next run
+    """
+    uploaded = set()
+    for line in local_script:
+        line = _translate_ids(line, real_id)
+        # Deletions may be pruned into the deleted directories, so the operations are not checked
+        basic_operation(line, planned_tree)
+        if isinstance(line, (AddFile, ModifyFile)):
+            uploaded.add(line.child_id if isinstance(line, AddFile) else line.id)
+    for file_id in uploaded:
+        if file_id in planned_tree.files:
+            file = planned_tree.files[file_id]
+            # Files deleted from the cloud again after uploading are kept without tags, and deleted in the next run
+            uploaded_file = cloud_tree.files.get(file_id)
+            planned_tree.invalidate_digest(file.parent)
+            planned_tree.files[file_id] = CloudFile(
+                file_id, file.name, file.parent, file.size,
+                uploaded_file.eTag if uploaded_file is not None else None,
+                uploaded_file.cTag if uploaded_file is not None else None,
+                {}
+            )
+    return planned_tree
 
 
 def local_apply_script(
@@ -149,12 +382,162 @@ def local_apply_script(
         id_to_path: MutableMapping[str, Path],
         local_tree: Tree,
         cloud_tree: Tree,
-        session: Session
+        session: Session,
+        done: AbstractSet[Tuple[ScriptType, int]] = frozenset(),
+        sources: Mapping[str, str] = None,
+        priority: TransferPriority = None,
+        sizes: Mapping[str, int] = None
 ):
+    """Apply the cloud changes locally
+
+    Downloads run concurrently, see TransferScheduler, while other operations are applied in order after the
+    downloads they depend on.
+
+    :param priority: Orders the downloads waiting for a thread
+    :param sizes: Sizes of the files to download as reported by the cloud, see retrieve_delta
+
+    :param sources: Mapping from files added by @cloud_script to local files with the same content, which are
+        reused instead of downloaded, see find_local_sources. Sources deleted by @cloud_script are moved by their last
+        use, and deleted ones still needed later are kept in the staging directory by hard links until then.
+    """
+    sources = {} if sources is None else sources
+    priority = TransferPriority() if priority is None else priority
+    sizes = {} if sizes is None else sizes
+    uses = Counter(
+        sources[line.child_id] for index, line in enumerate(cloud_script)
+        if isinstance(line, AddFile) and line.child_id in sources and (ScriptType.CLOUD, index) not in done
+    )
+    deleted = set()
     for index, line in enumerate(cloud_script):
-        logging.info('Applying to local state (' + str(index + 1) + '/' + str(len(cloud_script)) + ')')
-        local_apply_operation(line, local_tree, cloud_tree, id_to_path, session)
-        basic_operation(line, local_tree)
+        if isinstance(line, (DelFile, DelDir)) and (ScriptType.CLOUD, index) not in done:
+            deleted.update(_files_to_delete(line, local_tree))
+    staging = id_to_path[local_tree.root_id] / STAGING_DIR_NAME
+    links = staging / 'links'
+    _clear_staging(links)
+    staged = {}
+    counter = itertools.count()
+
+    def _apply(index: int, line: Operation, transfers: TransferScheduler):
+        def _applied(operation: Operation):
+            # Files deleted before an interrupted run recorded it are not in the local tree when resuming
+            if not isinstance(operation, DelFile) or operation.id in local_tree.files:
+                basic_operation(operation, local_tree)
+            with session_scope() as db_session:
+                checkpoint_journal(db_session, ScriptType.CLOUD, index, {})
+
+        resources = _waited_resources(line, local_tree, {})
+        if isinstance(line, AddFile) and line.child_id in sources:
+            resources.add(sources[line.child_id])
+        transfers.wait(resources)
+        logging.info('Applying to local state (' + str(index + 1) + '/' + str(len(cloud_script)) + ', ' + str(
+            transfers.in_flight
+        ) + ' transfer(s) in flight)')
+        if isinstance(line, (DelFile, DelDir)):
+            for file_id in _files_to_delete(line, local_tree):
+                if uses[file_id] and file_id not in staged:
+                    links.mkdir(parents=True, exist_ok=True)
+                    staged[file_id] = links / str(next(counter))
+                    os.link(str(id_to_path[file_id]), str(staged[file_id]))
+        if isinstance(line, AddFile) and line.child_id in sources:
+            source_id = sources[line.child_id]
+            uses[source_id] -= 1
+            source = staged.get(source_id, id_to_path.get(source_id))
+            destination = id_to_path[line.parent_id] / line.name
+            if source_id in deleted and not uses[source_id]:
+                # Moved instead of linked, as the identifier saved below would be shared with the source still to be
+                # deleted. The source is already there if it was moved before an interrupted run recorded it
+                if source != destination:
+                    os.replace(str(source), str(destination))
+                staged.pop(source_id, None)
+                id_to_path.pop(source_id, None)
+            else:
+                clone_file(source, destination)
+            save_id_in_metadata(line.child_id, destination)
+            id_to_path[line.child_id] = destination
+            _applied(line)
+        else:
+            local_apply_operation(line, local_tree, cloud_tree, id_to_path, session, transfers, _applied)
+
+    root = id_to_path[local_tree.root_id]
+
+    def _priority(line: Union[AddFile, ModifyFile]) -> Tuple:
+        if isinstance(line, AddFile):
+            return priority((id_to_path[line.parent_id] / line.name).relative_to(root), sizes.get(line.child_id))
+        return priority(id_to_path[line.id].relative_to(root), sizes.get(line.id))
+
+    with TransferScheduler(TRANSFER_WORKERS, _priority) as transfers:
+        for index, line in enumerate(cloud_script):
+            if (ScriptType.CLOUD, index) not in done:
+                _apply(index, line, transfers)
+
+    _clear_staging(links)
+    # Every download has finished, so anything left was abandoned by the script of an interrupted run
+    _clear_staging(staging / 'partial')
+    with session_scope() as db_session:
+        remove_partial_downloads(db_session)
+    if staging.exists() and not any(staging.iterdir()):
+        staging.rmdir()
+
+
+def _clear_staging(staging: Path):
+    # Files left by interrupted runs are never used as sources, as the staging directory is not parsed
+    if staging.exists():
+        for child in staging.iterdir():
+            child.unlink()
+        staging.rmdir()
+
+
+def _download_partial(session: Session, file_id: str, cloud_file: CloudFile, staging: Path) -> Path:
+    """Download into a partial file in the staging directory, which is moved into place by _finish_download
+
+    The ranges written are recorded as the download goes, and a later run resumes them if the file is still at the
+    same version. This runs in the threads of transfers, so that nothing shared is touched other than the database.
+    """
+    partial = staging / 'partial' / (file_id + '.partial')
+    with session_scope() as db_session:
+        record = load_partial_download(db_session, file_id, cloud_file.cTag)
+    if record is None or not partial.exists():
+        partial.parent.mkdir(parents=True, exist_ok=True)
+        total, done, mode = None, [], 'w+b'
+    else:
+        (total, done), mode = record, 'r+b'
+        logging.info('Resuming the download of ' + cloud_file.name)
+
+    def _progress(size: int, ranges: Sequence[Tuple[int, int]]):
+        with session_scope() as db_session:
+            save_partial_download(db_session, file_id, cloud_file.cTag, size, ranges)
+
+    try:
+        with partial.open(mode) as file:
+            download_file(session, file_id, file, cloud_file.size, checksum=cloud_file.hashes,
+                          total=total, done=done, progress=_progress)
+    except RequestException:
+        raise
+    except Exception:
+        # The content written is wrong, so that resuming it would never succeed
+        partial.unlink()
+        with session_scope() as db_session:
+            remove_partial_downloads(db_session, file_id)
+        raise
+    return partial
+
+
+def _finish_download(file_id: str, partial: Path, destination: Path):
+    os.replace(str(partial), str(destination))
+    with session_scope() as db_session:
+        remove_partial_downloads(db_session, file_id)
+
+
+def _files_to_delete(line: Operation, local_tree: Tree) -> List[str]:
+    if isinstance(line, DelFile):
+        return [line.id]
+    result = []
+    stack = [line.id]
+    while stack:
+        directory = local_tree.dirs[stack.pop()]
+        result.extend(directory.files)
+        stack.extend(directory.dirs)
+    return result
 
 
 @singledispatch
@@ -163,7 +546,9 @@ def local_apply_operation(
         local_tree: Tree,
         cloud_tree: Tree,
         id_to_path: MutableMapping[str, Path],
-        session: Session
+        session: Session,
+        transfers: TransferScheduler,
+        applied: Callable[[Operation], None]
 ) -> None:
     raise NotImplementedError()
 
@@ -174,14 +559,23 @@ def _(
         local_tree: Tree,
         cloud_tree: Tree,
         id_to_path: MutableMapping[str, Path],
-        session: Session
+        session: Session,
+        transfers: TransferScheduler,
+        applied: Callable[[Operation], None]
 ) -> None:
-    destination = id_to_path[args.parent_id] / args.name
     cloud_file = cloud_tree.files[args.child_id]
-    with destination.open('wb') as file:
-        download_file(session, args.child_id, file, cloud_file.size, checksum=cloud_file.hashes)
-    save_id_in_metadata(args.child_id, destination)
-    id_to_path[args.child_id] = destination
+    staging = id_to_path[local_tree.root_id] / STAGING_DIR_NAME
+
+    def _downloaded(partial: Path):
+        # The parent may have been moved meanwhile
+        destination = id_to_path[args.parent_id] / args.name
+        _finish_download(args.child_id, partial, destination)
+        save_id_in_metadata(args.child_id, destination)
+        id_to_path[args.child_id] = destination
+        applied(args)
+
+    transfers.submit(lambda: _download_partial(session, args.child_id, cloud_file, staging),
+                     _operation_resources(args, local_tree, {}), _downloaded, args)
 
 
 @local_apply_operation.register(DelFile)
@@ -190,10 +584,15 @@ def _(
         local_tree: Tree,
         cloud_tree: Tree,
         id_to_path: MutableMapping[str, Path],
-        session: Session
+        session: Session,
+        transfers: TransferScheduler,
+        applied: Callable[[Operation], None]
 ) -> None:
-    id_to_path[args.id].unlink()
-    del id_to_path[args.id]
+    # Files are missing if they have been moved to the files added from them, or deleted by an interrupted run
+    path = id_to_path.pop(args.id, None)
+    if path is not None:
+        path.unlink()
+    applied(args)
 
 
 @local_apply_operation.register(ModifyFile)
@@ -202,11 +601,21 @@ def _(
         local_tree: Tree,
         cloud_tree: Tree,
         id_to_path: MutableMapping[str, Path],
-        session: Session
+        session: Session,
+        transfers: TransferScheduler,
+        applied: Callable[[Operation], None]
 ) -> None:
     cloud_file = cloud_tree.files[args.id]
-    with id_to_path[args.id].open('wb') as file:
-        download_file(session, args.id, file, cloud_file.size, checksum=cloud_file.hashes)
+    staging = id_to_path[local_tree.root_id] / STAGING_DIR_NAME
+
+    def _downloaded(partial: Path):
+        _finish_download(args.id, partial, id_to_path[args.id])
+        # The file is replaced by a new one, which needs the id again
+        save_id_in_metadata(args.id, id_to_path[args.id])
+        applied(args)
+
+    transfers.submit(lambda: _download_partial(session, args.id, cloud_file, staging),
+                     _operation_resources(args, local_tree, {}), _downloaded, args)
 
 
 @local_apply_operation.register(RenameMoveFile)
@@ -215,7 +624,9 @@ def _(
         local_tree: Tree,
         cloud_tree: Tree,
         id_to_path: MutableMapping[str, Path],
-        session: Session
+        session: Session,
+        transfers: TransferScheduler,
+        applied: Callable[[Operation], None]
 ) -> None:
     file = local_tree.files[args.id]
     destination_id = args.destination_id if args.destination_id is not None else file.parent
@@ -223,6 +634,7 @@ def _(
     destination = id_to_path[destination_id] / name
     id_to_path[args.id].rename(destination)
     id_to_path[args.id] = destination
+    applied(args)
 
 
 @local_apply_operation.register(AddDir)
@@ -231,12 +643,15 @@ def _(
         local_tree: Tree,
         cloud_tree: Tree,
         id_to_path: MutableMapping[str, Path],
-        session: Session
+        session: Session,
+        transfers: TransferScheduler,
+        applied: Callable[[Operation], None]
 ) -> None:
     destination = id_to_path[args.parent_id] / args.name
     destination.mkdir()
     save_id_in_metadata(args.child_id, destination)
     id_to_path[args.child_id] = destination
+    applied(args)
 
 
 @local_apply_operation.register(DelDir)
@@ -245,10 +660,24 @@ def _(
         local_tree: Tree,
         cloud_tree: Tree,
         id_to_path: MutableMapping[str, Path],
-        session: Session
+        session: Session,
+        transfers: TransferScheduler,
+        applied: Callable[[Operation], None]
 ) -> None:
-    id_to_path[args.id].rmdir()
-    del id_to_path[args.id]
+    # Deletions inside this directory may have been pruned, but only known nodes are removed, so that anything
+    # unexpected inside makes it fail
+    def _remove(dir_id: str):
+        directory = local_tree.dirs[dir_id]
+        for child in directory.files:
+            id_to_path[child].unlink()
+            del id_to_path[child]
+        for child in directory.dirs:
+            _remove(child)
+        id_to_path[dir_id].rmdir()
+        del id_to_path[dir_id]
+
+    _remove(args.id)
+    applied(args)
 
 
 @local_apply_operation.register(RenameMoveDir)
@@ -257,7 +686,9 @@ def _(
         local_tree: Tree,
         cloud_tree: Tree,
         id_to_path: MutableMapping[str, Path],
-        session: Session
+        session: Session,
+        transfers: TransferScheduler,
+        applied: Callable[[Operation], None]
 ) -> None:
     directory = local_tree.dirs[args.id]
     destination_id = args.destination_id if args.destination_id is not None else directory.parent
@@ -276,6 +707,7 @@ def _(
             _migrate(child)
 
     _migrate(args.id)
+    applied(args)
 
 
 def cloud_apply_script(
@@ -283,13 +715,176 @@ def cloud_apply_script(
         id_to_path: Mapping[str, Path],
         local_tree: Tree,
         cloud_tree: Tree,
-        session: Session
+        session: Session,
+        done: AbstractSet[Tuple[ScriptType, int]] = frozenset(),
+        real_id: MutableMapping[str, str] = None,
+        copies: Mapping[str, str] = None,
+        priority: TransferPriority = None
 ):
-    real_id = {}
-    for index, line in enumerate(local_script):
-        logging.info('Applying to cloud state (' + str(index + 1) + '/' + str(len(local_script)) + ')')
-        line = cloud_apply_operation(line, cloud_tree, id_to_path, real_id, session)
-        basic_operation(line, cloud_tree)
+    """Apply the local changes to the cloud
+
+    Uploads too large for batches run concurrently, see TransferScheduler, while other operations are applied in
+    order after the uploads they depend on.
+
+    :param copies: Mapping from newly added nodes to cloud items with the same content, which are copied on the
+        server side instead of being uploaded, see find_cloud_copies. Copying is asynchronous, so the copies are
+        waited for concurrently after everything else is applied, as nothing else depends on the copied nodes
+    :param priority: Orders the uploads waiting for a thread
+    """
+    real_id = {} if real_id is None else real_id
+    copies = {} if copies is None else copies
+    priority = TransferPriority() if priority is None else priority
+    batch = BatchClient(session)
+    root_path = id_to_path[local_tree.root_id]
+
+    def _priority(line: Union[AddFile, ModifyFile]) -> Tuple:
+        path = id_to_path[line.child_id if isinstance(line, AddFile) else line.id]
+        return priority(path.relative_to(root_path), path.stat().st_size)
+
+    def _apply(index: int, line: Operation):
+        transfers.wait(_waited_resources(line, cloud_tree, real_id))
+        logging.info('Applying to cloud state (' + str(index + 1) + '/' + str(len(local_script)) + ', ' + str(
+            transfers.in_flight
+        ) + ' transfer(s) in flight)')
+        # Identifiers assigned by queued operations are only known after flushing
+        if any(is_temp_id(getattr(line, key, None)) and getattr(line, key) not in real_id for key in _RESOLVED_FIELDS):
+            batch.flush()
+
+        def _applied(operation: Operation):
+            basic_operation(operation, cloud_tree)
+            new_ids = {line.child_id: real_id[line.child_id]} if isinstance(line, (AddFile, AddDir)) else {}
+            with session_scope() as db_session:
+                checkpoint_journal(db_session, ScriptType.LOCAL, index, new_ids)
+
+        cloud_apply_operation(line, cloud_tree, id_to_path, real_id, batch, transfers, _applied)
+
+    # The root of the copied subtree which each node belongs to, and the operations creating each subtree
+    copied = {}
+    pending = defaultdict(list)
+    monitors = OrderedDict()
+    with ThreadPoolExecutor(max_workers=8) as executor, TransferScheduler(TRANSFER_WORKERS, _priority) as transfers:
+        for index, line in enumerate(local_script):
+            if isinstance(line, (AddFile, AddDir)) and (line.child_id in copies or line.parent_id in copied):
+                root = line.child_id if line.child_id in copies else copied[line.parent_id]
+                copied[line.child_id] = root
+                if (ScriptType.LOCAL, index) in done:
+                    continue
+                pending[root].append((index, line))
+                if root == line.child_id:
+                    batch.flush()
+                    logging.info('Copying ' + line.name + ' in the cloud (' + str(index + 1) + '/' + str(
+                        len(local_script)
+                    ) + ')')
+                    monitor = copy_item(session, copies[root], real_id.get(line.parent_id, line.parent_id), line.name)
+                    monitors[root] = executor.submit(wait_for_monitor, monitor)
+                continue
+            if (ScriptType.LOCAL, index) in done:
+                continue
+            _apply(index, line)
+        batch.flush()
+
+        for root, monitor in monitors.items():
+            try:
+                new_id = monitor.result()
+            except Exception as error:
+                logging.info('Failed to copy ' + str(id_to_path[root]) + ', uploading instead: ' + str(error))
+                _remove_partial_copy(pending[root][0][1], session, real_id)
+                for index, line in pending[root]:
+                    _apply(index, line)
+                batch.flush()
+            else:
+                _register_copy(pending[root], new_id, id_to_path, cloud_tree, session, real_id)
+
+
+def _remove_partial_copy(line: Union[AddFile, AddDir], session: Session, real_id: Mapping[str, str]):
+    # The failed copy may have created the item already, which would conflict with the upload. The name was free
+    # when planning, so the item is taken as the copy, and removed to the recycle bin
+    parent_id = real_id.get(line.parent_id, line.parent_id)
+    identifier = find_child(session, parent_id, line.name)
+    if identifier is not None:
+        logging.info('Removing the partial copy of ' + line.name)
+        remove_item(session, identifier)
+
+
+def _register_copy(
+        lines: Sequence[Tuple[int, Operation]],
+        new_id: str,
+        id_to_path: Mapping[str, Path],
+        cloud_tree: Tree,
+        session: Session,
+        real_id: MutableMapping[str, str]
+):
+    # Identifiers of the nodes inside the copy are found by listing the copied directories
+    children = {}
+    new_ids = {}
+    for position, (index, line) in enumerate(lines):
+        parent_id = real_id.get(line.parent_id, line.parent_id)
+        if position == 0:
+            item = get_item(session, new_id) if isinstance(line, AddFile) else None
+        else:
+            if parent_id not in children:
+                children[parent_id] = {child.name: child for child in list_children(session, parent_id)}
+            item = children[parent_id][line.name]
+        identifier = new_id if item is None else item.id
+        if isinstance(line, AddFile):
+            basic_operation(AddCloudFile(parent_id, identifier, line.name, line.size, item.eTag, item.cTag), cloud_tree)
+        else:
+            basic_operation(AddDir(parent_id, identifier, line.name), cloud_tree)
+        save_id_in_metadata(identifier, id_to_path[line.child_id])
+        real_id[line.child_id] = new_ids[line.child_id] = identifier
+    with session_scope() as db_session:
+        for index, line in lines:
+            checkpoint_journal(db_session, ScriptType.LOCAL, index, {line.child_id: new_ids[line.child_id]})
+
+
+def _upload_file(session: Session, parent_id: str, name: str, path: Path, identifier: str = None) -> CloudFile:
+    # The upload session is recorded, so that it is continued if the process is restarted before it finishes
+    with path.open('rb') as file:
+        stat = os.fstat(file.fileno())
+        if stat.st_size <= SIMPLE_UPLOAD_LIMIT:
+            if identifier is not None:
+                return upload_file_by_id(session, identifier, file)
+            return upload_file_by_parent(session, parent_id, name, file)
+        with session_scope() as db_session:
+            resume = load_upload_session(db_session, str(path), parent_id, name, stat)
+
+        def _progress(url: str, offset: int):
+            with session_scope() as db_session:
+                save_upload_session(db_session, str(path), parent_id, name, url, stat, offset)
+
+        if resume is not None:
+            logging.info('Resuming the upload of ' + str(path) + ' from byte ' + str(resume[1]))
+        new_file = upload_large_file_by_parent(
+            session, parent_id, name, file, stat.st_size, resume_url=resume[0] if resume is not None else None,
+            progress=_progress
+        )
+    with session_scope() as db_session:
+        remove_upload_session(db_session, str(path))
+    return new_file
+
+
+def _operation_resources(args: Operation, tree: Tree, real_id: Mapping[str, str]) -> Set[str]:
+    # Every dependency found by mark_dependencies involves a directory, either as the parent of both operations or as
+    # the node of one and the parent of the other, so that sharing items keeps the order in batches and transfers
+    resources = set()
+    for key in _ID_FIELDS:
+        value = getattr(args, key, None)
+        if value is not None:
+            resources.add(real_id.get(value, value))
+    node = tree.files.get(getattr(args, 'id', None)) or tree.dirs.get(getattr(args, 'id', None))
+    if node is not None:
+        resources.add(node.parent)
+    return resources
+
+
+def _waited_resources(args: Operation, tree: Tree, real_id: Mapping[str, str]) -> Set[str]:
+    # Transfers of different files never depend on each other, even in the same directory, while other operations are
+    # applied after the transfers sharing any resources
+    if isinstance(args, AddFile):
+        return {real_id.get(args.child_id, args.child_id)}
+    if isinstance(args, ModifyFile):
+        return {args.id}
+    return _operation_resources(args, tree, real_id)
 
 
 @singledispatch
@@ -298,8 +893,15 @@ def cloud_apply_operation(
         cloud_tree: Tree,
         id_to_path: Mapping[str, Path],
         real_id: MutableMapping[str, str],
-        session: Session
-) -> Operation:
+        batch: BatchClient,
+        transfers: TransferScheduler,
+        applied: Callable[[Operation], None]
+) -> None:
+    """Apply an operation to the cloud, either immediately or in a batch
+
+    :param applied: Called with the operation with real identifiers once applied, which may happen when @batch is
+        flushed
+    """
     raise NotImplementedError()
 
 
@@ -309,17 +911,27 @@ def _(
         cloud_tree: Tree,
         id_to_path: Mapping[str, Path],
         real_id: MutableMapping[str, str],
-        session: Session
-) -> Operation:
+        batch: BatchClient,
+        transfers: TransferScheduler,
+        applied: Callable[[Operation], None]
+) -> None:
     parent_id = real_id.get(args.parent_id, args.parent_id)
     path = id_to_path[args.child_id]
     if not _compare_size(path.stat().st_size, args.size):
         raise AssertionError()
-    with path.open('rb') as file:
-        new_file = upload_large_file_by_parent(session, parent_id, args.name, file, path.stat().st_size)
-    save_id_in_metadata(new_file.id, path)
-    real_id[args.child_id] = new_file.id
-    return AddCloudFile(parent_id, new_file.id, args.name, args.size, new_file.eTag, new_file.cTag)
+
+    def _uploaded(new_file: CloudFile):
+        save_id_in_metadata(new_file.id, path)
+        real_id[args.child_id] = new_file.id
+        applied(AddCloudFile(parent_id, new_file.id, args.name, args.size, new_file.eTag, new_file.cTag))
+
+    resources = _operation_resources(args, cloud_tree, real_id)
+    if path.stat().st_size <= BATCH_UPLOAD_LIMIT:
+        batch.upload_file_by_parent(parent_id, args.name, path.read_bytes(), resources=resources, tag=args,
+                                    callback=lambda response: _uploaded(file_from_item(response)))
+        return
+    batch.flush()
+    transfers.submit(lambda: _upload_file(batch.session, parent_id, args.name, path), resources, _uploaded, args)
 
 
 @cloud_apply_operation.register(DelFile)
@@ -328,10 +940,12 @@ def _(
         cloud_tree: Tree,
         id_to_path: Mapping[str, Path],
         real_id: MutableMapping[str, str],
-        session: Session
-) -> Operation:
-    remove_item(session, args.id)
-    return args
+        batch: BatchClient,
+        transfers: TransferScheduler,
+        applied: Callable[[Operation], None]
+) -> None:
+    batch.remove_item(args.id, resources=_operation_resources(args, cloud_tree, real_id), tag=args,
+                      callback=lambda response: applied(args))
 
 
 @cloud_apply_operation.register(ModifyFile)
@@ -340,28 +954,47 @@ def _(
         cloud_tree: Tree,
         id_to_path: Mapping[str, Path],
         real_id: MutableMapping[str, str],
-        session: Session
-) -> Operation:
+        batch: BatchClient,
+        transfers: TransferScheduler,
+        applied: Callable[[Operation], None]
+) -> None:
     orig_file = cloud_tree.files[args.id]
     path = id_to_path[args.id]
     if not _compare_size(path.stat().st_size, args.size):
         raise AssertionError()
-    with path.open('rb') as file:
-        new_file = upload_large_file_by_parent(session, orig_file.parent, orig_file.name, file, path.stat().st_size)
-    return ModifyCloudFile(args.id, args.size, new_file.eTag, new_file.cTag)
+
+    def _uploaded(new_file: CloudFile):
+        # The identifier may have been lost and recovered by matching, see _match_vanished_files
+        save_id_in_metadata(args.id, path)
+        applied(ModifyCloudFile(args.id, args.size, new_file.eTag, new_file.cTag))
+
+    resources = _operation_resources(args, cloud_tree, real_id)
+    if path.stat().st_size <= BATCH_UPLOAD_LIMIT:
+        batch.upload_file_by_id(args.id, path.read_bytes(), resources=resources, tag=args,
+                                callback=lambda response: _uploaded(file_from_item(response)))
+        return
+    batch.flush()
+    transfers.submit(lambda: _upload_file(batch.session, orig_file.parent, orig_file.name, path, args.id), resources,
+                     _uploaded, args)
 
 
 @cloud_apply_operation.register(RenameMoveFile)
+@cloud_apply_operation.register(RenameMoveDir)
 def _(
-        args: RenameMoveFile,
+        args: Union[RenameMoveFile, RenameMoveDir],
         cloud_tree: Tree,
         id_to_path: Mapping[str, Path],
         real_id: MutableMapping[str, str],
-        session: Session
-) -> Operation:
+        batch: BatchClient,
+        transfers: TransferScheduler,
+        applied: Callable[[Operation], None]
+) -> None:
     destination_id = real_id.get(args.destination_id, args.destination_id)
-    move_rename_item(session, args.id, destination_id=destination_id, name=args.name)
-    return RenameMoveFile(args.id, args.name, destination_id)
+    batch.move_rename_item(
+        args.id, destination_id=destination_id, name=args.name,
+        resources=_operation_resources(args, cloud_tree, real_id), tag=args,
+        callback=lambda response: applied(type(args)(args.id, args.name, destination_id))
+    )
 
 
 @cloud_apply_operation.register(AddDir)
@@ -370,35 +1003,30 @@ def _(
         cloud_tree: Tree,
         id_to_path: Mapping[str, Path],
         real_id: MutableMapping[str, str],
-        session: Session
-) -> Operation:
+        batch: BatchClient,
+        transfers: TransferScheduler,
+        applied: Callable[[Operation], None]
+) -> None:
     parent_id = real_id.get(args.parent_id, args.parent_id)
-    new_id = create_dir(session, parent_id, args.name)
-    save_id_in_metadata(new_id, id_to_path[args.child_id])
-    real_id[args.child_id] = new_id
-    return AddDir(parent_id, new_id, args.name)
 
+    def _created(response: Dict):
+        save_id_in_metadata(response['id'], id_to_path[args.child_id])
+        real_id[args.child_id] = response['id']
+        applied(AddDir(parent_id, response['id'], args.name))
 
-@cloud_apply_operation.register(DelDir)
-def _(
-        args: DelDir,
-        cloud_tree: Tree,
-        id_to_path: Mapping[str, Path],
-        real_id: MutableMapping[str, str],
-        session: Session
-) -> Operation:
-    remove_item(session, args.id)
-    return args
+    batch.create_dir(parent_id, args.name, resources=_operation_resources(args, cloud_tree, real_id), tag=args,
+                     callback=_created)
 
 
-@cloud_apply_operation.register(RenameMoveDir)
+@cloud_apply_operation.register(DelDir)
 def _(
-        args: RenameMoveDir,
+        args: DelDir,
         cloud_tree: Tree,
         id_to_path: Mapping[str, Path],
         real_id: MutableMapping[str, str],
-        session: Session
-) -> Operation:
-    destination_id = real_id.get(args.destination_id, args.destination_id)
-    move_rename_item(session, args.id, destination_id=destination_id, name=args.name)
-    return RenameMoveFile(args.id, args.name, destination_id)
+        batch: BatchClient,
+        transfers: TransferScheduler,
+        applied: Callable[[Operation], None]
+) -> None:
+    batch.remove_item(args.id, resources=_operation_resources(args, cloud_tree, real_id), tag=args,
+                      callback=lambda response: applied(args))
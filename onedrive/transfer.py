@@ -0,0 +1,386 @@
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import heapq
+import itertools
+import logging
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from pathlib import PurePath
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+# Fragments of upload sessions must be multiples of 320 KiB, and no more than 60 MiB
+UPLOAD_CHUNK_UNIT = 320 * 1024
+MAX_UPLOAD_CHUNK = 192 * UPLOAD_CHUNK_UNIT
+
+
+class ChunkSizer:
+    """Adapt the size of chunks to the measured throughput, so that sending each one takes about @target seconds
+
+    The size is always a multiple of @unit. It is at most doubled after a success, and halved after a failure.
+    """
+
+    def __init__(self, unit: int = UPLOAD_CHUNK_UNIT, maximum: int = MAX_UPLOAD_CHUNK, target: float = 2):
+        self._unit = unit
+        self._maximum = maximum
+        self._target = target
+        self.size = unit
+
+    def measure(self, length: int, elapsed: float) -> None:
+        ideal = length / max(elapsed, 1e-3) * self._target
+        size = min(int(ideal) // self._unit * self._unit, self.size * 2, self._maximum)
+        self.size = max(size, self._unit)
+
+    def failed(self) -> None:
+        self.size = max(self.size // 2 // self._unit * self._unit, self._unit)
+
+
+class Backoff:
+    """Exponential backoff with full jitter
+
+    After @attempts consecutive failures wait() raises the last error instead.
+    """
+
+    def __init__(self, base: float = 1, maximum: float = 60, attempts: int = 10):
+        self._base = base
+        self._maximum = maximum
+        self._attempts = attempts
+        self.failures = 0
+
+    def delay(self) -> float:
+        return random.uniform(0, min(self._base * 2 ** self.failures, self._maximum))
+
+    def wait(self, error: Exception, retry_after: Optional[float] = None) -> None:
+        """Sleep after a failure, at least for @retry_after seconds if the server asked for it"""
+        if self.failures >= self._attempts:
+            raise error
+        delay = self.delay()
+        self.failures += 1
+        time.sleep(max(delay, retry_after or 0))
+
+    def reset(self) -> None:
+        self.failures = 0
+
+
+class RequestGovernor:
+    """Admit requests from all threads, slowing down when the server throttles them
+
+    Requests are admitted at most @rate per second with bursts of @burst, from one token bucket shared by all
+    threads. At most a limit of them are in flight, which is adjusted by AIMD: the limit grows by one after about a
+    limit of successes, and is halved when a request is throttled, at most once for the requests admitted at the same
+    time. A throttled request with Retry-After also pauses every request until then.
+    """
+
+    def __init__(self, rate: float = 20, burst: int = 40, concurrency: int = 8, maximum: int = 32):
+        self._rate = rate
+        self._burst = burst
+        self._maximum = maximum
+        self._condition = threading.Condition()
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._limit = float(concurrency)
+        self._active = 0
+        self._paused_until = 0.0
+        self._decreased_at = 0.0
+        self.throttled_requests = 0
+        self.throttled_time = 0.0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def acquire(self) -> Tuple[float, float]:
+        """Wait until a request can be sent
+
+        :return: The time when the request is admitted, to be passed to release(), and the seconds waited for it
+        """
+        begin = None
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._tokens + (now - self._updated) * self._rate, self._burst)
+                self._updated = now
+                if now < self._paused_until:
+                    timeout = self._paused_until - now
+                elif self._active >= int(self._limit):
+                    timeout = None
+                elif self._tokens < 1:
+                    timeout = (1 - self._tokens) / self._rate
+                else:
+                    self._tokens -= 1
+                    self._active += 1
+                    return now, now - begin if begin is not None else 0.0
+                begin = now if begin is None else begin
+                self._condition.wait(timeout)
+
+    def release(self, admitted: float, status: int = None, retry_after: float = None):
+        """Finish a request admitted at @admitted, with the status of its response if any"""
+        with self._condition:
+            self._active -= 1
+            if status in (429, 503):
+                now = time.monotonic()
+                if admitted >= self._decreased_at:
+                    self._limit = max(self._limit / 2, 1)
+                    self._decreased_at = now
+                if retry_after is not None:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+            elif status is not None:
+                self._limit = min(self._limit + 1 / self._limit, self._maximum)
+            self._condition.notify_all()
+
+    def record(self, throttled: float):
+        """Account a request which waited for @throttled seconds in total, in admission and retries"""
+        if throttled > 0:
+            with self._condition:
+                self.throttled_requests += 1
+                self.throttled_time += throttled
+
+
+def parse_ranges(ranges: Iterable[str]) -> List[Tuple[int, Optional[int]]]:
+    """Parse ranges like '0-1023' or '1024-' used by upload sessions, where the ends are inclusive"""
+    result = []
+    for value in ranges:
+        begin, _, end = value.partition('-')
+        result.append((int(begin), int(end) if end else None))
+    return sorted(result)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header in seconds, the HTTP date format is not used by OneDrive"""
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def missing_ranges(total: int, done: Iterable[Tuple[int, int]], part_size: int) -> List[Tuple[int, int]]:
+    """Split the bytes in [0, @total) not covered by the ranges in @done into ranges of at most @part_size bytes
+
+    Ranges here include the beginnings but not the ends.
+    """
+    result = []
+    offset = 0
+    for begin, end in sorted(done) + [(total, total)]:
+        for part in range(offset, min(begin, total), part_size):
+            result.append((part, min(part + part_size, begin, total)))
+        offset = max(offset, end)
+    return result
+
+
+class TransferScheduler:
+    """Run transfers in a thread pool, while other operations are applied in order by the calling thread
+
+    A transfer holds its resources, usually the identifiers of the affected items and their parents, until it
+    finishes, and wait() blocks until the transfers holding any of the given resources finish, so that operations
+    depending on transfers are still applied after them. Only the transfers themselves run in the pool, while their
+    callbacks are run by the calling thread, so that the state updated by them is never shared between threads.
+
+    Transfers waiting for a free thread are started in the order of their priorities, lowest first, and then in the
+    order of submission. The priority of a transfer is given by @priority from the tag given when submitting.
+    """
+
+    def __init__(self, workers: int, priority: Callable[[Any], Any] = None):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._priority = priority
+        self._running = {}  # type: Dict[Future, Tuple[Set[Any], Optional[Callable[[Any], None]]]]
+        self._queue = []  # type: List[Tuple[Any, int, Callable[[], Any], Future]]
+        self._queue_lock = threading.Lock()
+        self._counter = itertools.count()
+
+    def __enter__(self) -> 'TransferScheduler':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._finish(list(self._running))
+        finally:
+            # After an error, the transfers already started are still called back, so that their results are not lost
+            for future in self._running:
+                future.cancel()
+            for future, (_, callback) in list(self._running.items()):
+                del self._running[future]
+                try:
+                    if not future.cancelled() and callback is not None:
+                        callback(future.result())
+                except Exception as error:
+                    logging.info('Transfer failed: ' + str(error))
+            self._executor.shutdown()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._running)
+
+    def submit(self, work: Callable[[], Any], resources: Iterable[Any],
+               callback: Callable[[Any], None] = None, tag: Any = None):
+        """Run @work in the pool holding @resources, and call back with its result"""
+        future = Future()
+        priority = self._priority(tag) if self._priority is not None else ()
+        with self._queue_lock:
+            heapq.heappush(self._queue, (priority, next(self._counter), work, future))
+        self._running[future] = (set(resources), callback)
+        # Each task runs whichever queued transfer comes first when a thread is free
+        self._executor.submit(self._run_next)
+
+    def _run_next(self):
+        with self._queue_lock:
+            _, _, work, future = heapq.heappop(self._queue)
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(work())
+        except BaseException as error:
+            future.set_exception(error)
+
+    def wait(self, resources: Iterable[Any]):
+        """Finish the transfers holding any of @resources, and the others which have finished by then"""
+        resources = set(resources)
+        self._finish([future for future, (held, _) in self._running.items() if held & resources])
+
+    def collect(self):
+        """Call back the finished transfers without blocking"""
+        self._finish([])
+
+    def _finish(self, futures: List[Future]):
+        # Errors of transfers are raised here, leaving the others running until __exit__
+        pending = set(futures)
+        while True:
+            for future in [future for future in self._running if future.done()]:
+                pending.discard(future)
+                _, callback = self._running.pop(future)
+                result = future.result()
+                if callback is not None:
+                    callback(result)
+            if not pending:
+                return
+            wait(pending, return_when=FIRST_COMPLETED)
+
+
+# Rates are in bytes per second, optionally in KiB, MiB or GiB
+_RATE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(value: str) -> Optional[int]:
+    """Parse a rate like '512K' or '2.5M', where 'unlimited' means no limit"""
+    value = value.strip().upper()
+    if value == 'UNLIMITED':
+        return None
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([KMG]?)(?:I?B)?(?:/S)?', value)
+    if match is None or float(match.group(1)) <= 0:
+        raise ValueError('Invalid rate: ' + value)
+    return int(float(match.group(1)) * _RATE_UNITS[match.group(2)])
+
+
+class BandwidthSchedule:
+    """Rates limiting the bandwidth at each time of day
+
+    A schedule is written like '08:00-18:00=512K,22:00-06:00=unlimited,2M', where the first period containing the
+    time decides the rate, and the rate without a period applies to the rest of the day. Periods may span midnight.
+    """
+
+    def __init__(self, periods: Sequence[Tuple[datetime.time, datetime.time, Optional[int]]] = (),
+                 default: Optional[int] = None):
+        self.periods = list(periods)
+        self.default = default
+
+    @staticmethod
+    def parse(text: str) -> 'BandwidthSchedule':
+        periods = []
+        default = None
+        for entry in filter(None, (entry.strip() for entry in text.split(','))):
+            period, _, rate = entry.rpartition('=')
+            if not period:
+                default = parse_rate(rate)
+                continue
+            begin, _, end = period.partition('-')
+            try:
+                begin, end = (datetime.datetime.strptime(value.strip(), '%H:%M').time() for value in (begin, end))
+            except ValueError:
+                raise ValueError('Invalid period: ' + period)
+            periods.append((begin, end, parse_rate(rate)))
+        return BandwidthSchedule(periods, default)
+
+    def rate_at(self, moment: datetime.time) -> Optional[int]:
+        for begin, end, rate in self.periods:
+            if (begin <= moment < end) if begin <= end else (moment >= begin or moment < end):
+                return rate
+        return self.default
+
+
+class BandwidthLimiter:
+    """Limit the bytes transferred by all threads per second to the current rate of a schedule
+
+    Transfers may consume more than available, which is paid back by waiting, so that a large chunk is still sent as a
+    whole while the average rate is kept.
+    """
+
+    def __init__(self, schedule: BandwidthSchedule = None):
+        self.schedule = BandwidthSchedule() if schedule is None else schedule
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+
+    @property
+    def rate(self) -> Optional[int]:
+        return self.schedule.rate_at(datetime.datetime.now().time())
+
+    def consume(self, length: int):
+        """Wait until @length bytes can be transferred"""
+        with self._lock:
+            now = time.monotonic()
+            rate = self.rate
+            if rate is None:
+                self._tokens = 0.0
+                self._updated = now
+                return
+            # Bursts are at most as large as a second of the rate
+            self._tokens = min(self._tokens + (now - self._updated) * rate, rate) - length
+            self._updated = now
+            delay = -self._tokens / rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class TransferPriority:
+    """Order transfers by rules, which are applied in order until one of them tells two transfers apart
+
+    Rules are 'paths' for transfers of the listed paths or inside them first, and 'small-first' or 'large-first' by
+    the sizes of the files. Files of unknown sizes come after the others.
+    """
+
+    RULES = ('paths', 'small-first', 'large-first')
+
+    def __init__(self, rules: Sequence[str] = (), paths: Iterable[str] = ()):
+        for rule in rules:
+            if rule not in self.RULES:
+                raise ValueError('Unknown priority rule: ' + rule)
+        self.rules = list(rules)
+        self.paths = {PurePath(path) for path in paths}
+
+    def __call__(self, path: PurePath, size: Optional[int]) -> Tuple:
+        """The priority of transferring the file at @path relative to the root, lower first"""
+        key = []
+        for rule in self.rules:
+            if rule == 'paths':
+                key.append(0 if path in self.paths or not self.paths.isdisjoint(path.parents) else 1)
+            elif size is None:
+                key.append((1, 0))
+            else:
+                key.append((0, size if rule == 'small-first' else -size))
+        return tuple(key)
@@ -0,0 +1,213 @@
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import socket
+import ssl
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers, select_proxy, urlparse, DEFAULT_CA_BUNDLE_PATH
+
+
+class HTTPXAdapter(BaseAdapter):
+    """Send requests through an httpx client, multiplexed over HTTP/2 connections when the server supports it
+
+    Unless @client is given, one client for each TLS and proxy setting of requests is shared by every adapter, so that
+    all threads share the same connections. A given @client keeps its own settings, so requests needing other ones are
+    rejected. Options of connection pools for HTTPAdapter are accepted but ignored, as the pool of the client is shared.
+    """
+
+    _shared_clients = {}  # type: Dict[Tuple, Any]
+    _shared_lock = threading.Lock()
+
+    def __init__(self, client: Any = None, **kwargs):
+        super().__init__()
+        self._client = client
+
+    @staticmethod
+    def create_client(http1: bool = True, http2: bool = True, verify: Union[bool, str] = True, cert: Any = None,
+                      proxy: str = None) -> Any:
+        """Create an httpx client suitable for many threads
+
+        Streams of threads multiplexed over one connection are written as small frames, which would be held back by
+        Nagle's algorithm until earlier ones are acknowledged, so it is disabled as urllib3 does. Idle connections are
+        kept for every thread when they fall back to HTTP/1.1, instead of closing those beyond the default of 20.
+
+        :param verify: Whether certificates of servers are verified, or the CA bundle verifying them, as in requests
+        :param cert: The client certificate, or the certificate and its key, as in requests
+        :param proxy: The URL of the proxy which every request is sent through
+        """
+        try:
+            import httpx
+        except ImportError:
+            raise Exception('The httpx transport needs httpx with HTTP/2 support: pip install httpx[http2]')
+        return httpx.Client(transport=httpx.HTTPTransport(
+            verify=_ssl_context(verify, cert), http1=http1, http2=http2,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=100),
+            proxy=httpx.Proxy(proxy) if proxy is not None else None,
+            socket_options=[(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+        ), timeout=None)
+
+    @classmethod
+    def shared_client(cls, verify: Union[bool, str] = True, cert: Any = None, proxy: str = None) -> Any:
+        settings = verify, cert, proxy
+        with cls._shared_lock:
+            if settings not in cls._shared_clients:
+                cls._shared_clients[settings] = cls.create_client(verify=verify, cert=cert, proxy=proxy)
+            return cls._shared_clients[settings]
+
+    def client(self, verify: Union[bool, str] = True, cert: Any = None, proxy: str = None) -> Any:
+        """The client sending requests with the TLS and proxy settings of requests"""
+        if self._client is None:
+            return self.shared_client(verify, cert, proxy)
+        if (verify, cert, proxy) != (True, None, None):
+            raise Exception('The given httpx client cannot send requests with other TLS or proxy settings')
+        return self._client
+
+    def send(self, request: requests.PreparedRequest, stream: bool = False, timeout: Any = None, verify: bool = True,
+             cert: Any = None, proxies: Dict = None) -> requests.Response:
+        import httpx
+        # Certificates are only used by HTTPS, and the proxy is selected by the scheme and host as HTTPAdapter does
+        if urlparse(request.url).scheme != 'https':
+            verify, cert = True, None
+        cert = tuple(cert) if isinstance(cert, list) else cert
+        client = self.client(verify, cert, select_proxy(request.url, proxies))
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        body = request.body
+        if isinstance(body, memoryview):
+            body = body.tobytes()
+        elif hasattr(body, 'read'):
+            file = body
+            body = iter(lambda: file.read(64 * 1024), b'')
+        try:
+            # Headers of connections are managed by httpx, and are forbidden in HTTP/2
+            headers = {key: value for key, value in request.headers.items() if key.lower() not in _HOP_HEADERS}
+            response = client.send(client.build_request(
+                request.method, request.url, headers=headers, content=body, timeout=timeout
+            ), stream=True)
+        except httpx.TimeoutException as error:
+            raise requests.exceptions.Timeout(error, request=request)
+        except httpx.HTTPError as error:
+            raise requests.exceptions.ConnectionError(error, request=request)
+
+        result = requests.Response()
+        result.status_code = response.status_code
+        result.headers = CaseInsensitiveDict(response.headers.multi_items())
+        result.encoding = get_encoding_from_headers(result.headers)
+        result.reason = response.reason_phrase
+        result.url = request.url
+        result.request = request
+        result.connection = self
+        result.raw = _HTTPXStream(response)
+        if not stream:
+            try:
+                result.content
+            finally:
+                response.close()
+        return result
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+
+
+_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade'}
+
+
+def _ssl_context(verify: Union[bool, str], cert: Any) -> Union[bool, ssl.SSLContext]:
+    # Versions of httpx differ in how they take CA bundles and client certificates, but all take contexts
+    if verify is True and cert is None:
+        return True
+    if verify is False:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif verify is True:
+        context = ssl.create_default_context(cafile=DEFAULT_CA_BUNDLE_PATH)
+    elif os.path.isdir(verify):
+        context = ssl.create_default_context(capath=verify)
+    else:
+        context = ssl.create_default_context(cafile=verify)
+    if isinstance(cert, str):
+        context.load_cert_chain(cert)
+    elif cert is not None:
+        context.load_cert_chain(*cert)
+    return context
+
+
+@contextmanager
+def _translate_errors():
+    import httpx
+    try:
+        yield
+    except httpx.TimeoutException as error:
+        raise requests.exceptions.ConnectionError(error)
+    except httpx.HTTPError as error:
+        raise requests.exceptions.ChunkedEncodingError(error)
+
+
+class _HTTPXStream:
+    """The body of a response of httpx, read like the one of urllib3 by responses of requests"""
+
+    def __init__(self, response: Any):
+        self._response = response
+        self._chunks = None  # type: Optional[Iterator[bytes]]
+        self._buffer = b''
+
+    def _iterate(self, chunk_size: Optional[int] = None) -> Iterator[bytes]:
+        # Decoded chunks of the body, which are continued by later reads
+        if self._chunks is None:
+            self._chunks = self._response.iter_bytes(chunk_size)
+        return self._chunks
+
+    def stream(self, chunk_size: Optional[int] = None, decode_content: bool = True) -> Iterator[bytes]:
+        if self._buffer:
+            yield self._buffer
+            self._buffer = b''
+        with _translate_errors():
+            yield from self._iterate(chunk_size)
+
+    def read(self, amt: int = None, decode_content: bool = True) -> bytes:
+        data = self._buffer
+        with _translate_errors():
+            for chunk in self._iterate():
+                data += chunk
+                if amt is not None and len(data) >= amt:
+                    break
+        self._buffer = data[amt:] if amt is not None else b''
+        return data[:amt] if amt is not None else data
+
+    def close(self):
+        self._response.close()
+
+
+# Transports are adapters of requests, so that connections can be managed by other libraries while sessions, responses
+# and exceptions are still the ones of requests
+TRANSPORTS = {
+    'requests': HTTPAdapter,
+    'httpx': HTTPXAdapter
+}
+
+
+def create_transport(**kwargs) -> BaseAdapter:
+    """Create the adapter of the configured transport, passing options of connection pools to it"""
+    from .database import CONFIG
+    return TRANSPORTS[getattr(CONFIG, 'transport', 'requests')](**kwargs)
@@ -33,8 +33,11 @@ def get_git_tag():
 setup(
     name='onedrive-sync-client',
     version=get_git_tag(),
-    packages=find_packages(exclude=["*.tests", "*.tests.*", "tests.*", "tests"]),
+    packages=find_packages(exclude=["*.tests", "*.tests.*", "tests.*", "tests", "benchmarks.*", "benchmarks"]),
     install_requires=Path('requirements.txt').read_text(),
+    extras_require={
+        'http2': ['httpx[http2]']
+    },
     author='XU Guang-zhao',
     description='OneDrive Client with Two-way Synchronizing Feature',
     license='AGPL-3.0-only',
@@ -12,3 +12,13 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import atexit
+import os
+import shutil
+import tempfile
+
+# Tests using the database must never touch the one of the user, so a temporary one is used before it is opened
+_DATABASE_DIR = tempfile.mkdtemp()
+os.environ['ONEDRIVE_CONFIG_PATH'] = os.path.join(_DATABASE_DIR, 'onedrive.sqlite')
+atexit.register(shutil.rmtree, _DATABASE_DIR, ignore_errors=True)
@@ -14,10 +14,21 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import copy
+import hashlib
+import tempfile
 import unittest
+import zlib
+from pathlib import Path
+from unittest import mock
 
-from onedrive.model import Tree, basic_operation, AddFile, File, Directory
+from onedrive.model import Tree, basic_operation, AddFile, File, Directory, CloudFile, LocalFile
+from onedrive.model import DelFile, ModifyFile, RenameMoveFile, AddDir, DelDir, RenameMoveDir
 from onedrive.algorithms import mark_dependencies, get_change_set, check_same_node_operations
+from onedrive.algorithms import topological_layers, topological_sort, field_test
+from onedrive.algorithms import optimize_scripts, drop_common_operations, prune_deletions
+from onedrive.algorithms import hash_file, hash_files, compare_file_by_hashes, HashCache, drop_unchanged_content
+from onedrive.algorithms import find_cloud_copies, find_local_sources
 
 
 class TestAlgorithm(unittest.TestCase):
@@ -59,6 +70,230 @@ class TestAlgorithm(unittest.TestCase):
     def test_change_set(self):
         self.assertTrue(get_change_set(self.tree, self.tree, lambda before, after: before.size == after.size) == set())
 
+    def test_change_set_by_digest(self):
+        after = copy.deepcopy(self.tree)
+        after.digest(after.root_id)
+        for operation in [
+            RenameMoveFile('14', 'File 26', '7'),
+            DelFile('25'),
+            DelDir('6'),
+            AddDir('2', '8', 'Folder 8'),
+            AddFile('8', '26', 'File 26', 0),
+            RenameMoveDir('5', None, '8')
+        ]:
+            basic_operation(operation, after)
+        self.assertFalse(after.equals(self.tree))
+
+        def comparison(before, after):
+            return True
+
+        change_set = get_change_set(self.tree, after, comparison)
+        self.assertEqual(get_change_set(self.tree, after, comparison, by_digest=True), change_set)
+        self.assertEqual(len(change_set), 6)
+        self.assertEqual(get_change_set(after, after, comparison, by_digest=True), set())
+
+    def test_topological_layers(self):
+        after = copy.deepcopy(self.tree)
+        for operation in [
+            AddDir('0', '8', 'Folder 8'),
+            AddDir('8', '9', 'Folder 9'),
+            AddFile('9', '26', 'File 26', 0),
+            RenameMoveFile('11', 'File 12', '9'),
+            RenameMoveFile('12', 'File 27', None),
+            DelFile('25'),
+            DelDir('6')
+        ]:
+            basic_operation(operation, after)
+
+        change_set = get_change_set(self.tree, after, lambda before, after: True)
+        dependencies = mark_dependencies(self.tree, change_set)
+        layers = topological_layers(change_set, dependencies)
+        self.assertEqual(sum(len(layer) for layer in layers), len(change_set))
+        layer_of = {operation: index for index, layer in enumerate(layers) for operation in layer}
+        for consumer, producer in dependencies:
+            self.assertLess(layer_of[producer], layer_of[consumer])
+        self.assertEqual(len(layers), 3)
+        self.assertTrue(field_test(self.tree, topological_sort(change_set, dependencies)).equals(after))
+
+        swap = {RenameMoveFile('11', 'File 12', None), RenameMoveFile('12', 'File 11', None)}
+        with self.assertRaises(Exception):
+            topological_sort(swap, mark_dependencies(self.tree, swap))
+
+    def test_optimize_scripts(self):
+        cloud_script = [
+            DelFile('17'),
+            RenameMoveFile('18', 'File 28', '3'),
+            DelFile('23'),
+            DelDir('7'),
+            DelDir('5')
+        ]
+        local_script = [
+            DelFile('17'),
+            DelFile('24'),
+            DelFile('14'),
+            DelDir('5')
+        ]
+        check_same_node_operations(set(cloud_script), set(local_script))
+        cloud_script, local_script, saved = optimize_scripts(
+            self.tree, cloud_script, self.tree, local_script,
+            [drop_common_operations, prune_deletions]
+        )
+        self.assertEqual(cloud_script, [RenameMoveFile('18', 'File 28', '3'), DelFile('23'), DelDir('7')])
+        self.assertEqual(local_script, [DelFile('24'), DelFile('14')])
+        self.assertEqual(dict(saved), {'drop_common_operations': 4, 'prune_deletions': 0})
+
+        cloud_script, local_script, saved = optimize_scripts(
+            self.tree, [DelFile('23'), DelDir('7'), DelDir('5')], self.tree, [], [prune_deletions]
+        )
+        self.assertEqual(cloud_script, [DelDir('5')])
+        self.assertEqual(dict(saved), {'prune_deletions': 2})
+
+    def test_hashes(self):
+        content = bytes(range(256)) * 10000
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'file'
+            path.write_bytes(content)
+            hashes = {
+                'sha1Hash': hashlib.sha1(content).hexdigest(),
+                'crc32Hash': zlib.crc32(content).to_bytes(4, 'little').hex(),
+                'unknownHash': 'whatever'
+            }
+            self.assertEqual(hash_file(path, hashes, chunk_size=1000), {
+                'sha1Hash': hashes['sha1Hash'].upper(),
+                'crc32Hash': hashes['crc32Hash'].upper()
+            })
+
+            local_tree = Tree('0')
+            local_tree.files['1'] = LocalFile('1', 'file', '0')
+            cloud_tree = Tree('0')
+            cloud_tree.files['1'] = CloudFile('1', 'file', '0', hashes=hashes)
+            for comparison in [
+                compare_file_by_hashes({'1': path}),
+                compare_file_by_hashes({'1': path}, before=local_tree, after=cloud_tree)
+            ]:
+                self.assertTrue(comparison(local_tree.files['1'], cloud_tree.files['1']))
+            path.write_bytes(content[1:])
+            self.assertFalse(compare_file_by_hashes({'1': path})(local_tree.files['1'], cloud_tree.files['1']))
+
+    def test_hash_cache(self):
+        class DictHashCache(HashCache):
+            def __init__(self):
+                self.entries = {}
+
+            def get(self, stat, algorithms):
+                hashes = self.entries.get((stat.st_ino, stat.st_mtime_ns), {})
+                return hashes if all(algorithm in hashes for algorithm in algorithms) else None
+
+            def put(self, stat, hashes):
+                self.entries[stat.st_ino, stat.st_mtime_ns] = dict(hashes)
+
+        cache = DictHashCache()
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'file'
+            path.write_bytes(b'content')
+            expected = hash_file(path, ['sha1Hash'])
+            self.assertEqual(hash_file(path, ['sha1Hash'], cache=cache), expected)
+            self.assertEqual(len(cache.entries), 1)
+            cache.entries[next(iter(cache.entries))]['sha1Hash'] = 'CACHED'
+            self.assertEqual(hash_file(path, ['sha1Hash'], cache=cache), {'sha1Hash': 'CACHED'})
+
+    def test_drop_unchanged_content(self):
+        with tempfile.TemporaryDirectory() as directory:
+            local_tree = Tree('0')
+            cloud_tree = Tree('0')
+            id_to_path = {}
+            for identifier, local_content, cloud_content in [('1', b'same', b'same'), ('2', b'new', b'old')]:
+                id_to_path[identifier] = Path(directory) / identifier
+                id_to_path[identifier].write_bytes(local_content)
+                local_tree.files[identifier] = LocalFile(identifier, identifier, '0', size=len(local_content))
+                cloud_tree.files[identifier] = CloudFile(identifier, identifier, '0', size=len(cloud_content), hashes={
+                    'sha1Hash': hashlib.sha1(cloud_content).hexdigest()
+                })
+            # Without any supported hash, the file is considered modified
+            id_to_path['3'] = Path(directory) / '3'
+            id_to_path['3'].write_bytes(b'same')
+            local_tree.files['3'] = LocalFile('3', '3', '0', size=4)
+            cloud_tree.files['3'] = CloudFile('3', '3', '0', size=4, hashes={'unknownHash': 'whatever'})
+
+            cloud_changes = {ModifyFile('1', 4), ModifyFile('3', 4), RenameMoveFile('1', 'renamed', None)}
+            local_changes = {ModifyFile('1', 4), ModifyFile('2', 3)}
+            self.assertEqual(drop_unchanged_content(
+                [cloud_changes, local_changes], local_tree, cloud_tree, id_to_path
+            ), [{ModifyFile('3', 4), RenameMoveFile('1', 'renamed', None)}, {ModifyFile('2', 3)}])
+
+    def test_find_cloud_copies(self):
+        cloud_tree = Tree('0')
+        cloud_tree.dirs['a'] = Directory('a', 'a', '0')
+        for identifier, content in [('x', b'x'), ('y', b'y')]:
+            cloud_tree.files[identifier] = CloudFile(identifier, identifier, 'a', size=1, hashes={
+                'sha1Hash': hashlib.sha1(content).hexdigest()
+            })
+        cloud_tree.reconstruct_by_parents()
+
+        with tempfile.TemporaryDirectory() as directory:
+            local_tree = Tree('0')
+            id_to_path = {}
+            local_script = [AddDir('0', '\0d', 'b')]
+            for identifier, name, parent_id, content in [
+                ('\0f1', 'x', '\0d', b'x'), ('\0f2', 'y', '\0d', b'y'),
+                ('\0f3', 'z', '0', b'x'), ('\0f4', 'w', '0', b'w')
+            ]:
+                id_to_path[identifier] = Path(directory) / identifier[1:]
+                id_to_path[identifier].write_bytes(content)
+                local_tree.files[identifier] = LocalFile(identifier, name, parent_id, 1)
+                local_script.append(AddFile(parent_id, identifier, name, 1))
+            local_tree.dirs['a'] = Directory('a', 'a', '0')
+            local_tree.dirs['\0d'] = Directory('\0d', 'b', '0')
+            local_tree.reconstruct_by_parents()
+
+            self.assertEqual(find_cloud_copies(local_script, local_tree, cloud_tree, id_to_path), {
+                '\0d': 'a',
+                '\0f3': 'x'
+            })
+            # Directories changed by the script cannot be sources, but the files unchanged inside can
+            self.assertEqual(find_cloud_copies(local_script + [DelFile('y')], local_tree, cloud_tree, id_to_path), {
+                '\0f1': 'x',
+                '\0f3': 'x'
+            })
+            # Nothing can be copied without any strong hash
+            for file in cloud_tree.files.values():
+                file.hashes = {'crc32Hash': '00000000'}
+            self.assertEqual(find_cloud_copies(local_script, local_tree, cloud_tree, id_to_path), {})
+
+    def test_find_local_sources(self):
+        with tempfile.TemporaryDirectory() as directory:
+            local_tree = Tree('0')
+            id_to_path = {}
+            for identifier, content in [('1', b'one'), ('2', b'two'), ('3', b'six'), ('8', b'eight')]:
+                id_to_path[identifier] = Path(directory) / identifier
+                id_to_path[identifier].write_bytes(content)
+                local_tree.files[identifier] = LocalFile(identifier, identifier, '0', len(content))
+            local_tree.reconstruct_by_parents()
+
+            cloud_tree = Tree('0')
+            cloud_script = []
+            for identifier, content in [('4', b'one'), ('5', b'two'), ('6', b'one'), ('7', b'ten'), ('9', b'one')]:
+                cloud_tree.files[identifier] = CloudFile(identifier, identifier, '0', size=3, hashes={
+                    'sha1Hash': hashlib.sha1(content).hexdigest().lower()
+                })
+                cloud_script.append(AddFile('0', identifier, identifier, 3))
+            cloud_tree.files['2'] = CloudFile('2', '2', '0', size=3)
+            cloud_tree.reconstruct_by_parents()
+            # Sizes in trees are always 0, so the ones reported by the cloud are used, and the unknown one is skipped
+            sizes = {'4': 3, '5': 3, '6': 3, '7': 3}
+
+            with mock.patch('onedrive.algorithms.hash_files', wraps=hash_files) as spy:
+                self.assertEqual(find_local_sources(cloud_script, local_tree, cloud_tree, id_to_path, sizes), {
+                    '4': '1', '5': '2', '6': '1'
+                })
+            # Local files of other sizes are never read
+            self.assertEqual(set(spy.call_args[0][0]), {'1', '2', '3'})
+            # Sources are never the files modified in the same script
+            cloud_script.append(ModifyFile('2', 3))
+            self.assertEqual(find_local_sources(cloud_script, local_tree, cloud_tree, id_to_path, sizes), {
+                '4': '1', '6': '1'
+            })
+
     def test_same_node(self):
         try:
             check_same_node_operations(set(), set())
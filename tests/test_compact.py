@@ -0,0 +1,71 @@
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import copy
+import unittest
+
+from onedrive.compact import CompactTree
+from onedrive.model import Tree, CloudFile, Directory, basic_operation
+from onedrive.model import AddCloudFile, DelFile, ModifyCloudFile, RenameMoveFile
+
+
+class TestCompactTree(unittest.TestCase):
+    def setUp(self):
+        self.trees = Tree('0'), CompactTree('0')
+        for tree in self.trees:
+            for file in [
+                CloudFile('11', 'File 11', '0', 0, 'e11', 'c11', {'sha1Hash': 'AA', 'quickXorHash': 'AA=='}),
+                CloudFile('12', 'File 12', '1', 0, 'e12', 'c12', {}),
+                CloudFile('13', 'File 13', '2', 0, 'e13', None, {})
+            ]:
+                tree.files[file.id] = file
+            for directory in [
+                Directory('1', 'Folder 1', '0'),
+                Directory('2', 'Folder 2', '1')
+            ]:
+                tree.dirs[directory.id] = directory
+            tree.reconstruct_by_parents()
+
+    def test_attributes(self):
+        tree, compact = self.trees
+        for identifier, file in tree.files.items():
+            compact_file = compact.files[identifier]
+            self.assertIsInstance(compact_file, CloudFile)
+            for attribute in ['id', 'name', 'parent', 'size', 'eTag', 'cTag', 'hashes']:
+                self.assertEqual(getattr(file, attribute), getattr(compact_file, attribute))
+        self.assertTrue(compact.equals(tree))
+
+    def test_operations(self):
+        for tree in self.trees:
+            for operation in [
+                AddCloudFile('2', '14', 'File 14', 0, 'e14', 'c14'),
+                ModifyCloudFile('11', 0, 'e11-longer', 'c'),
+                RenameMoveFile('12', 'File 15', '2'),
+                DelFile('13'),
+                AddCloudFile('0', '16', 'File 16', 0, 'e16', 'c16')
+            ]:
+                basic_operation(operation, tree)
+        tree, compact = self.trees
+        self.assertTrue(compact.equals(tree))
+        self.assertEqual(compact.files['11'].eTag, 'e11-longer')
+        self.assertEqual(compact.files['11'].cTag, 'c')
+        self.assertEqual(compact.files['16'].cTag, 'c16')
+        self.assertEqual(compact.dirs['2'].files, {'12', '14'})
+        self.assertEqual(copy.deepcopy(compact).files['12'].name, 'File 15')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Mapping
+from unittest import mock
+
+from onedrive.algorithms import hash_file, HashCache
+from onedrive.local import get_local_tree, is_temp_id
+from onedrive.model import Tree, CloudFile, File
+
+
+class TestLocal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        patcher = mock.patch('onedrive.local.CONFIG', mock.Mock(root_id='R'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+
+    def _local_ids(self, cloud_tree: Tree, saved_tree: Tree, sizes: Mapping[str, int] = None, cache: HashCache = None):
+        tree, id_to_path = get_local_tree(self.path, cloud_tree, saved_tree, {} if sizes is None else sizes, cache)
+        return {file.name: file_id for file_id, file in tree.files.items()}
+
+    def test_match_by_name(self):
+        # Replaced by an editor, the file has lost its saved identifier but keeps its name
+        (self.path / 'a.txt').write_bytes(b'edited')
+        saved_tree = Tree('R')
+        saved_tree.files['F'] = File('F', 'a.txt', 'R')
+        saved_tree.reconstruct_by_parents()
+        cloud_tree = Tree('R')
+        cloud_tree.files['F'] = CloudFile('F', 'a.txt', 'R', hashes={'sha1Hash': hashlib.sha1(b'old').hexdigest()})
+        cloud_tree.reconstruct_by_parents()
+        self.assertEqual(self._local_ids(cloud_tree, saved_tree), {'a.txt': 'F'})
+
+        # Files removed from the cloud since the last synchronization are not candidates
+        self.assertTrue(is_temp_id(self._local_ids(Tree('R'), saved_tree)['a.txt']))
+
+    def test_match_by_hashes(self):
+        (self.path / 'renamed.txt').write_bytes(b'content')
+        (self.path / 'other.txt').write_bytes(b'other')
+        saved_tree = Tree('R')
+        saved_tree.files['F'] = File('F', 'a.txt', 'R')
+        saved_tree.reconstruct_by_parents()
+        cloud_tree = Tree('R')
+        cloud_tree.files['F'] = CloudFile('F', 'a.txt', 'R', hashes={'sha1Hash': hashlib.sha1(b'content').hexdigest()})
+        cloud_tree.reconstruct_by_parents()
+        cache = mock.Mock(get=mock.Mock(return_value=None))
+        ids = self._local_ids(cloud_tree, saved_tree, cache=cache)
+        self.assertEqual(ids['renamed.txt'], 'F')
+        self.assertTrue(is_temp_id(ids['other.txt']))
+        self.assertTrue(cache.put.called)
+
+        # Files of other sizes than the ones reported by the cloud are never read
+        self.assertEqual(self._local_ids(cloud_tree, saved_tree, {'F': len(b'content')})['renamed.txt'], 'F')
+        with mock.patch('onedrive.local.hash_file', wraps=hash_file) as spy:
+            ids = self._local_ids(cloud_tree, saved_tree, {'F': len(b'content') + 1})
+        self.assertTrue(is_temp_id(ids['renamed.txt']))
+        self.assertFalse(spy.called)
+
+    def test_new_cloud_file(self):
+        # A file of the same name added in the cloud has never been downloaded, so it conflicts instead of pairing
+        (self.path / 'a.txt').write_bytes(b'local')
+        cloud_tree = Tree('R')
+        cloud_tree.files['X'] = CloudFile('X', 'a.txt', 'R', hashes={'sha1Hash': hashlib.sha1(b'cloud').hexdigest()})
+        cloud_tree.reconstruct_by_parents()
+        self.assertTrue(is_temp_id(self._local_ids(cloud_tree, Tree('R'))['a.txt']))
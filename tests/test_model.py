@@ -0,0 +1,96 @@
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import copy
+import unittest
+
+from onedrive.model import Tree, File, Directory, basic_operation, check_operation
+from onedrive.model import AddFile, DelFile, RenameMoveFile, AddDir, DelDir, RenameMoveDir
+
+
+class TestModel(unittest.TestCase):
+    def setUp(self):
+        self.tree = Tree('0')
+        for file in [
+            File('11', 'File 11', '0'),
+            File('12', 'File 12', '1'),
+            File('13', 'File 13', '2'),
+            File('14', 'File 14', '9'),
+            File('15', 'File 15', '5')
+        ]:
+            self.tree.files[file.id] = file
+        for directory in [
+            Directory('1', 'Folder 1', '0'),
+            Directory('2', 'Folder 2', '1'),
+            Directory('3', 'Folder 3', '9'),
+            Directory('4', 'Folder 4', '3'),
+            Directory('5', 'Folder 5', '6'),
+            Directory('6', 'Folder 6', '5')
+        ]:
+            self.tree.dirs[directory.id] = directory
+        self.tree.reconstruct_by_parents()
+
+    def test_reconstruct_by_parents(self):
+        self.assertEqual(self.tree.files.keys(), {'11', '12', '13'})
+        self.assertEqual(self.tree.dirs.keys(), {'0', '1', '2'})
+        self.assertEqual(self.tree.dirs['0'].files, {'11'})
+        self.assertEqual(self.tree.dirs['0'].dirs, {'1'})
+        self.assertEqual(self.tree.dirs['1'].files, {'12'})
+        self.assertEqual(self.tree.dirs['1'].dirs, {'2'})
+        self.assertEqual(self.tree.dirs['2'].files, {'13'})
+        self.assertEqual(self.tree.dirs['2'].dirs, set())
+        self.assertEqual(self.tree.list_names('0'), {'File 11', 'Folder 1'})
+
+    def test_digest(self):
+        other = copy.deepcopy(self.tree)
+        self.assertTrue(other.equals(self.tree))
+        basic_operation(RenameMoveFile('13', 'File 16', None), other)
+        self.assertFalse(other.equals(self.tree))
+        self.assertEqual(other.digest('1')[1], self.tree.digest('1')[1])
+        basic_operation(RenameMoveFile('13', 'File 13', None), other)
+        self.assertTrue(other.equals(self.tree))
+
+        # A directory is restored only with all its subdirectories, so invalidating them reaches it
+        digests = self.tree.all_digests()
+        restored = copy.deepcopy(self.tree)
+        restored.reconstruct_by_parents()
+        restored.restore_digests({dir_id: digest for dir_id, digest in digests.items() if dir_id != '2'})
+        self.assertEqual(restored.cached_digests(), {})
+        restored.restore_digests(digests)
+        self.assertEqual(restored.cached_digests(), digests)
+
+    def test_name_index(self):
+        for operation in [
+            AddFile('0', '16', 'File 16', 0),
+            RenameMoveFile('16', 'File 17', '1'),
+            DelFile('11'),
+            AddDir('1', '7', 'Folder 7'),
+            RenameMoveDir('2', 'Folder 8', '7'),
+            RenameMoveFile('13', None, '1'),
+            RenameMoveDir('2', None, '0'),
+            DelDir('7')
+        ]:
+            self.assertTrue(check_operation(operation, self.tree))
+            basic_operation(operation, self.tree)
+            for directory in self.tree.dirs.values():
+                names = {self.tree.files[child].name for child in directory.files}
+                names |= {self.tree.dirs[child].name for child in directory.dirs}
+                self.assertEqual(self.tree.list_names(directory.id), names)
+        self.assertFalse(check_operation(AddFile('1', '18', 'File 13', 0), self.tree))
+        self.assertTrue(check_operation(AddFile('1', '18', 'Folder 7', 0), self.tree))
+
+
+if __name__ == '__main__':
+    unittest.main()
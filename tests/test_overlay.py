@@ -0,0 +1,79 @@
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import copy
+import unittest
+
+from onedrive.algorithms import field_test
+from onedrive.compact import CompactTree
+from onedrive.model import Tree, CloudFile, Directory, basic_operation
+from onedrive.model import AddCloudFile, DelFile, ModifyCloudFile, RenameMoveFile, AddDir, DelDir, RenameMoveDir
+from onedrive.overlay import OverlayTree
+
+
+class TestOverlayTree(unittest.TestCase):
+    def setUp(self):
+        self.trees = Tree('0'), CompactTree('0')
+        for tree in self.trees:
+            for file in [
+                CloudFile('11', 'File 11', '0', 0, 'e11', 'c11', {}),
+                CloudFile('12', 'File 12', '1', 0, 'e12', 'c12', {}),
+                CloudFile('13', 'File 13', '2', 0, 'e13', 'c13', {}),
+                CloudFile('14', 'File 14', '3', 0, 'e14', 'c14', {})
+            ]:
+                tree.files[file.id] = file
+            for directory in [
+                Directory('1', 'Folder 1', '0'),
+                Directory('2', 'Folder 2', '1'),
+                Directory('3', 'Folder 3', '0')
+            ]:
+                tree.dirs[directory.id] = directory
+            tree.reconstruct_by_parents()
+        self.script = [
+            AddCloudFile('2', '15', 'File 15', 0, 'e15', 'c15'),
+            ModifyCloudFile('11', 0, 'e11', 'c11-modified'),
+            RenameMoveFile('12', 'File 16', '2'),
+            DelFile('14'),
+            DelDir('3'),
+            AddDir('0', '4', 'Folder 4'),
+            RenameMoveDir('2', 'Folder 5', '4')
+        ]
+
+    def test_field_test(self):
+        for tree in self.trees:
+            original = copy.deepcopy(tree)
+            expected = copy.deepcopy(tree)
+            for line in self.script:
+                basic_operation(line, expected)
+
+            field = field_test(tree, self.script)
+            self.assertIsInstance(field, OverlayTree)
+            self.assertTrue(field.equals(expected))
+            self.assertEqual(field.files.keys(), expected.files.keys())
+            self.assertEqual(field.dirs.keys(), expected.dirs.keys())
+            self.assertEqual(len(field.files), len(expected.files))
+            self.assertEqual(field.files['11'].cTag, 'c11-modified')
+            self.assertEqual(field.list_names('2'), {'File 13', 'File 15', 'File 16'})
+
+            # The base tree is left untouched
+            self.assertTrue(tree.equals(original))
+            self.assertEqual(tree.files['11'].cTag, 'c11')
+            self.assertEqual(tree.dirs['2'].files, {'13'})
+            self.assertEqual(tree.list_names('0'), {'File 11', 'Folder 1', 'Folder 3'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import tempfile
+import unittest
+from pathlib import Path
+
+from onedrive.platform import clone_file
+
+
+class TestPlatform(unittest.TestCase):
+    def test_clone_file(self):
+        content = bytes(range(256)) * 10000
+        with tempfile.TemporaryDirectory() as directory:
+            source = Path(directory) / 'source'
+            destination = Path(directory) / 'destination'
+            source.write_bytes(content)
+            destination.write_bytes(b'overwritten' * 100000)
+            clone_file(source, destination)
+            self.assertEqual(destination.read_bytes(), content)
+            source.write_bytes(b'changed')
+            self.assertEqual(destination.read_bytes(), content)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import base64
+import random
+import unittest
+
+from onedrive.algorithms import HASH_ENGINES
+from onedrive.quickxor import QuickXorHash
+
+
+def _quick_xor_by_definition(data: bytes) -> str:
+    register = 0
+    for position, byte in enumerate(data):
+        offset = position * 11 % 160
+        register ^= ((byte << offset) | (byte >> (160 - offset))) & ((1 << 160) - 1)
+    register ^= len(data) << (12 * 8)
+    return base64.b64encode((register & ((1 << 160) - 1)).to_bytes(20, 'little')).decode()
+
+
+class TestQuickXorHash(unittest.TestCase):
+    def test_vectors(self):
+        for content, expected in [
+            (b'', 'AAAAAAAAAAAAAAAAAAAAAAAAAAA='),
+            (b'0', 'MAAAAAAAAAAAAAAAAQAAAAAAAAA=')
+        ]:
+            engine = QuickXorHash()
+            engine.update(content)
+            self.assertEqual(engine.b64digest(), expected)
+
+    def test_chunks(self):
+        rng = random.Random(0)
+        for length in [1, 159, 160, 161, 1000, 12345]:
+            content = bytes(rng.getrandbits(8) for _ in range(length))
+            expected = _quick_xor_by_definition(content)
+            for chunk_size in [1, 7, 160, 333, length]:
+                engine = HASH_ENGINES['quickXorHash']()
+                engine.send(None)
+                for begin in range(0, length, chunk_size):
+                    engine.send(memoryview(content)[begin:begin + chunk_size])
+                self.assertEqual(engine.send(None), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
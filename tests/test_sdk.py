@@ -0,0 +1,304 @@
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import copy
+import io
+import json
+import types
+import unittest
+from typing import List, Mapping
+from unittest import mock
+
+import requests
+from requests.adapters import BaseAdapter
+
+from onedrive.database import TreeType, session_scope, load_tree, save_tree
+from onedrive.model import Tree, CloudFile, Directory, _node_digest
+from onedrive.sdk import BatchClient, BatchError, retrieve_delta, wait_for_monitor, upload_large_file_by_parent
+
+
+class BatchAdapter(BaseAdapter):
+    """Answer each batch with the next statuses, by the identifiers of the requests"""
+
+    def __init__(self, statuses: List[Mapping[str, int]]):
+        super().__init__()
+        self.batches = []
+        self._statuses = iter(statuses)
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        batch = json.loads(request.body.decode())['requests']
+        self.batches.append(batch)
+        statuses = next(self._statuses)
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        response._content = json.dumps({'responses': [{
+            'id': item['id'],
+            'status': statuses[item['id']],
+            'headers': {'Retry-After': '0'} if statuses[item['id']] == 429 else {},
+            'body': {'id': item['id']}
+        } for item in batch]}).encode()
+        return response
+
+    def close(self):
+        pass
+
+
+class MonitorAdapter(BaseAdapter):
+    """Answer each poll with the next status, headers and body"""
+
+    def __init__(self, responses: List[tuple]):
+        super().__init__()
+        self.polls = 0
+        self._responses = iter(responses)
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        self.polls += 1
+        status, headers, body = next(self._responses)
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response.request = request
+        response.url = request.url
+        response._content = json.dumps(body).encode()
+        return response
+
+    def close(self):
+        pass
+
+
+class UploadAdapter(BaseAdapter):
+    """Serve an upload session which has received the first @received bytes, or has expired if None"""
+
+    def __init__(self, received: int = None):
+        super().__init__()
+        self.received = received
+        self.requests = []
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        self.requests.append((request.method, request.headers.get('Content-Range', None)))
+        response = requests.Response()
+        response.request = request
+        response.status_code = 404 if self.received is None else 200
+        body = {'nextExpectedRanges': ['{}-'.format(self.received)]}
+        if request.method == 'PUT':
+            response.status_code = 201
+            body = {'id': 'F', 'name': 'a.bin', 'parentReference': {'id': 'R'}, 'size': 10, 'eTag': 'e', 'cTag': 'c',
+                    'file': {}}
+        response._content = json.dumps(body).encode()
+        return response
+
+    def close(self):
+        pass
+
+
+class TestBatchClient(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('onedrive.transfer.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _client(self, statuses: List[Mapping[str, int]]):
+        self.adapter = BatchAdapter(statuses)
+        session = requests.Session()
+        session.mount('https://', self.adapter)
+        self.called = []
+        return BatchClient(session)
+
+    def _queue(self, client: BatchClient, tag: str, *resources: str):
+        client.remove_item(tag, resources=resources, tag=tag, callback=lambda body: self.called.append(tag))
+
+    def test_dependencies(self):
+        # Unrelated requests are applied in any order
+        client = self._client([{'0': 204, '1': 204}, {'0': 204, '1': 204, '2': 204}])
+        self._queue(client, 'a', '1')
+        self._queue(client, 'b', '2')
+        client.flush()
+        self.assertFalse(any('dependsOn' in request for request in self.adapter.batches[0]))
+
+        # Any dependency makes the whole batch serial, as a request may only depend on one other
+        self._queue(client, 'a', '1')
+        self._queue(client, 'b', '2')
+        self._queue(client, 'c', '1', '3')
+        client.flush()
+        self.assertEqual([request.get('dependsOn') for request in self.adapter.batches[1]], [None, ['0'], ['1']])
+        self.assertEqual(self.called, ['a', 'b', 'a', 'b', 'c'])
+
+    def test_throttled(self):
+        # The throttled request is sent again together with the one depending on it
+        client = self._client([{'0': 429, '1': 204, '2': 424}, {'0': 204, '2': 204}])
+        self._queue(client, 'a', '1')
+        self._queue(client, 'b', '2')
+        self._queue(client, 'c', '1')
+        client.flush()
+        self.assertEqual([(request['id'], request.get('dependsOn')) for request in self.adapter.batches[1]], [
+            ('0', None), ('2', ['0'])
+        ])
+        self.assertEqual(self.called, ['b', 'a', 'c'])
+        self.assertEqual(self.sleep.call_count, 1)
+
+    def test_failed(self):
+        # Requests after a failed one in a serial batch are sent again unless they depend on it
+        client = self._client([{'0': 409, '1': 424, '2': 424}, {'2': 204}])
+        self._queue(client, 'a', '1')
+        self._queue(client, 'b', '1')
+        self._queue(client, 'c', '2')
+        with self.assertRaises(BatchError) as context:
+            client.flush()
+        self.assertEqual(context.exception.failures, [('a', 409, {'id': '0'}), ('b', 424, {'id': '1'})])
+        self.assertEqual(self.called, ['c'])
+        self.sleep.assert_not_called()
+
+    def test_exhausted(self):
+        client = self._client([{'0': 429}] * 11)
+        self._queue(client, 'a', '1')
+        with self.assertRaises(BatchError) as context:
+            client.flush()
+        self.assertEqual(context.exception.failures, [('a', 429, {'id': '0'})])
+        self.assertEqual(len(self.adapter.batches), 11)
+
+
+class TestRetrieveDelta(unittest.TestCase):
+    def setUp(self):
+        config = types.SimpleNamespace(root_id='R', delta_link='L')
+        for target in ['onedrive.sdk.CONFIG', 'onedrive.database.CONFIG']:
+            patcher = mock.patch(target, config)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self._clear)
+
+    @staticmethod
+    def _clear():
+        with session_scope() as db_session:
+            save_tree(db_session, Tree('R'), TreeType.DELTA)
+
+    @staticmethod
+    def _item(identifier: str, name: str, parent_id: str, c_tag: str = None) -> dict:
+        item = {'id': identifier, 'name': name, 'parentReference': {'id': parent_id}}
+        if c_tag is None:
+            item['folder'] = {}
+        else:
+            item.update(eTag='e', cTag=c_tag, size=0, file={})
+        return item
+
+    def test_digests(self):
+        tree = Tree('R')
+        for directory in [Directory('A', 'a', 'R'), Directory('B', 'b', 'A'), Directory('C', 'c', 'R'),
+                          Directory('E', 'e', 'R'), Directory('H', 'h', 'R')]:
+            tree.dirs[directory.id] = directory
+        for file in [CloudFile('F1', '1', 'A', 0, 'e', 'c'), CloudFile('F2', '2', 'B', 0, 'e', 'c'),
+                     CloudFile('F3', '3', 'R', 0, 'e', 'c'), CloudFile('F4', '4', 'C', 0, 'e', 'c'),
+                     CloudFile('F6', '6', 'H', 0, 'e', 'c')]:
+            tree.files[file.id] = file
+        tree.reconstruct_by_parents()
+        with session_scope() as db_session:
+            save_tree(db_session, tree, TreeType.DELTA)
+        with session_scope() as db_session:
+            self.assertEqual(load_tree(db_session, TreeType.DELTA).cached_digests(), tree.all_digests())
+
+        session = mock.Mock()
+        session.get.return_value.json.return_value = {'value': [
+            self._item('F1', '1', 'A', 'd'),
+            self._item('D', 'd', 'B'),
+            self._item('F5', '5', 'D', 'c'),
+            self._item('F3', '3', 'E', 'c'),
+            {'id': 'F2', 'deleted': {}},
+            {'id': 'F6', 'deleted': {}}
+        ], '@odata.deltaLink': 'L'}
+        with mock.patch('onedrive.model._node_digest', wraps=_node_digest) as node_digest:
+            tree = retrieve_delta(session)
+
+        # Only the subtrees with changes are digested again, and none of the digests kept is stale
+        digested = {field for call in node_digest.call_args_list for field in call[0]}
+        self.assertTrue({'R', 'A', 'B', 'D', 'E', 'H', 'F1', 'F3', 'F5'} <= digested)
+        self.assertFalse({'C', 'F4'} & digested)
+        fresh = copy.deepcopy(tree)
+        fresh.reconstruct_by_parents()
+        self.assertEqual(tree.all_digests(), fresh.all_digests())
+
+
+class TestWaitForMonitor(unittest.TestCase):
+    def setUp(self):
+        self.clock = 0
+        patchers = [
+            mock.patch('onedrive.sdk.time.sleep', side_effect=self._sleep),
+            mock.patch('onedrive.sdk.time.monotonic', side_effect=lambda: self.clock)
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _sleep(self, seconds: float):
+        self.clock += seconds
+
+    def _wait(self, responses: List[tuple], **kwargs) -> str:
+        self.adapter = MonitorAdapter(responses)
+        session = requests.Session()
+        session.mount('https://', self.adapter)
+        with mock.patch('onedrive.sdk.governed_session', return_value=session):
+            return wait_for_monitor('https://monitor/', **kwargs)
+
+    def test_finished(self):
+        progress = (202, {}, {'status': 'inProgress'})
+        self.assertEqual(self._wait([progress, (503, {}, {}), (200, {}, {'status': 'completed', 'resourceId': 'A'})]),
+                         'A')
+        # The resulting item needs authentication, so the redirect to it is not followed
+        self.assertEqual(self._wait([progress, (303, {'Location': 'https://graph/v1.0/drives/D/items/B%21C'}, {})]),
+                         'B!C')
+        self.assertEqual(self.adapter.polls, 2)
+        self.assertEqual(self._wait([(200, {}, {'id': 'E', 'name': 'copy'})]), 'E')
+
+    def test_unfinished(self):
+        with self.assertRaises(Exception):
+            self._wait([(200, {}, {'status': 'failed', 'error': {'code': 'nameAlreadyExists'}})])
+        # Polls stop at the deadline whether the job is in progress or the monitor keeps failing
+        with self.assertRaises(Exception):
+            self._wait(iter(lambda: (202, {}, {'status': 'inProgress'}), None), total_timeout=60)
+        self.assertEqual(self.adapter.polls, 9)
+        self.clock = 0
+        with self.assertRaises(Exception):
+            self._wait(iter(lambda: (500, {}, {}), None), total_timeout=60)
+        self.assertLess(self.clock, 60)
+
+
+class TestUploadSession(unittest.TestCase):
+    def _upload(self, adapter: UploadAdapter, session: mock.Mock, resume_url: str = None) -> List[int]:
+        connection = requests.Session()
+        connection.mount('https://', adapter)
+        confirmed = []
+
+        def _progress(url: str, offset: int):
+            confirmed.append((url, offset))
+
+        with mock.patch('onedrive.sdk.governed_session', return_value=connection):
+            file = upload_large_file_by_parent(session, 'R', 'a.bin', io.BytesIO(b'0123456789'), 10,
+                                               resume_url=resume_url, progress=_progress)
+        self.assertEqual(file.id, 'F')
+        return confirmed
+
+    def test_resume(self):
+        # Only the bytes after the ranges the server expects are sent, to the same session
+        adapter = UploadAdapter(6)
+        session = mock.Mock()
+        self.assertEqual(self._upload(adapter, session, 'https://upload/1'), [('https://upload/1', 6)])
+        self.assertEqual(adapter.requests, [('GET', None), ('PUT', 'bytes 6-9/10')])
+        self.assertFalse(session.post.called)
+
+    def test_expired(self):
+        adapter = UploadAdapter()
+        session = mock.Mock()
+        session.post.return_value.json.return_value = {'uploadUrl': 'https://upload/2'}
+        self.assertEqual(self._upload(adapter, session, 'https://upload/1'), [('https://upload/2', 0)])
+        self.assertEqual(adapter.requests, [('GET', None), ('PUT', 'bytes 0-9/10')])
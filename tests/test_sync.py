@@ -0,0 +1,301 @@
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import copy
+import hashlib
+import os
+import socketserver
+import tempfile
+import threading
+import types
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from unittest import mock
+
+from onedrive.database import TreeType, ScriptType, session_scope, load_tree, save_tree
+from onedrive.database import save_journal, load_journal, checkpoint_journal, clear_journal, load_upload_session
+from onedrive.database import save_partial_download, load_partial_download, remove_partial_downloads
+from onedrive.model import Tree, CloudFile, Directory, AddFile, AddCloudFile, DelFile, ModifyFile, AddDir, DelDir
+from onedrive.model import LocalFile
+from onedrive.platform import save_id_in_metadata, load_id_from_metadata
+from onedrive.sdk import BATCH_UPLOAD_LIMIT, download_file
+from onedrive.sync import translate_journal, synchronized_tree, local_apply_script, cloud_apply_script, _upload_file
+from onedrive.sync import _download_partial
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serve the content with ranges, recording the beginnings of the ranges requested"""
+
+    protocol_version = 'HTTP/1.1'
+    content = bytes(range(256)) * 16
+    requested = []
+
+    def do_GET(self):
+        first, _, last = self.headers['Range'][len('bytes='):].partition('-')
+        begin, end = int(first), min(int(last) + 1 if last else len(self.content), len(self.content))
+        self.requested.append(begin)
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(begin, end - 1, len(self.content)))
+        self.send_header('Content-Length', str(end - begin))
+        self.end_headers()
+        self.wfile.write(self.content[begin:end])
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('onedrive.database.CONFIG', types.SimpleNamespace(root_id='R'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self._clear)
+
+    @staticmethod
+    def _clear():
+        with session_scope() as db_session:
+            clear_journal(db_session)
+            remove_partial_downloads(db_session)
+            save_tree(db_session, Tree('R'), TreeType.SAVED)
+
+    def test_journal(self):
+        planned_tree = Tree('R')
+        planned_tree.files['F'] = CloudFile('F', 'a.txt', 'R', 0, 'e', 'c', {})
+        planned_tree.reconstruct_by_parents()
+        saved_tree = Tree('R')
+        saved_tree.dirs['D'] = Directory('D', 'dir', 'R')
+        saved_tree.reconstruct_by_parents()
+        scripts = {
+            ScriptType.CLOUD: [AddCloudFile('R', 'F', 'a.txt', 0, 'e', 'c'), DelDir('D')],
+            ScriptType.LOCAL: [AddFile('R', '\0' + '1', 'b.txt', 0), ModifyFile('F', 0)]
+        }
+        with session_scope() as db_session:
+            save_tree(db_session, saved_tree, TreeType.SAVED)
+            save_journal(db_session, scripts, {'\0' + '1': 'b.txt'}, planned_tree)
+        with session_scope() as db_session:
+            self.assertEqual(load_journal(db_session), (scripts, set(), {'\0' + '1': 'b.txt'}, {}))
+            self.assertTrue(load_tree(db_session, TreeType.PLANNED).equals(planned_tree))
+            checkpoint_journal(db_session, ScriptType.LOCAL, 0, {'\0' + '1': 'B'})
+        with session_scope() as db_session:
+            _, done, _, real_id = load_journal(db_session)
+            self.assertEqual(done, {(ScriptType.LOCAL, 0)})
+            self.assertEqual(real_id, {'\0' + '1': 'B'})
+            clear_journal(db_session)
+        with session_scope() as db_session:
+            self.assertIsNone(load_journal(db_session))
+            self.assertFalse(load_tree(db_session, TreeType.PLANNED).files)
+            # Only the trees of the journal are cleared
+            self.assertTrue(load_tree(db_session, TreeType.SAVED).equals(saved_tree))
+
+    def test_translate_journal(self):
+        root = Path('/root')
+        scripts = {
+            ScriptType.CLOUD: [DelFile('F')],
+            ScriptType.LOCAL: [AddDir('R', '\0' + '1', 'dir'), AddFile('\0' + '1', '\0' + '2', 'a.txt', 0)]
+        }
+        # The directory is found again by its path, but the file has disappeared since the interruption
+        cloud_script, local_script, real_id = translate_journal(
+            scripts, {'\0' + '1': 'dir', '\0' + '2': 'dir/a.txt'}, {'\0' + '1': 'D'},
+            {'R': root, '\0' + '7': root / 'dir'}, root
+        )
+        self.assertEqual(cloud_script, [DelFile('F')])
+        self.assertEqual(local_script, [AddDir('R', '\0' + '7', 'dir'), AddFile('\0' + '7', '\0\0' + '2', 'a.txt', 0)])
+        self.assertEqual(real_id, {'\0' + '7': 'D'})
+
+    def test_synchronized_tree(self):
+        planned_tree = Tree('R')
+        planned_tree.dirs['D'] = Directory('D', 'dir', 'R')
+        planned_tree.files['F'] = CloudFile('F', 'a.txt', 'R', 0, 'e1', 'c1', {})
+        planned_tree.files['G'] = CloudFile('G', 'b.txt', 'R', 0, 'e1', 'c1', {})
+        planned_tree.files['H'] = CloudFile('H', 'c.txt', 'D', 0, 'e1', 'c1', {})
+        planned_tree.reconstruct_by_parents()
+        planned_tree.all_digests()
+
+        # Uploaded files take the tags assigned by the cloud, while changes by others since planning are left out
+        cloud_tree = Tree('R')
+        cloud_tree.dirs['E'] = Directory('E', 'new', 'R')
+        cloud_tree.files['F'] = CloudFile('F', 'a.txt', 'R', 0, 'e2', 'c2', {})
+        cloud_tree.files['G'] = CloudFile('G', 'b.txt', 'R', 0, 'e2', 'c2', {})
+        cloud_tree.files['N'] = CloudFile('N', 'n.txt', 'E', 0, 'e1', 'c1', {})
+        cloud_tree.files['X'] = CloudFile('X', 'x.txt', 'R', 0, 'e1', 'c1', {})
+        cloud_tree.reconstruct_by_parents()
+
+        # The deletion inside the deleted directory has been pruned
+        local_script = [
+            ModifyFile('F', 0), AddDir('R', '\0' + '1', 'new'), AddFile('\0' + '1', '\0' + '2', 'n.txt', 0), DelDir('D')
+        ]
+        tree = synchronized_tree(planned_tree, local_script, cloud_tree, {'\0' + '1': 'E', '\0' + '2': 'N'})
+        self.assertEqual({file_id: file.cTag for file_id, file in tree.files.items()}, {
+            'F': 'c2', 'G': 'c1', 'N': 'c1'
+        })
+        self.assertEqual(set(tree.dirs), {'R', 'E'})
+        self.assertEqual(tree.files['N'].parent, 'E')
+        fresh = copy.deepcopy(tree)
+        fresh.reconstruct_by_parents()
+        self.assertEqual(tree.all_digests(), fresh.all_digests())
+
+    def test_reuse_deleted_source(self):
+        cloud_tree = Tree('R')
+        cloud_tree.files['N'] = CloudFile('N', 'b.txt', 'R', 0, 'e', 'c', {})
+        cloud_tree.reconstruct_by_parents()
+        cloud_script = [AddFile('R', 'N', 'b.txt', 0), DelFile('S')]
+
+        def _apply(root: Path, name: str, identifier: str, done=frozenset()) -> Tree:
+            # Apply with the local tree as parsed from a file saved with @identifier
+            save_id_in_metadata(identifier, root / name)
+            local_tree = Tree('R')
+            local_tree.files[identifier] = LocalFile(identifier, name, 'R')
+            local_tree.reconstruct_by_parents()
+            local_apply_script(cloud_script, {'R': root, identifier: root / name}, local_tree, cloud_tree, None, done,
+                               {'N': 'S'})
+            self.assertEqual([path.name for path in root.iterdir()], ['b.txt'])
+            self.assertEqual((root / 'b.txt').read_bytes(), b'content')
+            self.assertEqual(load_id_from_metadata(root / 'b.txt'), 'N')
+            return local_tree
+
+        with tempfile.TemporaryDirectory() as directory:
+            # The last use of a deleted source takes the file itself, so the source never carries the new identifier
+            (Path(directory) / 'a.txt').write_bytes(b'content')
+            self.assertEqual(set(_apply(Path(directory), 'a.txt', 'S').files), {'N'})
+        with tempfile.TemporaryDirectory() as directory:
+            # Interrupted after the reuse was recorded, the deletion of the source has nothing left to delete
+            (Path(directory) / 'b.txt').write_bytes(b'content')
+            _apply(Path(directory), 'b.txt', 'N', {(ScriptType.CLOUD, 0)})
+        with tempfile.TemporaryDirectory() as directory:
+            # Interrupted after moving but before saving the identifier, the source is already at the destination
+            (Path(directory) / 'b.txt').write_bytes(b'content')
+            _apply(Path(directory), 'b.txt', 'S')
+
+    def test_copy_and_upload(self):
+        local_script = [AddFile('R', '\0' + '1', 'copy.bin', 0), AddFile('R', '\0' + '2', 'big.bin', 0)]
+
+        def _upload(session, parent_id: str, name: str, path: Path, identifier: str = None) -> CloudFile:
+            return CloudFile('U' + name, name, parent_id, 0, 'e', 'c', {})
+
+        removed = []
+
+        def _apply(root: Path, copy_error: Exception = None) -> Tree:
+            cloud_tree = Tree('R')
+            copied = CloudFile('C', 'copy.bin', 'R', 0, 'e', 'c', {})
+            for index in range(2):
+                (root / local_script[index].name).write_bytes(b'\0' * (BATCH_UPLOAD_LIMIT + 1))
+            id_to_path = {'R': root, '\0' + '1': root / 'copy.bin', '\0' + '2': root / 'big.bin'}
+            with mock.patch('onedrive.sync.copy_item', return_value='M'), \
+                    mock.patch('onedrive.sync.wait_for_monitor', return_value='C', side_effect=copy_error), \
+                    mock.patch('onedrive.sync.get_item', return_value=copied), \
+                    mock.patch('onedrive.sync._upload_file', side_effect=_upload), \
+                    mock.patch('onedrive.sync.find_child', return_value='P'), \
+                    mock.patch('onedrive.sync.remove_item', side_effect=lambda _, item_id: removed.append(item_id)):
+                cloud_apply_script(local_script, id_to_path, Tree('R'), cloud_tree, mock.Mock(),
+                                   copies={'\0' + '1': 'S'})
+            return cloud_tree
+
+        # Large uploads are ordered by their paths relative to the root, which the copy must not change
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(set(_apply(Path(directory)).files), {'C', 'Ubig.bin'})
+        self.assertEqual(removed, [])
+        # The item partially copied before failing is removed, so that the upload does not conflict with it
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(set(_apply(Path(directory), Exception('Failed')).files), {'Ucopy.bin', 'Ubig.bin'})
+        self.assertEqual(removed, ['P'])
+
+    def test_resume_upload(self):
+        def _upload(session, parent_id: str, name: str, file, size: int, *, resume_url: str = None, progress=None):
+            resumed.append(resume_url)
+            progress('https://upload/' + str(len(resumed)), 4)
+            if interrupted:
+                raise ConnectionError()
+            return CloudFile('F', name, parent_id, 0, 'e', 'c', {})
+
+        resumed = []
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch('onedrive.sync.SIMPLE_UPLOAD_LIMIT', 0), \
+                mock.patch('onedrive.sync.upload_large_file_by_parent', side_effect=_upload):
+            path = Path(directory) / 'a.bin'
+            path.write_bytes(b'content')
+            interrupted = True
+            with self.assertRaises(ConnectionError):
+                _upload_file(None, 'R', 'a.bin', path)
+            # The session is continued after a restart as long as the file is the same version
+            with self.assertRaises(ConnectionError):
+                _upload_file(None, 'R', 'a.bin', path)
+            stat = path.stat()
+            os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+            with self.assertRaises(ConnectionError):
+                _upload_file(None, 'R', 'a.bin', path)
+            # Replaced by another file of the same modification time, the inode is different
+            path.with_name('b.bin').write_bytes(b'content')
+            stat = path.stat()
+            os.utime(str(path.with_name('b.bin')), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            os.replace(str(path.with_name('b.bin')), str(path))
+            interrupted = False
+            self.assertEqual(_upload_file(None, 'R', 'a.bin', path).id, 'F')
+            self.assertEqual(resumed, [None, 'https://upload/1', None, None])
+            with session_scope() as db_session:
+                self.assertIsNone(load_upload_session(db_session, str(path), 'R', 'a.bin', path.stat()))
+
+    def test_resume_download(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+        content = RangeHandler.content
+        cloud_file = CloudFile('F', 'a.bin', 'R', 0, 'e', 'c1', {'sha1Hash': hashlib.sha1(content).hexdigest()})
+
+        def _download_file(*args, progress, interrupted: bool, **kwargs):
+            def _interrupt(*progress_args):
+                progress(*progress_args)
+                raise KeyboardInterrupt()
+            download_file(*args, part_size=1024, progress=_interrupt if interrupted else progress, **kwargs)
+
+        def _download(staging: Path, file: CloudFile = cloud_file, interrupted: bool = False) -> Path:
+            del RangeHandler.requested[:]
+            with mock.patch('onedrive.sdk.get_download_url', return_value=url), \
+                    mock.patch('onedrive.sync.download_file',
+                               side_effect=lambda *args, **kwargs: _download_file(*args, interrupted=interrupted,
+                                                                                  **kwargs)):
+                return _download_partial(None, file.id, file, staging)
+
+        with tempfile.TemporaryDirectory() as directory:
+            staging = Path(directory)
+            # Interrupted after the first part is recorded, the parts still running are written but not recorded
+            with self.assertRaises(KeyboardInterrupt):
+                _download(staging, interrupted=True)
+            with session_scope() as db_session:
+                total, done = load_partial_download(db_session, 'F', 'c1')
+            self.assertEqual((total, len(done)), (len(content), 1))
+            partial = _download(staging)
+            self.assertEqual(partial.read_bytes(), content)
+            self.assertEqual(sorted(RangeHandler.requested), sorted({0, 1024, 2048, 3072} - {done[0][0]}))
+
+            # Another version of the file is downloaded from the beginning
+            with session_scope() as db_session:
+                save_partial_download(db_session, 'F', 'c0', len(content), [(0, 1024)])
+            _download(staging)
+            self.assertEqual(sorted(RangeHandler.requested), [0, 1024, 2048, 3072])
+
+            # Content of wrong hashes is removed with its record, as resuming it would never succeed
+            wrong = CloudFile('F', 'a.bin', 'R', 0, 'e', 'c2', {'sha1Hash': hashlib.sha1(b'other').hexdigest()})
+            with self.assertRaises(Exception):
+                _download(staging, wrong)
+            self.assertFalse(partial.exists())
+            with session_scope() as db_session:
+                self.assertIsNone(load_partial_download(db_session, 'F', 'c2'))
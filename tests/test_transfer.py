@@ -0,0 +1,173 @@
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import threading
+import unittest
+from pathlib import PurePath
+from unittest import mock
+
+from onedrive.transfer import ChunkSizer, Backoff, parse_ranges, parse_retry_after, missing_ranges, UPLOAD_CHUNK_UNIT
+from onedrive.transfer import TransferScheduler, RequestGovernor, TransferPriority, BandwidthSchedule, BandwidthLimiter
+from onedrive.transfer import parse_rate
+
+
+class TestTransfer(unittest.TestCase):
+    def test_chunk_sizer(self):
+        sizer = ChunkSizer(maximum=8 * UPLOAD_CHUNK_UNIT, target=1)
+        self.assertEqual(sizer.size, UPLOAD_CHUNK_UNIT)
+        # Grows at most twice as large each time, and never exceeds the maximum
+        for expected in [2, 4, 8, 8]:
+            sizer.measure(sizer.size, 0.01)
+            self.assertEqual(sizer.size, expected * UPLOAD_CHUNK_UNIT)
+        # Shrinks to what can be sent in the target time, in multiples of the unit
+        sizer.measure(sizer.size, 2.5)
+        self.assertEqual(sizer.size, 3 * UPLOAD_CHUNK_UNIT)
+        sizer.failed()
+        self.assertEqual(sizer.size, UPLOAD_CHUNK_UNIT)
+        sizer.measure(sizer.size, 100)
+        sizer.failed()
+        self.assertEqual(sizer.size, UPLOAD_CHUNK_UNIT)
+
+    def test_backoff(self):
+        backoff = Backoff(base=1, maximum=4, attempts=3)
+        error = Exception()
+        with mock.patch('time.sleep') as sleep:
+            backoff.wait(error)
+            backoff.wait(error, retry_after=30)
+            self.assertLessEqual(sleep.call_args_list[0][0][0], 1)
+            self.assertEqual(sleep.call_args_list[1][0][0], 30)
+            backoff.wait(error)
+            with self.assertRaises(Exception) as context:
+                backoff.wait(error)
+            self.assertIs(context.exception, error)
+            backoff.reset()
+            backoff.wait(error)
+        self.assertLessEqual(backoff.delay(), 4)
+
+    def test_parse(self):
+        self.assertEqual(parse_ranges(['1024-', '12-55']), [(12, 55), (1024, None)])
+        self.assertEqual(parse_retry_after('3'), 3)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'))
+
+    def test_missing_ranges(self):
+        self.assertEqual(missing_ranges(10, [], 4), [(0, 4), (4, 8), (8, 10)])
+        self.assertEqual(missing_ranges(10, [(4, 8), (0, 2)], 4), [(2, 4), (8, 10)])
+        self.assertEqual(missing_ranges(10, [(0, 4), (2, 10)], 4), [])
+        self.assertEqual(missing_ranges(0, [], 4), [])
+
+    def test_transfer_scheduler(self):
+        events = []
+        release = threading.Event()
+        with TransferScheduler(2) as transfers:
+            transfers.submit(lambda: release.wait(5) and 'a', ['x', 'p'], events.append)
+            transfers.submit(lambda: 'b', ['y'], events.append)
+            self.assertEqual(transfers.in_flight, 2)
+            transfers.wait(['y'])
+            self.assertEqual(events, ['b'])
+            self.assertEqual(transfers.in_flight, 1)
+            threading.Thread(target=release.set).start()
+            transfers.wait(['p'])
+            transfers.submit(lambda: 'c', ['p'], events.append)
+            self.assertEqual(events, ['b', 'a'])
+        self.assertEqual(events, ['b', 'a', 'c'])
+
+        started = threading.Event()
+
+        def _fail():
+            started.wait(5)
+            raise ValueError()
+
+        # Transfers which have started are still called back after a failure
+        with self.assertRaises(ValueError):
+            with TransferScheduler(2) as transfers:
+                transfers.submit(_fail, ['x'])
+                transfers.submit(lambda: started.set() or 'd', ['y'], events.append)
+        self.assertEqual(events, ['b', 'a', 'c', 'd'])
+
+    def test_request_governor(self):
+        governor = RequestGovernor(rate=1000, burst=2, concurrency=2, maximum=3)
+        first, waited = governor.acquire()
+        self.assertEqual(waited, 0)
+        second, _ = governor.acquire()
+        # Both throttled requests were admitted before the first decrease, so the limit is only halved once
+        governor.release(first, 429)
+        governor.release(second, 503)
+        self.assertEqual(governor.limit, 1)
+        for _ in range(4):
+            admitted, _ = governor.acquire()
+            governor.release(admitted, 200)
+        self.assertEqual(governor.limit, 3)
+        # The token bucket refills at the rate, and Retry-After pauses every request
+        admitted, _ = governor.acquire()
+        governor.release(admitted, 429, retry_after=0.05)
+        _, waited = governor.acquire()
+        self.assertGreaterEqual(waited, 0.04)
+        governor.record(waited)
+        self.assertEqual(governor.throttled_requests, 1)
+
+    def test_transfer_priority(self):
+        order = []
+        release = threading.Event()
+        with TransferScheduler(1, lambda tag: tag) as transfers:
+            # The only thread is busy, so that the others are queued and started by their priorities
+            transfers.submit(lambda: release.wait(5), ['blocker'])
+            for tag in [3, 1, 2, 1]:
+                transfers.submit(lambda tag=tag: order.append(tag), [tag], tag=tag)
+            release.set()
+        self.assertEqual(order, [1, 1, 2, 3])
+
+        priority = TransferPriority(['paths', 'small-first'], ['Work', 'a/b'])
+        keys = [
+            priority(PurePath('Work/x/big'), 1000),
+            priority(PurePath('a/b'), None),
+            priority(PurePath('a/c'), 10),
+            priority(PurePath('z'), None),
+            priority(PurePath('Workspace'), 1)
+        ]
+        self.assertEqual(sorted(range(5), key=keys.__getitem__), [0, 1, 4, 2, 3])
+        self.assertLess(TransferPriority(['large-first'])(PurePath('a'), 2), TransferPriority(['large-first'])(
+            PurePath('b'), 1
+        ))
+        with self.assertRaises(ValueError):
+            TransferPriority(['newest-first'])
+
+    def test_bandwidth(self):
+        self.assertEqual(parse_rate('512K'), 512 * 1024)
+        self.assertEqual(parse_rate('1.5MiB/s'), 1536 * 1024)
+        self.assertIsNone(parse_rate('unlimited'))
+        with self.assertRaises(ValueError):
+            parse_rate('fast')
+        schedule = BandwidthSchedule.parse('08:00-18:00=512K, 22:00-06:00=unlimited, 2M')
+        self.assertEqual(schedule.rate_at(datetime.time(9)), 512 * 1024)
+        self.assertIsNone(schedule.rate_at(datetime.time(23, 30)))
+        self.assertIsNone(schedule.rate_at(datetime.time(5)))
+        self.assertEqual(schedule.rate_at(datetime.time(20)), 2 * 1024 ** 2)
+        self.assertIsNone(BandwidthSchedule.parse('').rate_at(datetime.time(12)))
+
+        limiter = BandwidthLimiter(BandwidthSchedule(default=1000))
+        with mock.patch('time.sleep') as sleep:
+            limiter.consume(500)
+            # A second of the rate at most is saved up, and more than available is paid back by waiting
+            limiter.consume(2000)
+            self.assertAlmostEqual(sleep.call_args_list[-1][0][0], 2.5, places=1)
+            limiter.schedule = BandwidthSchedule()
+            limiter.consume(10 ** 9)
+        self.assertEqual(len(sleep.call_args_list), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
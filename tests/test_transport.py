@@ -0,0 +1,111 @@
+# Copyright (C) 2018  XU Guang-zhao
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, only version 3 of the License, but not any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import socket
+import socketserver
+import ssl
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+from onedrive.transport import HTTPXAdapter, _ssl_context
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    paths = []
+
+    def do_GET(self):
+        self.paths.append(self.path)
+        body = bytes(range(256)) * 64
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipIf(httpx is None, 'httpx is not installed')
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+        self.session = requests.Session()
+        self.session.trust_env = False
+        self.session.mount('http://', HTTPXAdapter(HTTPXAdapter.create_client(http2=False)))
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_responses(self):
+        expected = bytes(range(256)) * 64
+        self.assertEqual(self.session.get(self.url).content, expected)
+        with self.session.get(self.url, stream=True) as response:
+            self.assertEqual(response.raw.read(100), expected[:100])
+            self.assertEqual(b''.join(response.iter_content(1000)), expected[100:])
+
+        # Bodies of files and memory views are both sent, with the headers and status of requests
+        response = self.session.put(self.url, data=io.BytesIO(b'{"id": "1"}'), headers={'Content-Length': '11'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.headers['content-type'], 'application/json')
+        self.assertEqual(response.json(), {'id': '1'})
+        self.assertEqual(self.session.put(self.url, data=memoryview(b'content')).content, b'content')
+
+    def test_errors(self):
+        with socket.socket() as unused:
+            unused.bind(('127.0.0.1', 0))
+            port = unused.getsockname()[1]
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.session.get('http://127.0.0.1:{}/'.format(port))
+
+    def test_settings(self):
+        # A proxy receives the whole URL, and takes a client of its own unless the client is given
+        with requests.Session() as session:
+            session.trust_env = False
+            session.mount('http://', HTTPXAdapter())
+            del Handler.paths[:]
+            self.assertEqual(session.get('http://example.invalid/path', proxies={'http': self.url}).status_code, 200)
+            self.assertEqual(Handler.paths, ['http://example.invalid/path'])
+        with self.assertRaises(Exception):
+            self.session.get('http://example.invalid/path', proxies={'http': self.url})
+
+        self.assertIs(_ssl_context(True, None), True)
+        self.assertEqual(_ssl_context(False, None).verify_mode, ssl.CERT_NONE)
+        self.assertEqual(_ssl_context(requests.certs.where(), None).verify_mode, ssl.CERT_REQUIRED)